@@ -0,0 +1,46 @@
+"""
+Measures the memory held per dormant session, besides its persistence: a
+disconnected :class:`MQTTClient`, as kept before, against the
+:class:`DormantSession` record kept now.
+
+Usage: python -m benchmarks.dormant_sessions
+"""
+import tracemalloc
+
+from broker.client import DormantSession
+from broker.persistence import InMemoryPersistence
+from broker.server import MQTTServer
+
+
+SESSIONS = 10000
+
+
+def measure(make_session, uids):
+    tracemalloc.start()
+    sessions = [make_session(uid) for uid in uids]
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert len(sessions) == len(uids)
+    return allocated / len(uids)
+
+
+def main():
+    persistence = InMemoryPersistence()
+    uids = ['client-%d' % n for n in range(SESSIONS)]
+    for n, uid in enumerate(uids):
+        persistence.get_for_client(uid).subscriptions['site/%d/#' % n] = 1
+
+    server = MQTTServer(persistence=persistence)
+
+    clients = measure(server.recreate_client, uids)
+    records = measure(
+        lambda uid: DormantSession(uid, persistence.get_for_client(uid)), uids)
+
+    print('bytes per dormant session')
+    print('%-16s%8.0f' % ('MQTTClient', clients))
+    print('%-16s%8.0f' % ('DormantSession', records))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Measures the cost of encoding the copies of a Publish made for each of its
+subscribers: the full re-encoding of the copies (topic and payload included)
+against :meth:`broker.messages.Publish.raw_parts`, which only encodes the
+header and the packet id of each copy.
+
+Usage: python -m benchmarks.fanout
+"""
+from timeit import timeit
+
+from broker.messages import Publish
+
+
+SUBSCRIBERS = 1000
+PAYLOAD_SIZE = 1024
+ROUNDS = 20
+
+
+def make_publish():
+    msg = Publish(qos=1)
+    msg.topic = 'site/42/telemetry'
+    msg.payload = b'x' * PAYLOAD_SIZE
+    msg.id = 1
+    return Publish.from_bytes(msg.raw_data)
+
+
+def reencode(msg):
+    # the encoding path used before raw_parts
+    data = msg._encode_data()
+    header = msg._encode_fixed_header(data)
+    frame = bytearray()
+    frame.extend(header)
+    frame.extend(data)
+    return bytes(frame),
+
+
+def make_copies(msg):
+    copies = []
+    for packet_id in range(1, SUBSCRIBERS + 1):
+        copy = msg.copy()
+        copy.id = packet_id
+        copy.dup = False
+        copies.append(copy)
+
+    return copies
+
+
+def fan_out(msg, copies, encode):
+    shared = msg.payload, msg._get_encoded_topic()
+    encoded = 0
+
+    for copy in copies:
+        copy._pending_update = True
+        for part in encode(copy):
+            if part not in shared:
+                encoded += len(part)
+
+    return encoded
+
+
+def main():
+    msg = make_publish()
+    copies = make_copies(msg)
+
+    print('%d subscribers, %d bytes payload, %d rounds' %
+          (SUBSCRIBERS, PAYLOAD_SIZE, ROUNDS))
+    print()
+    print('%-12s %14s %18s' % ('', 'time (ms)', 'bytes encoded'))
+
+    results = []
+    for name, encode in (('re-encode', reencode),
+                         ('raw_parts', Publish.raw_parts)):
+        encoded = fan_out(msg, copies, encode)
+        seconds = timeit(lambda: fan_out(msg, copies, encode), number=ROUNDS)
+        results.append(seconds)
+        print('%-12s %14.3f %18d' % (name, seconds / ROUNDS * 1e3, encoded))
+
+    print()
+    print('speedup: %.1fx' % (results[0] / results[1]))
+
+
+if __name__ == '__main__':
+    main()
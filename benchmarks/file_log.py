@@ -0,0 +1,85 @@
+"""
+Measures the file log persistence: how many queued QoS 1 publishes are
+synced to the disk per second, for several of them appended per IOLoop
+iteration (thus per commit and fsync), and how fast the log is replayed on
+startup.
+
+Usage: python -m benchmarks.file_log [directory]
+"""
+import sys
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from tornado.ioloop import IOLoop
+
+from broker.messages import Publish
+from broker.persistence import FileLogPersistence
+
+
+MESSAGES = 5000
+BATCHES = (1, 10, 100, 1000)
+REPLAYED = 200000
+
+
+def make_publish():
+    msg = Publish(qos=1)
+    msg.topic = 'site/42/telemetry'
+    msg.payload = b'x' * 64
+    return msg
+
+
+def measure_commits(directory, batch):
+    persistence = FileLogPersistence(directory)
+    publishes = persistence.get_for_client('bob').outgoing_publishes
+    msg = make_publish()
+
+    def tick():
+        for _ in range(batch):
+            publishes.insert(msg)
+
+        # as done for each publish, before acknowledging it
+        return persistence.sync()
+
+    start = perf_counter()
+    for n in range(0, MESSAGES, batch):
+        IOLoop.instance().run_sync(tick)
+
+    elapsed = perf_counter() - start
+    persistence.log.close()
+
+    return MESSAGES / elapsed
+
+
+def measure_replay(directory):
+    persistence = FileLogPersistence(directory)
+    publishes = persistence.get_for_client('bob').outgoing_publishes
+    msg = make_publish()
+
+    for _ in range(REPLAYED):
+        publishes.insert(msg)
+
+    persistence.log.close()
+
+    start = perf_counter()
+    persistence = FileLogPersistence(directory)
+    elapsed = perf_counter() - start
+    persistence.log.close()
+
+    return REPLAYED / elapsed
+
+
+def main():
+    base = sys.argv[1] if len(sys.argv) > 1 else None
+
+    print('publishes synced per second')
+    print('%10s%14s' % ('per commit', 'publishes/s'))
+    for batch in BATCHES:
+        with TemporaryDirectory(dir=base) as directory:
+            print('%10d%14.0f' % (batch, measure_commits(directory, batch)))
+
+    with TemporaryDirectory(dir=base) as directory:
+        print('replay: %.0f records/s' % measure_replay(directory))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Measures the QoS 1 delivery throughput of a subscriber for several in-flight
+windows (see :class:`broker.client.OutgoingQueue`) and round trip times.
+
+The link is simulated: every packet ready is sent at once and its PUBACK
+arrives one round trip later, so the figures only account for the latency,
+not for the bandwidth or the broker's own processing time. The publishes are
+also checked to be first sent in the order they were queued.
+
+Usage: python -m benchmarks.inflight_window
+"""
+from heapq import heappush, heappop
+
+from broker.client import OutgoingQueue
+from broker.messages import Publish
+from broker.persistence.in_memory import InMemoryOutgoingPublishes
+
+
+MESSAGES = 2000
+WINDOWS = (1, 4, 16, 64)
+RTTS = (0.001, 0.020, 0.080, 0.300)
+
+
+def make_publish(n):
+    msg = Publish(qos=1)
+    msg.topic = 'site/42/telemetry'
+    msg.payload = n.to_bytes(4, 'big')
+    return msg
+
+
+def simulate(window, rtt):
+    queue = OutgoingQueue(InMemoryOutgoingPublishes(), window)
+    for n in range(MESSAGES):
+        queue.put_publish(make_publish(n))
+
+    clock = 0.0
+    acks = []
+    sent = 0
+
+    while sent < MESSAGES or acks:
+        packet = queue.get_nowait()
+        while packet is not None:
+            assert int.from_bytes(packet.payload, 'big') == sent, \
+                'publishes sent out of order'
+
+            queue.set_sent(packet.id)
+            heappush(acks, (clock + rtt, sent, packet.id))
+            sent += 1
+
+            packet = queue.get_nowait()
+
+        clock, _, packet_id = heappop(acks)
+        queue.flow_completed(packet_id)
+
+    return MESSAGES / clock
+
+
+def main():
+    print('msgs/s for %d QoS 1 publishes' % MESSAGES)
+    print('%10s' % 'rtt' + ''.join('%12s' % ('window %d' % w) for w in WINDOWS))
+
+    for rtt in RTTS:
+        rates = (simulate(window, rtt) for window in WINDOWS)
+        print('%8.0fms' % (rtt * 1000) + ''.join('%12.0f' % r for r in rates))
+
+
+if __name__ == '__main__':
+    main()
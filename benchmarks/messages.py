@@ -0,0 +1,73 @@
+"""
+Decodes and re-encodes a stream of Publish and Puback packets, the way the
+broker handles a routed QoS 1 publish (decode, copy with a new packet id,
+encode, acknowledge), and reports the throughput and the memory held by the
+message objects.
+
+Usage: python -m benchmarks.messages [packets]
+"""
+import sys
+import tracemalloc
+from time import perf_counter
+
+from broker.factory import MQTTMessageFactory
+from broker.messages import Publish, Puback
+
+
+PACKETS = 1000000
+RETAINED = 10000
+
+
+def make_frames():
+    publish = Publish(qos=1)
+    publish.topic = 'site/42/telemetry'
+    publish.payload = b'x' * 64
+    publish.id = 1
+
+    return publish.raw_data, Puback.from_id(1).raw_data
+
+
+def run(frames, packets):
+    publish_frame, puback_frame = frames
+
+    for i in range(packets // 2):
+        msg = MQTTMessageFactory.make(publish_frame)
+        copy = msg.copy()
+        copy.id = i % 65534 + 1
+        copy.raw_data
+
+        ack = MQTTMessageFactory.make(puback_frame)
+        ack.id = copy.id
+        ack.raw_data
+
+
+def measure_memory(frames):
+    publish_frame, puback_frame = frames
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    messages = [MQTTMessageFactory.make(publish_frame) for _ in range(RETAINED)]
+    messages.extend(MQTTMessageFactory.make(puback_frame)
+                    for _ in range(RETAINED))
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return allocated / len(messages)
+
+
+def main():
+    packets = int(sys.argv[1]) if len(sys.argv) > 1 else PACKETS
+    frames = make_frames()
+
+    start = perf_counter()
+    run(frames, packets)
+    elapsed = perf_counter() - start
+
+    print('%d packets decoded and re-encoded in %.2f s' % (packets, elapsed))
+    print('throughput: %.0f packets/s' % (packets / elapsed))
+    print('memory: %.0f bytes per decoded message' % measure_memory(frames))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Measures how the in-memory outgoing publishes store scales with the number
+of queued messages: the time of a publish flow (get_next, is_inflight,
+set_sent, is_sent, remove) while many messages are queued and a window of
+flows is in-flight, against the list based store used before.
+
+Usage: python -m benchmarks.outgoing_store
+"""
+from time import perf_counter
+
+from broker.messages import Publish
+from broker.persistence import PacketIdGenerator
+from broker.persistence.in_memory import InMemoryOutgoingPublishes
+
+
+QUEUED = (10, 1000, 100000, 1000000)
+INFLIGHT = 1000
+
+
+class ListOutgoingPublishes(InMemoryOutgoingPublishes):
+    # the list based store used before
+    def __init__(self):
+        self._queue = list()
+        self._inflight_ids = list()
+        self._inflight = dict()
+        self._ids_gen = PacketIdGenerator(self._inflight)
+
+    def get_next(self):
+        if len(self._queue) > 0:
+            msg = self._queue.pop(0).copy()
+            msg.id = self._ids_gen.next()
+            self._inflight_ids.append(msg.id)
+            self._inflight[msg.id] = {'id': msg.id, 'msg': msg}
+            return msg.copy()
+
+    @property
+    def inflight_len(self):
+        return len(self._inflight_ids)
+
+    def is_inflight(self, packet_id):
+        return packet_id in self._inflight_ids
+
+    def remove(self, packet_id):
+        if packet_id in self._inflight:
+            del self._inflight[packet_id]
+
+        if packet_id in self._inflight_ids:
+            self._inflight_ids.remove(packet_id)
+
+
+def make_publish():
+    msg = Publish(qos=1)
+    msg.topic = 'site/42/telemetry'
+    msg.payload = b'x' * 64
+    return msg
+
+
+def measure(store_class, queued):
+    store = store_class()
+
+    # the same publish may be queued for many sessions (and many times),
+    # the store copies it when a flow is started
+    msg = make_publish()
+    for _ in range(queued + 2 * INFLIGHT):
+        store.insert(msg)
+
+    inflight = [store.get_next().id for _ in range(INFLIGHT)]
+
+    start = perf_counter()
+    for packet_id in inflight:
+        assert store.is_inflight(packet_id)
+        store.set_sent(packet_id)
+        store.is_sent(packet_id)
+        store.remove(packet_id)
+
+        store.get_next()
+
+    return (perf_counter() - start) / INFLIGHT * 1e6
+
+
+def main():
+    print('us per flow, %d flows in-flight' % INFLIGHT)
+    print('%10s%12s%12s' % ('queued', 'list', 'deque'))
+
+    for queued in QUEUED:
+        print('%10d%12.1f%12.1f' % (queued,
+                                    measure(ListOutgoingPublishes, queued),
+                                    measure(InMemoryOutgoingPublishes, queued)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Measures routing messages to clients whose subscriptions overlap, each of
+them subscribed on ``site/#``, ``site/+/telemetry`` and
+``site/42/telemetry``: with a copy queued for each matching subscription,
+and with a single delivery per client.
+
+Usage: python -m benchmarks.overlapping_subscriptions [messages]
+"""
+import logging
+import sys
+from time import perf_counter
+
+from broker.messages import Publish
+from broker.routing import SubscriptionIndex
+from broker.server import MQTTServer
+
+
+CLIENTS = 100
+MESSAGES = 1000
+MASKS = ('site/#', 'site/+/telemetry', 'site/42/telemetry')
+
+
+def route(single_delivery, messages):
+    server = MQTTServer(
+        subscriptions=SubscriptionIndex(single_delivery=single_delivery))
+    clients = []
+
+    for n in range(CLIENTS):
+        client = server.recreate_client('client-%d' % n)
+        server.add_client(client)
+        client._connected.set()
+        for mask in MASKS:
+            client.subscribe(mask, 1)
+        clients.append(client)
+
+    msg = Publish(qos=1)
+    msg.topic = 'site/42/telemetry'
+    msg.payload = b'x' * 64
+
+    start = perf_counter()
+    for _ in range(messages):
+        server.broadcast_message(msg, 'sensor')
+    elapsed = perf_counter() - start
+
+    queued = sum(client.outgoing_queue.depth for client in clients)
+    return elapsed, queued
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else MESSAGES
+
+    # the clients log each publish
+    logging.disable(logging.ERROR)
+
+    print('%d messages, %d clients with %d overlapping subscriptions' % (
+        messages, CLIENTS, len(MASKS)))
+    print('%-22s%10s%12s' % ('', 'seconds', 'queued'))
+
+    for name, single_delivery in (('per subscription', False),
+                                  ('single delivery', True)):
+        print('%-22s%10.2f%12d' % ((name, ) + route(single_delivery,
+                                                    messages)))
+
+
+if __name__ == '__main__':
+    main()
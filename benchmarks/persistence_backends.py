@@ -0,0 +1,145 @@
+"""
+Compares the persistence backends on a client session with many queued
+QoS 1 publishes: queueing them, completing their flows (start, set sent,
+remove) and recovering the session on a restart.
+
+The changes are committed once per IOLoop iteration, ended each
+`PER_TICK` operations, and the time includes waiting for the last commit.
+The Redis backend is only measured if a server answers on localhost.
+
+Usage: python -m benchmarks.persistence_backends [messages]
+"""
+import os
+import sys
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from broker.messages import Publish
+from broker.persistence import InMemoryPersistence, RedisPersistence, \
+    SQLitePersistence, FileLogPersistence
+
+
+MESSAGES = 1000000
+PER_TICK = 100
+
+
+def make_publish():
+    msg = Publish(qos=1)
+    msg.topic = 'site/42/telemetry'
+    msg.payload = b'x' * 64
+    return msg
+
+
+@gen.coroutine
+def run_ticks(persistence, operation, messages):
+    for n in range(messages):
+        operation(n)
+        if n % PER_TICK == PER_TICK - 1:
+            # the IOLoop iteration ends, committing its changes
+            yield gen.Task(IOLoop.instance().add_callback)
+
+    synced = persistence.sync()
+    if synced is not None:
+        yield synced
+
+
+def enqueue(persistence, messages):
+    publishes = persistence.get_for_client('bob').outgoing_publishes
+    msg = make_publish()
+
+    def insert(n):
+        publishes.insert(msg)
+
+    IOLoop.instance().run_sync(
+        lambda: run_ticks(persistence, insert, messages))
+
+
+def complete_flows(persistence, messages):
+    publishes = persistence.get_for_client('bob').outgoing_publishes
+
+    def complete(n):
+        packet_id = publishes.get_next().id
+        publishes.set_sent(packet_id)
+        publishes.remove(packet_id)
+
+    IOLoop.instance().run_sync(
+        lambda: run_ticks(persistence, complete, messages))
+
+
+def recover(open_persistence):
+    persistence = open_persistence()
+    publishes = persistence.get_for_client('bob').outgoing_publishes
+    publishes.inflight_len
+
+    return persistence
+
+
+def measure(function, *args):
+    start = perf_counter()
+    result = function(*args)
+    return perf_counter() - start, result
+
+
+def run(name, open_persistence, close, messages):
+    persistence = open_persistence()
+
+    enqueued, _ = measure(enqueue, persistence, messages)
+    close(persistence)
+
+    if open_persistence is InMemoryPersistence:
+        recovered = None
+    else:
+        recovered, persistence = measure(recover, open_persistence)
+
+    # half of the queued flows are completed, the rest stays queued
+    completed, _ = measure(complete_flows, persistence, messages // 2)
+    close(persistence)
+
+    print('%-10s%12.2f%12.2f%12s' % (
+        name, enqueued, completed,
+        '%.2f' % recovered if recovered is not None else '-'))
+
+
+def redis_server():
+    try:
+        import redis
+        server = redis.StrictRedis()
+        server.ping()
+        return server
+    except Exception:
+        return None
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else MESSAGES
+
+    print('seconds for %d queued messages' % messages)
+    print('%-10s%12s%12s%12s' % ('', 'enqueue', 'complete', 'recover'))
+
+    run('memory', InMemoryPersistence, lambda p: None, messages)
+
+    with TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'broker.db')
+        run('sqlite', lambda: SQLitePersistence(path),
+            lambda p: p.statements.close(), messages)
+
+    with TemporaryDirectory() as directory:
+        run('file log', lambda: FileLogPersistence(directory),
+            lambda p: p.log.close(), messages)
+
+    server = redis_server()
+    if server is not None:
+        server.delete('bob:outgoing_queue', 'bob:outgoing_inflight',
+                      'bob:outgoing_ids', 'bob:outgoing_sent_ids',
+                      'bob:outgoing_conf_ids')
+        run('redis', lambda: RedisPersistence(server), lambda p: None,
+            messages)
+    else:
+        print('redis: no server on localhost, skipped')
+
+
+if __name__ == '__main__':
+    main()
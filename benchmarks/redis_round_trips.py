@@ -0,0 +1,168 @@
+"""
+Counts the Redis round trips per delivered QoS 1 message: the publish is
+queued, its flow is started, it's written (checking and setting the 'sent'
+flag) and acknowledged, as done by :class:`broker.client.OutgoingQueue`.
+
+Compares the store doing one command per round trip, as used before, to the
+current :class:`RedisOutgoingPublishes` and to the
+:class:`AsyncRedisOutgoingPublishes`, whose round trips are made off the
+IOLoop. The Redis server is the in-process fake of the tests.
+
+Also counts the round trips of reading a session's subscriptions, as done
+when routing, with the hash read on each access as before and with the
+:class:`RedisClientPersistence` cache.
+
+Usage: python -m benchmarks.redis_round_trips
+"""
+from broker.client import OutgoingQueue
+from broker.factory import MQTTMessageFactory
+from broker.messages import Publish
+from broker.persistence import RedisPersistence, AsyncRedisPersistence, PacketIdGenerator
+from broker.persistence.redis import RedisOutgoingPublishes
+from broker.persistence.redis_types import RedisHashDict, RedisIntList, RedisIntSet
+from tests.persistence import FakeRedis
+
+
+MESSAGES = 1000
+SUBSCRIPTIONS = 10
+
+
+class RedisPacketsDict(RedisHashDict):
+    def keys(self):
+        yield from (int(k) for k in super().keys())
+
+
+class CommandPerRoundTripOutgoingPublishes(RedisOutgoingPublishes):
+    # the store used before, issuing each command on its own
+    def __init__(self, redis, uid):
+        super().__init__(redis, uid)
+        self._inflight_ids = RedisIntList(redis, self._ids_key)
+        self._inflight = RedisPacketsDict(redis, self._inflight_key)
+        self._sent_ids = RedisIntSet(redis, self._sent_key)
+        self._confirmed_ids = RedisIntSet(redis, self._conf_key)
+        self._ids_gen = PacketIdGenerator(self._inflight)
+
+    def get_next(self):
+        if len(self._queue) > 0:
+            msg = MQTTMessageFactory.make(self._queue.pop())
+            msg.id = self._ids_gen.next()
+            self._inflight_ids.append(msg.id)
+            self._inflight[msg.id] = msg.raw_data
+            return msg
+
+    @property
+    def inflight_len(self):
+        return len(self._inflight)
+
+    def is_inflight(self, packet_id):
+        return packet_id in self._inflight
+
+    def set_sent(self, packet_id):
+        if packet_id in self._inflight:
+            self._sent_ids.add(packet_id)
+
+    def is_sent(self, packet_id):
+        if packet_id in self._inflight:
+            return packet_id in self._sent_ids
+
+    def remove(self, packet_id):
+        if packet_id in self._inflight:
+            self._inflight_ids.remove(packet_id)
+            self._sent_ids.remove(packet_id)
+            self._confirmed_ids.remove(packet_id)
+            del self._inflight[packet_id]
+            self._ids_gen.release(packet_id)
+
+
+def make_publish():
+    msg = Publish(qos=1)
+    msg.topic = 'site/42/telemetry'
+    msg.payload = b'x' * 64
+    return msg
+
+
+def deliver(queue):
+    msg = make_publish()
+    for _ in range(MESSAGES):
+        queue.put_publish(msg)
+
+    delivered = 0
+    packet = queue.get_nowait()
+    while packet is not None:
+        queue.is_sent(packet.id)
+        queue.set_sent(packet.id)
+        queue.flow_completed(packet.id)
+        delivered += 1
+
+        packet = queue.get_nowait()
+
+    assert delivered == MESSAGES
+
+
+def count_sync(store_class):
+    redis = FakeRedis()
+    queue = OutgoingQueue(store_class(redis, 'bob'))
+
+    deliver(queue)
+    return redis.round_trips / MESSAGES
+
+
+def count_async():
+    redis = FakeRedis()
+    persistence = AsyncRedisPersistence(redis)
+    queue = OutgoingQueue(persistence.get_for_client('bob').outgoing_publishes)
+
+    loaded = redis.round_trips
+    deliver(queue)
+    persistence.sync().result()
+
+    return (redis.round_trips - loaded) / MESSAGES
+
+
+def route(subscriptions):
+    # what routing a publish reads of each client's session
+    for mask in subscriptions.keys():
+        subscriptions[mask]
+
+
+def count_subscriptions_uncached():
+    redis = FakeRedis()
+    subscriptions = RedisHashDict(redis, 'bob:subscriptions')
+    for n in range(SUBSCRIPTIONS):
+        subscriptions['site/%d/#' % n] = 1
+
+    before = redis.round_trips
+    for _ in range(MESSAGES):
+        route(subscriptions)
+
+    return (redis.round_trips - before) / MESSAGES
+
+
+def count_subscriptions_cached():
+    redis = FakeRedis()
+    subscriptions = RedisPersistence(redis).get_for_client('bob').subscriptions
+    for n in range(SUBSCRIPTIONS):
+        subscriptions['site/%d/#' % n] = 1
+
+    before = redis.round_trips
+    for _ in range(MESSAGES):
+        route(subscriptions)
+
+    return (redis.round_trips - before) / MESSAGES
+
+
+def main():
+    print('round trips per delivered message')
+    print('%-24s%8.1f' % ('command per round trip',
+                          count_sync(CommandPerRoundTripOutgoingPublishes)))
+    print('%-24s%8.1f' % ('scripted / pipelined',
+                          count_sync(RedisOutgoingPublishes)))
+    print('%-24s%8.1f' % ('async (off the IOLoop)', count_async()))
+
+    print('round trips per routed publish, %d subscriptions' % SUBSCRIPTIONS)
+    print('%-24s%8.1f' % ('read on each access', count_subscriptions_uncached()))
+    print('%-24s%8.1f' % ('cached', count_subscriptions_cached()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Measures the memory held by the retained messages store, besides the
+persistence, after subscribers have matched every retained message once and
+then kept subscribing to a small set of hot topics: with the messages all
+kept in memory and with a memory budget.
+
+Usage: python -m benchmarks.retained_memory [retained]
+"""
+import sys
+import tracemalloc
+
+from broker.messages import Publish
+from broker.server import RetainedMessages
+
+
+RETAINED = 200000
+HOT_TOPICS = 1000
+BUDGETS = (None, 16 * 1024 * 1024, 1024 * 1024)
+
+
+def persist(count):
+    persisted = dict()
+    retained = RetainedMessages(persisted)
+
+    for n in range(count):
+        msg = Publish(qos=1, retain=True, id=1)
+        msg.topic = 'devices/%d/status' % n
+        msg.payload = b'x' * 256
+        retained.save(msg, 'device-%d' % n)
+
+    return persisted
+
+
+def subscribe(retained, count):
+    for _ in retained.match('devices/#'):
+        pass
+
+    # only the hot topics' subscriptions are counted
+    retained.hits = retained.misses = 0
+
+    for round_ in range(10):
+        for n in range(HOT_TOPICS):
+            topic = 'devices/%d/status' % (n * count // HOT_TOPICS)
+            for _ in retained.match(topic):
+                pass
+
+
+def measure(persisted, count, max_bytes):
+    tracemalloc.start()
+
+    retained = RetainedMessages(persisted, max_bytes)
+    subscribe(retained, count)
+
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stats = retained.stats()
+    hit_ratio = stats['hits'] / (stats['hits'] + stats['misses'])
+    return allocated / 1024 / 1024, hit_ratio, stats['evictions']
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else RETAINED
+    persisted = persist(count)
+
+    print('%d retained messages, %d hot topics' % (count, HOT_TOPICS))
+    print('%-12s%10s%10s%12s' % ('budget', 'MB', 'hot hits', 'evictions'))
+
+    for max_bytes in BUDGETS:
+        budget = 'unbounded' if max_bytes is None else \
+            '%d MB' % (max_bytes // 1024 // 1024)
+        print('%-12s%10.1f%10.2f%12d' % (
+            (budget, ) + measure(persisted, count, max_bytes)))
+
+
+if __name__ == '__main__':
+    main()
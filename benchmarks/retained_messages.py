@@ -0,0 +1,63 @@
+"""
+Measures matching the retained messages of a new subscription, with many
+retained device status topics: scanning and decoding every retained message
+as before, against walking the retained topic trie.
+
+Usage: python -m benchmarks.retained_messages [retained]
+"""
+import sys
+from timeit import timeit
+
+from broker.messages import Publish
+from broker.server import RetainedMessages
+from broker.util import TopicFilter
+
+
+RETAINED = 200000
+MASKS = ('devices/4242/status', 'devices/+/status', 'devices/#')
+
+
+def scan(persisted, mask):
+    # matches every retained message, as done before
+    topic_filter = TopicFilter(mask)
+    matched = []
+
+    for topic, (raw_data, sender_uid) in persisted.items():
+        msg = Publish.from_bytes(raw_data)
+        if topic_filter.match(msg.topic):
+            matched.append(msg.copy())
+
+    return matched
+
+
+def walk(retained, mask):
+    return [msg.copy() for msg, _ in retained.match(mask)]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else RETAINED
+
+    persisted = dict()
+    retained = RetainedMessages(persisted)
+    for n in range(count):
+        msg = Publish(qos=1, retain=True, id=1)
+        msg.topic = 'devices/%d/status' % n
+        msg.payload = b'online'
+        retained.save(msg, 'device-%d' % n)
+
+    print('ms per subscribe, %d retained messages' % count)
+    print('%-22s%12s%12s' % ('mask', 'scan', 'trie'))
+
+    for mask in MASKS:
+        assert len(scan(persisted, mask)) == len(walk(retained, mask))
+
+        rounds = 3
+        before = timeit(lambda: scan(persisted, mask), number=rounds)
+        after = timeit(lambda: walk(retained, mask), number=rounds)
+
+        print('%-22s%12.2f%12.2f' % (mask, before / rounds * 1000,
+                                     after / rounds * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Measures a fleet of clients subscribing on the same mask: the time to
+subscribe and match a topic once per client, and the memory allocated, with a
+filter built per client as before and with the filters shared through the
+:class:`SubscriptionIndex`.
+
+Usage: python -m benchmarks.shared_filters
+"""
+import tracemalloc
+from time import perf_counter
+
+from broker.client import ClientSubscriptions
+from broker.routing import SubscriptionIndex
+from broker.util import MQTTUtils
+
+
+CLIENTS = (1000, 10000, 100000)
+MASK = 'cmd/broadcast/#'
+TOPIC = 'cmd/broadcast/reboot'
+
+
+class PerClientSubscriptions(ClientSubscriptions):
+    # compiles a filter for each client, as done before
+    def __init__(self, subscriptions, uid=None, index=None):
+        super().__init__(subscriptions, uid, index)
+        self._filters = dict()
+
+    def add(self, mask, qos):
+        self._filters[mask] = MQTTUtils.compile_filter(mask)
+        super().add(mask, qos)
+
+    def __getitem__(self, mask):
+        return self.qos(mask), self._filters[mask]
+
+
+def subscribe_fleet(subscriptions_class, count):
+    index = SubscriptionIndex()
+    fleet = []
+
+    for n in range(count):
+        subscriptions = subscriptions_class(dict(), 'client-%d' % n, index)
+        subscriptions.add(MASK, 1)
+        assert subscriptions[MASK][1].match(TOPIC)
+        fleet.append(subscriptions)
+
+    return fleet
+
+
+def measure(subscriptions_class, count):
+    tracemalloc.start()
+    start = perf_counter()
+
+    fleet = subscribe_fleet(subscriptions_class, count)
+
+    elapsed = perf_counter() - start
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert len(fleet) == count
+    return elapsed, allocated / 1024 / 1024
+
+
+def main():
+    print('%10s%22s%22s' % ('clients', 'per client (s / MB)',
+                            'shared (s / MB)'))
+
+    for count in CLIENTS:
+        before = measure(PerClientSubscriptions, count)
+        after = measure(ClientSubscriptions, count)
+
+        print('%10d%14.2f /%6.1f%14.2f /%6.1f' % ((count,) + before + after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Measures routing messages to a pool of workers: with every worker
+subscribed on the same filter, each receiving (and dropping most of) every
+message as before, against the workers joined in a shared subscription
+group, each message being queued for a single worker.
+
+Usage: python -m benchmarks.shared_subscriptions [messages]
+"""
+import logging
+import sys
+from time import perf_counter
+
+from broker.messages import Publish
+from broker.server import MQTTServer
+
+
+WORKERS = 16
+MESSAGES = 10000
+
+
+def start_workers(mask):
+    server = MQTTServer()
+    workers = []
+
+    for n in range(WORKERS):
+        client = server.recreate_client('worker-%d' % n)
+        server.add_client(client)
+        client._connected.set()
+        client.subscribe(mask, 1)
+        workers.append(client)
+
+    return server, workers
+
+
+def route(mask, messages):
+    server, workers = start_workers(mask)
+
+    msg = Publish(qos=1)
+    msg.payload = b'x' * 64
+
+    start = perf_counter()
+    for n in range(messages):
+        msg.topic = 'ingest/%d' % (n % 100)
+        server.broadcast_message(msg, 'sensor')
+    elapsed = perf_counter() - start
+
+    queued = sum(worker.outgoing_queue.depth for worker in workers)
+    return elapsed, queued
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else MESSAGES
+
+    # the clients log each publish
+    logging.disable(logging.ERROR)
+
+    print('%d messages, %d workers' % (messages, WORKERS))
+    print('%-22s%10s%12s' % ('', 'seconds', 'queued'))
+
+    for name, mask in (('every worker', 'ingest/#'),
+                       ('shared group', '$share/workers/ingest/#')):
+        print('%-22s%10.2f%12d' % ((name, ) + route(mask, messages)))
+
+
+if __name__ == '__main__':
+    main()
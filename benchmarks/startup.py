@@ -0,0 +1,61 @@
+"""
+Measures the server startup with many persisted sessions, each with a
+subscription: the time and the memory allocated to recreate them, with the
+clients recreated up front as before and with the dormant sessions only
+having their subscriptions indexed.
+
+Usage: python -m benchmarks.startup
+"""
+import tracemalloc
+from time import perf_counter
+
+from broker.persistence import InMemoryPersistence
+from broker.server import MQTTServer
+
+
+SESSIONS = (1000, 10000, 100000)
+
+
+class EagerMQTTServer(MQTTServer):
+    # recreates every persisted client on startup, as done before
+    def recreate_sessions(self, uids):
+        for uid in uids:
+            if uid not in self.clients:
+                self.add_client(self.recreate_client(str(uid)))
+
+
+def persist_sessions(count):
+    persistence = InMemoryPersistence()
+    for n in range(count):
+        persistence.get_for_client('client-%d' % n) \
+            .subscriptions['site/%d/#' % n] = 1
+
+    return persistence
+
+
+def measure(server_class, persistence):
+    tracemalloc.start()
+    start = perf_counter()
+
+    server = server_class(persistence=persistence)
+
+    elapsed = perf_counter() - start
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert len(server.subscriptions) == len(persistence.get_client_uids())
+    return elapsed, allocated / 1024 / 1024
+
+
+def main():
+    print('%10s%22s%22s' % ('sessions', 'eager (s / MB)', 'lazy (s / MB)'))
+
+    for count in SESSIONS:
+        eager = measure(EagerMQTTServer, persist_sessions(count))
+        lazy = measure(MQTTServer, persist_sessions(count))
+
+        print('%10d%14.2f /%6.1f%14.2f /%6.1f' % ((count,) + eager + lazy))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Compares :class:`broker.util.TopicFilter` against the regular expressions
+built by :meth:`broker.util.MQTTUtils.convert_to_ereg`, for compiling the
+subscription masks, for matching a topic against a single mask and for
+matching a topic against all the masks of a client (the topic is split once).
+
+Usage: python -m benchmarks.topic_matching
+"""
+import re
+from timeit import timeit
+
+from broker.util import MQTTUtils
+
+
+DEPTH = 12
+ROUNDS = 20000
+
+topic = 'site/%s/telemetry' % '/'.join(['x'] * DEPTH)
+
+cases = (
+    ('exact', topic),
+    ('multi level', 'site/x/#'),
+    ('single level', '/'.join(['+'] * (DEPTH + 2))),
+    ('mixed', 'site/+/x/+/x/+/x/#'),
+)
+
+# a client subscribed on many wildcarded masks, most of them not matching
+fleet = ['site/%d/+/+/#' % i for i in range(25)] + \
+        ['+/%s/+' % '/'.join(['x'] * i) for i in range(25)] + \
+        ['site/+/%s/#' % '/'.join(['x'] * i) for i in range(25)] + \
+        ['%s/#' % '/'.join(['site'] + ['x'] * i) for i in range(25)]
+
+
+def per_call(seconds, rounds):
+    return seconds / rounds * 1e6
+
+
+def bench_compile(mask):
+    rounds = ROUNDS // 10
+    regex = timeit(lambda: re.compile(MQTTUtils.convert_to_ereg(mask)),
+                   number=rounds)
+    # re.compile caches recent patterns; purge it to measure a cold subscribe
+    cold_regex = timeit(lambda: (re.purge(),
+                                 re.compile(MQTTUtils.convert_to_ereg(mask))),
+                        number=rounds)
+    topic_filter = timeit(lambda: MQTTUtils.compile_filter(mask),
+                          number=rounds)
+    return (per_call(regex, rounds), per_call(cold_regex, rounds),
+            per_call(topic_filter, rounds))
+
+
+def bench_match(mask):
+    pattern = re.compile(MQTTUtils.convert_to_ereg(mask))
+    topic_filter = MQTTUtils.compile_filter(mask)
+    assert (pattern.match(topic) is not None) == topic_filter.match(topic)
+
+    regex = timeit(lambda: pattern.match(topic), number=ROUNDS)
+    matcher = timeit(lambda: topic_filter.match(topic), number=ROUNDS)
+    return per_call(regex, ROUNDS), per_call(matcher, ROUNDS)
+
+
+def bench_fleet():
+    patterns = [re.compile(MQTTUtils.convert_to_ereg(m)) for m in fleet]
+    filters = [MQTTUtils.compile_filter(m) for m in fleet]
+
+    def match_regex():
+        return [p for p in patterns if p.match(topic) is not None]
+
+    def match_filters():
+        levels = topic.split('/')
+        return [f for f in filters if f.match(topic, levels)]
+
+    assert len(match_regex()) == len(match_filters())
+
+    rounds = ROUNDS // 10
+    return (per_call(timeit(match_regex, number=rounds), rounds),
+            per_call(timeit(match_filters, number=rounds), rounds))
+
+
+def main():
+    print('topic: %s (%d levels)' % (topic, topic.count('/') + 1))
+    print()
+    print('%-14s %12s %12s %12s %8s' %
+          ('match', 'regex (us)', 'filter (us)', '', 'speedup'))
+    for name, mask in cases:
+        regex, matcher = bench_match(mask)
+        print('%-14s %12.3f %12.3f %12s %7.1fx' %
+              (name, regex, matcher, '', regex / matcher))
+
+    regex, matcher = bench_fleet()
+    print('%-14s %12.3f %12.3f %12s %7.1fx' %
+          ('%d masks' % len(fleet), regex, matcher, '', regex / matcher))
+
+    print()
+    print('%-14s %12s %12s %12s %8s' %
+          ('compile', 'regex (us)', 'cold (us)', 'filter (us)', 'speedup'))
+    for name, mask in cases:
+        regex, cold_regex, topic_filter = bench_compile(mask)
+        print('%-14s %12.3f %12.3f %12.3f %7.1fx' %
+              (name, regex, cold_regex, topic_filter,
+               cold_regex / topic_filter))
+
+
+if __name__ == '__main__':
+    main()
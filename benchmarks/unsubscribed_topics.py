@@ -0,0 +1,151 @@
+"""
+Measures publishing on telemetry topics without subscribers, while other
+topics have some: with every publish routed and recorded for the uplink as
+before (the uplink's published topics kept in a list, and in a set),
+against the negative lookup skipping their routing. Publishing on topics
+with subscribers, whose plans are cached, is also compared to checking
+every topic before its cached plan is looked up, as done before. Last, the
+publishes on subscribed topics are mixed with more on unsubscribed ones, to
+compare caching the latter with the plans, as done before, to caching them
+apart.
+
+Usage: python -m benchmarks.unsubscribed_topics [messages]
+"""
+import sys
+from time import perf_counter
+
+from broker.messages import Publish
+from broker.routing import SubscriptionIndex
+from broker.server import MQTTServer
+
+
+MESSAGES = 100000
+DEVICES = 10000
+
+
+class RoutingAllIndex(SubscriptionIndex):
+    # every publish is routed, as done before
+    def has_subscribers(self, topic):
+        return True
+
+
+class CheckedFirstIndex(SubscriptionIndex):
+    # every topic was checked before its cached plan was looked up
+    def route(self, topic):
+        if not self.has_subscribers(topic):
+            return (), ()
+        return self.resolve(topic), self.resolve_shared(topic)
+
+
+class SharedCacheIndex(SubscriptionIndex):
+    # the topics without subscribers had an empty plan cached with the others
+    def route(self, topic):
+        plan = self.plans.get(topic)
+
+        if plan is None:
+            if not self.has_subscribers(topic):
+                self.plans.put(topic, ())
+                return (), ()
+
+            return self._build_plan(topic), self.resolve_shared(topic)
+
+        return plan, self.resolve_shared(topic)
+
+
+class TopicList(list):
+    # the published topics were kept in a list, as done before
+    add = list.append
+
+
+def publish(index, published_topics, messages,
+            topic='telemetry/%d/temperature', devices=DEVICES):
+    server = MQTTServer(subscriptions=index)
+    server.hacked_topic_list = published_topics
+
+    for n in range(100):
+        server.subscriptions.add('dashboard-%d' % n, 'alerts/%d/#' % n, 1)
+
+    msg = Publish(qos=0)
+    msg.payload = b'x' * 64
+    topics = [topic % n for n in range(devices)]
+
+    start = perf_counter()
+    for n in range(messages):
+        msg.topic = topics[n % devices]
+        server.broadcast_message(msg, 'device')
+
+    return perf_counter() - start
+
+
+def publish_mixed(index, messages, subscribed=1000, ratio=4):
+    # each publish on a subscribed topic follows `ratio` on unsubscribed ones
+    server = MQTTServer(subscriptions=index)
+    server.hacked_topic_list = set()
+
+    for n in range(subscribed):
+        for m in range(10):
+            server.subscriptions.add('dashboard-%d' % m, 'alerts/%d/#' % n, 1)
+
+    msg = Publish(qos=0)
+    msg.payload = b'x' * 64
+
+    start = perf_counter()
+    for n in range(messages):
+        if n % (ratio + 1):
+            msg.topic = 'telemetry/%d/temperature' % n
+        else:
+            msg.topic = 'alerts/%d/fire' % (n // (ratio + 1) % subscribed)
+        server.broadcast_message(msg, 'device')
+
+    return perf_counter() - start
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else MESSAGES
+
+    # the bookkeeping of the uplink prints each new topic
+    stdout, sys.stdout = sys.stdout, open('/dev/null', 'w')
+    try:
+        before = publish(RoutingAllIndex(), TopicList(), messages)
+        routed = publish(RoutingAllIndex(), set(), messages)
+        unchecked = publish(CheckedFirstIndex(), set(), messages)
+        index = SubscriptionIndex()
+        after = publish(index, set(), messages)
+
+        # the plans of the alerts fit in the cache
+        alerts = ('alerts/%d/fire', 100)
+        checked = publish(CheckedFirstIndex(), set(), messages, *alerts)
+        cached = publish(SubscriptionIndex(), set(), messages, *alerts)
+
+        shared_index = SharedCacheIndex()
+        shared = publish_mixed(shared_index, messages)
+        apart_index = SubscriptionIndex()
+        apart = publish_mixed(apart_index, messages)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    print('%d publishes on %d topics without subscribers' % (messages,
+                                                              DEVICES))
+    print('%-22s%10s' % ('', 'us each'))
+    print('%-22s%10.2f' % ('routed, topic list', before / messages * 1e6))
+    print('%-22s%10.2f' % ('routed, topic set', routed / messages * 1e6))
+    print('%-22s%10.2f' % ('skipped, checked first',
+                           unchecked / messages * 1e6))
+    print('%-22s%10.2f' % ('skipped', after / messages * 1e6))
+    print('skipped ratio: %.2f' % index.stats()['skipped_ratio'])
+
+    print('%d publishes on 100 subscribed topics' % messages)
+    print('%-22s%10.2f' % ('checked first', checked / messages * 1e6))
+    print('%-22s%10.2f' % ('cached plan first', cached / messages * 1e6))
+
+    print('%d publishes, 1 in 5 on 1000 subscribed topics' % messages)
+    print('%-22s%10s%12s' % ('', 'us each', 'plan hits'))
+    print('%-22s%10.2f%12d' % ('cached with the plans', shared / messages * 1e6,
+                               shared_index.plans.hits))
+    print('%-22s%10.2f%12d' % ('cached apart', apart / messages * 1e6,
+                               apart_index.plans.hits))
+
+
+if __name__ == '__main__':
+    main()
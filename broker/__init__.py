@@ -5,6 +5,7 @@ class MQTTConstants:
 
     MESSAGE_TYPE_LENGTH = 1
     MESSAGE_FIXED_HEADER_MINIMUM_SIZE = 2
+    REMAINING_LENGTH_MAXIMUM_SIZE = 4
 
     PUBLISH_TIMEOUT = 10
     KEEPALIVE_FACTOR = 2
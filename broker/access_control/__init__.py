@@ -1,7 +1,6 @@
 from logging import getLogger
-import re
 from tornado import gen
-from broker.util import MQTTUtils
+from broker.util import MQTTUtils, TopicFilter
 
 
 class NoAuthentication():
@@ -44,8 +43,8 @@ class Authorization():
         """
         Validates an authorization entry
         :param ts: authorization entry: an asterisk string `"*"` meaning
-        fully authorized, or a list of (topic str, topic ereg)
-        :type ts: str | list[(str, ereg)]
+        fully authorized, or a list of (topic str, topic filter)
+        :type ts: str | list[(str, TopicFilter)]
         :return:
         """
 
@@ -53,9 +52,9 @@ class Authorization():
             pass
 
         elif isinstance(ts, list):
-            for t, ereg in ts:
+            for t, topic_filter in ts:
                 assert isinstance(t, str)
-                assert hasattr(ereg, 'match')
+                assert hasattr(topic_filter, 'match')
 
         else:
             raise ValueError('authorization has unexpected format')
@@ -64,8 +63,8 @@ class Authorization():
         if self.allowed_subscription_masks == Authorization.ALL:
             return True
 
-        for t, ereg in self.allowed_subscription_masks:
-            if ereg.match(topic):
+        for t, topic_filter in self.allowed_subscription_masks:
+            if topic_filter.match(topic):
                 return True
 
         return False
@@ -74,8 +73,8 @@ class Authorization():
         if self.allowed_publish_masks == Authorization.ALL:
             return True
 
-        for t, ereg in self.allowed_publish_masks:
-            if ereg.match(topic):
+        for t, topic_filter in self.allowed_publish_masks:
+            if topic_filter.match(topic):
                 return True
 
         return False
@@ -135,10 +134,10 @@ class Authorization():
             rs = []
             for t in ts:
                 assert isinstance(t, str)
-                ereg = MQTTUtils.convert_to_ereg(t,
+                topic_filter = MQTTUtils.compile_filter(t,
                         allow_wildcards=allow_wildcards)
-                assert isinstance(ereg, str)
-                rs.append((t, re.compile(ereg)))
+                assert isinstance(topic_filter, TopicFilter)
+                rs.append((t, topic_filter))
 
             return rs
 
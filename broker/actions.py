@@ -1,3 +1,5 @@
+from tornado import gen
+
 from broker import MQTTConstants
 from broker.messages import Pingresp, Puback, Suback, Unsuback, Pubrel, Pubrec, Pubcomp
 
@@ -30,7 +32,8 @@ class IncomingAction(Action):
     def run(self):
         """
         Overwrite to implement packet specific actions.
-        Is called after a packet is received
+        Is called after a packet is received. May return a Future, then the
+        client's following packets are only processed once it's resolved.
         """
         pass
 
@@ -46,13 +49,30 @@ class IncomingPublish(IncomingAction):
                 self._client.incoming_packet_ids.add(self.msg.id)
 
         if not is_dup:
-            self._client.dispatch_to_server(self.msg)
+            persisted = self._client.dispatch_to_server(self.msg)
+        else:
+            persisted = self._client.server.persistence.sync()
 
         if self.qos == MQTTConstants.AT_LEAST_ONCE:
-            self.write_to_client(Puback.from_publish(self.msg))
+            reply = Puback.from_publish(self.msg)
 
         elif self.qos is MQTTConstants.EXACTLY_ONCE:
-            self.write_to_client(Pubrec.from_publish(self.msg))
+            reply = Pubrec.from_publish(self.msg)
+
+        else:
+            return
+
+        # with an asynchronous persistence, the publish is only acknowledged
+        # after it's stored for the subscribers
+        if persisted is None:
+            self.write_to_client(reply)
+        else:
+            return self._reply_when_persisted(persisted, reply)
+
+    @gen.coroutine
+    def _reply_when_persisted(self, persisted, reply):
+        yield persisted
+        self.write_to_client(reply)
 
 
 class IncomingSubscribe(IncomingAction):
@@ -16,6 +16,7 @@ from broker.actions import IncomingAction, OutgoingAction
 from broker.concurency import CancelledException, DummyFuture
 
 from broker.persistence import InMemoryClientPersistence, OutgoingPublishesBase, PacketIdsDepletedError
+from broker.routing import SubscriptionIndex
 from broker.util import MQTTUtils
 from broker.factory import MQTTMessageFactory, MQTTMessageMakeError, IncomingActionFactory, TypeFactoryError, \
     OutgoingActionFactory
@@ -40,19 +41,23 @@ class MQTTClient():
     :param bool clean_session: The clean session flag, as per MQTT Protocol;
     :param int keep_alive: The keep alive interval, in seconds.
     :param ClientPersistenceBase persistence: An object that provides persistence
+    :param int max_inflight: How many QoS 1 and 2 publishes may be in-flight
+      at once.
     """
 
     broker_re = re.compile(r'^(broker|uplink)', re.IGNORECASE) # matched against 'uid'
 
     def __init__(self, server, connection, authorization=None,
                  uid=None, clean_session=False,
-                 keep_alive=60, persistence=None, receive_subscriptions=None):
+                 keep_alive=60, persistence=None, receive_subscriptions=None,
+                 max_inflight=1):
 
         self.uid = uid
         self.logger = getLogger('activity.clients')
         self.persistence = persistence or InMemoryClientPersistence(uid)
 
-        self.subscriptions = ClientSubscriptions(persistence.subscriptions)
+        self.subscriptions = ClientSubscriptions(self.persistence.subscriptions,
+                                                 uid, server.subscriptions)
 
         self._connected = Event()
 
@@ -66,7 +71,11 @@ class MQTTClient():
         self.authorization = authorization or Authorization.no_restrictions()
 
         # Queue of the packets ready to be delivered
-        self.outgoing_queue = OutgoingQueue(self.persistence.outgoing_publishes)
+        self.outgoing_queue = OutgoingQueue(self.persistence.outgoing_publishes,
+                                            max_inflight)
+
+        # how many bytes of ready packets may be coalesced in a single write
+        self.write_budget = server.write_budget
 
         self.update_configuration(clean_session, keep_alive, receive_subscriptions)
         self.update_connection(connection)
@@ -75,6 +84,19 @@ class MQTTClient():
     def incoming_packet_ids(self):
         return self.persistence.incoming_packet_ids
 
+    @property
+    def max_inflight(self):
+        """
+        How many QoS 1 and 2 publishes may be awaiting acknowledgement at
+        once, ie. the client's in-flight window.
+        """
+        return self.outgoing_queue.max_inflight
+
+    @max_inflight.setter
+    def max_inflight(self, value):
+        assert value > 0
+        self.outgoing_queue.max_inflight = value
+
     @property
     def redelivery_deadline(self):
         s = self.keep_alive if self.keep_alive > 0 else 60
@@ -204,8 +226,8 @@ class MQTTClient():
     @gen.coroutine
     def _process_incoming_packets(self, connection):
         """
-        This coroutinte fetches the message raw data from
-        :attr:`self.incoming_queue`, parses it into the corresponding message
+        This coroutinte fetches batches of message raw data from the
+        connection, parses each one into the corresponding message
         object (an instance of one of the
         :class:`broker.messages.BaseMQTTMessage` subclasses) and passes it to
         the :attr:`self.incoming_transaction_manager` to be processed.
@@ -214,20 +236,35 @@ class MQTTClient():
         disconnection.
         """
         while connection.is_readable:
+            msgs = ()
             with client_process_context(self, connection):
-                msg = yield connection.read_message()
+                msgs = yield connection.read_messages()
 
-                msg_obj = MQTTMessageFactory.make(msg)
-                self.logger.debug("[B << C] [uid: %s] %s" %
-                                  (self.uid, msg_obj.log_info()))
+            for msg in msgs:
+                # a failed packet disconnects the client, the rest of the
+                # batch is dropped along with the connection
+                if not connection.is_readable:
+                    break
 
-                action = self._get_action(msg_obj, IncomingActionFactory)
-                assert isinstance(action, IncomingAction)
-                action.run()
+                with client_process_context(self, connection):
+                    # actions waiting on persistence return a Future, the
+                    # next packets are processed once it is resolved
+                    pending = self._process_incoming_packet(msg)
+                    if pending is not None:
+                        yield pending
 
         self.logger.debug("[uid: %s] stopping _process_incoming_messages"
                           % self.uid)
 
+    def _process_incoming_packet(self, msg):
+        msg_obj = MQTTMessageFactory.make(msg)
+        self.logger.debug("[B << C] [uid: %s] %s" %
+                          (self.uid, msg_obj.log_info()))
+
+        action = self._get_action(msg_obj, IncomingActionFactory)
+        assert isinstance(action, IncomingAction)
+        return action.run()
+
     @gen.coroutine
     def _process_outgoing_packets(self, connection):
         """
@@ -246,16 +283,33 @@ class MQTTClient():
         while not connection.closed():
             with client_process_context(self, connection):
                 msg = yield self.outgoing_queue.get()
-                assert isinstance(msg, BaseMQTTMessage)
 
-                action = self._get_action(msg, OutgoingActionFactory)
-                assert isinstance(action, OutgoingAction)
+                # drains the packets already ready, up to the write budget,
+                # so they are all sent on a single write
+                actions, parts, size = list(), list(), 0
+                while msg is not None:
+                    assert isinstance(msg, BaseMQTTMessage)
 
-                self.logger.debug("[B >> C] [uid: %s] %s" %
-                                  (self.uid, msg.log_info()))
-                yield self.write(action.get_data())
+                    action = self._get_action(msg, OutgoingActionFactory)
+                    assert isinstance(action, OutgoingAction)
 
-                action.post_write()
+                    self.logger.debug("[B >> C] [uid: %s] %s" %
+                                      (self.uid, msg.log_info()))
+
+                    packet = action.get_data()
+                    packet_parts = packet.raw_parts()
+                    size += sum(len(part) for part in packet_parts)
+
+                    actions.append(action)
+                    parts.extend(packet_parts)
+
+                    msg = self.outgoing_queue.get_nowait() \
+                        if size < self.write_budget else None
+
+                yield self.write_parts(parts)
+
+                for action in actions:
+                    action.post_write()
 
         self.logger.debug("[uid: %s] stopping _process_outgoing_messages" % self.uid)
 
@@ -292,20 +346,35 @@ class MQTTClient():
         yield self.connected.wait()
         yield self.connection.write_message(msg)
 
+    @gen.coroutine
+    def write_parts(self, parts):
+        """
+        Writes the raw parts of one or more MQTT Messages to the client on a
+        single write. If the client isn't connected, waits for the
+        :attr:`self.connected` event to be set.
+
+        :param list parts: The `bytes` to be send, in order.
+        """
+        yield self.connected.wait()
+        yield self.connection.write_parts(parts)
+
     def dispatch_to_server(self, pub_msg):
         """
         Dispatches a Publish message to the server for further processing, ie.
         delivering it to the appropriate subscribers.
 
         :param Publish pub_msg: A :class:`broker.messages.Publish` instance.
+        :return: A Future resolved once the message is persisted, or None if
+          it already is.
         """
         assert isinstance(pub_msg, Publish)
 
         if self.authorization.is_publish_allowed(pub_msg.topic):
-            self.server.handle_incoming_publish(pub_msg, self.uid)
+            return self.server.handle_incoming_publish(pub_msg, self.uid)
         else:
             self.logger.warn("[uid: %s] is not allowed to publish on %s" %
                              (self.uid, pub_msg.topic))
+            return self.server.persistence.sync()
 
     def subscribe(self, subscription_mask, qos):
         """
@@ -317,6 +386,11 @@ class MQTTClient():
         client has already a subscription it will silently ignore the command
         and return a suback.
 
+        A ``$share/<group>/<filter>`` mask joins the client to a shared
+        subscription group: each message matching the filter is delivered to
+        a single member of the group. Retained messages are not sent for
+        shared subscriptions, and the authorization applies to the filter.
+
         :param string subscription_mask: A MQTT valid topic or wildcarded mask;
         :param int qos: A valid QoS level (0, 1 or 2).
         :rtype: int
@@ -330,17 +404,21 @@ class MQTTClient():
         new_subscription = subscription_mask not in self.subscriptions or \
             self.subscriptions.qos(subscription_mask) != qos
 
-        if not self.authorization.is_subscription_allowed(subscription_mask):
+        group, topic_filter = \
+            MQTTUtils.split_shared_subscription(subscription_mask)
+
+        if not self.authorization.is_subscription_allowed(topic_filter):
             self.logger.warn("[uid: %s] is not allowed to subscribe on %s" %
                              (self.uid, subscription_mask))
             del self.subscriptions[subscription_mask]
             qos = 0x80
 
         elif new_subscription:
-            ereg = MQTTUtils.convert_to_ereg(subscription_mask)
-            if ereg is not None:
-                self.subscriptions.add(subscription_mask, qos, re.compile(ereg))
-                self.server.enqueue_retained_message(self, subscription_mask)
+            if MQTTUtils.subscription_is_valid(subscription_mask):
+                self.subscriptions.add(subscription_mask, qos)
+                if group is None:
+                    self.server.enqueue_retained_message(self,
+                                                         subscription_mask)
 
             else:
                 qos = 0x80
@@ -360,7 +438,8 @@ class MQTTClient():
 
     def unsubscribe_denied_topics(self):
         for topic in self.subscriptions.masks:
-            if not self.authorization.is_subscription_allowed(topic):
+            _, topic_filter = MQTTUtils.split_shared_subscription(topic)
+            if not self.authorization.is_subscription_allowed(topic_filter):
                 self.unsubscribe(topic)
 
     def disconnect(self):
@@ -384,6 +463,8 @@ class MQTTClient():
         if self.clean_session:
             self.logger.debug("[uid: %s] cleaning session" % self.uid)
             self.server.remove_client(self)
+        else:
+            self.server.client_disconnected(self)
 
     def get_list_of_delivery_qos(self, msg):
         """
@@ -396,15 +477,20 @@ class MQTTClient():
         """
         # TODO CACHING THESE RESULTS PER CLIENT
         qos_list = []
+        levels = msg.topic.split('/')
         for mask in self.subscriptions.masks:
-            qos = self.get_matching_qos(msg, mask)
+            # shared subscriptions are delivered by the server to one member
+            if mask.startswith(MQTTUtils.SHARED_SUBSCRIPTION_PREFIX):
+                continue
+
+            qos = self.get_matching_qos(msg, mask, levels)
 
             if qos is not None:
                 qos_list.append(qos)
 
         return qos_list
 
-    def get_matching_qos(self, msg, subscriptions_mask):
+    def get_matching_qos(self, msg, subscriptions_mask, levels=None):
         """
         Matches the ``msg.topic`` against a single subscription defined by the
         subscription mask and returns the QoS level on which the message should
@@ -413,13 +499,14 @@ class MQTTClient():
         :param Publish msg: Message to be analysed;
         :param subscriptions_mask: A subscription mask that identifies one of
           the client's subscriptions.
+        :param list levels: The ``msg.topic`` levels, if already split.
         :return: QoS Level or None, in case it doesn't match.
         """
         assert isinstance(msg, Publish)
 
-        qos, pattern = self.subscriptions[subscriptions_mask]
+        qos, topic_filter = self.subscriptions[subscriptions_mask]
 
-        if pattern.match(msg.topic) is not None:
+        if topic_filter.match(msg.topic, levels):
             self.logger.debug("[uid: %s] %s matched by %s, MAXQOS: %d"
                               % (self.uid, msg.topic, subscriptions_mask, qos))
 
@@ -463,6 +550,44 @@ class MQTTClient():
         connection.set_timeout_callback(None)
 
 
+class DormantSession():
+    """
+    The slim record kept for a persistent session while its client is
+    disconnected, instead of a whole :class:`MQTTClient`. The publishes
+    routed to it are just queued on its persistence, to be sent once the
+    client reconnects and the session is promoted back to a
+    :class:`MQTTClient` (see :meth:`MQTTServer.wake_session`).
+
+    :param str uid: The client's uid;
+    :param ClientPersistenceBase persistence: The session's subscriptions and
+      queued publishes;
+    :param float last_seen: When the client disconnected, as a timestamp, or
+      None if it didn't since the server started.
+    """
+    __slots__ = ('uid', 'persistence', 'last_seen')
+
+    # a dormant session never sends publishes, for them to loop back
+    receive_subscriptions = False
+
+    def __init__(self, uid, persistence, last_seen=None):
+        self.uid = uid
+        self.persistence = persistence
+        self.last_seen = last_seen
+
+    def is_broker(self):
+        return not not MQTTClient.broker_re.match(self.uid)
+
+    def is_connected(self):
+        return False
+
+    def publish(self, msg):
+        """
+        Queues a publish, its flow is started once the client reconnects.
+        """
+        assert isinstance(msg, Publish)
+        self.persistence.outgoing_publishes.insert(msg)
+
+
 class client_process_context(ContextDecorator):
     def __init__(self, client, connection):
         assert isinstance(client, MQTTClient)
@@ -499,37 +624,36 @@ class client_process_context(ContextDecorator):
 
 class ClientSubscriptions():
     """
-    Encapsulates subscription persistence access and mask regex caching.
+    Encapsulates subscription persistence access. The subscriptions are
+    mirrored on the server's :class:`SubscriptionIndex`, which also holds the
+    mask filters shared by all the clients; the persisted ones are indexed on
+    the server startup, see :meth:`MQTTServer.recreate_sessions`.
     """
-    def __init__(self, subscriptions):
+    def __init__(self, subscriptions, uid=None, index=None):
         self._subscriptions = subscriptions
+        self._uid = uid
+        self._index = index if index is not None else SubscriptionIndex()
 
-        self._re_cache = dict()
+        # a dormant session's subscriptions are indexed already
+        indexed = self._index.masks(self._uid)
+        for mask, qos in self._subscriptions.items():
+            if indexed.get(mask) != qos:
+                self._index.add(self._uid, mask, qos)
 
-    def add(self, mask, qos, pattern=None):
-        self._re_cache[mask] = pattern or re.compile(MQTTUtils.convert_to_ereg(mask))
+    def add(self, mask, qos):
         self._subscriptions[mask] = qos
+        self._index.add(self._uid, mask, qos)
 
     def __contains__(self, item):
         return item in self._subscriptions
 
     def __getitem__(self, mask):
         assert self.__contains__(mask)
-        return self.qos(mask), self._get_regex(mask)
+        return self.qos(mask), self._index.filters.get(mask)
 
     def qos(self, mask):
         return self._subscriptions[mask]
 
-    def _get_regex(self, mask):
-        compiled = self._re_cache.get(mask, None)
-
-        if not compiled:
-            ereg = MQTTUtils.convert_to_ereg(mask)
-            compiled = re.compile(ereg)
-            self._re_cache[mask] = compiled
-
-        return compiled
-
     @property
     def masks(self):
         return self._subscriptions.keys()
@@ -537,8 +661,7 @@ class ClientSubscriptions():
     def __delitem__(self, mask):
         if mask in self._subscriptions:
             del self._subscriptions[mask]
-        if mask in self._re_cache:
-            del self._re_cache[mask]
+        self._index.remove(self._uid, mask)
 
 
 class OutgoingQueue():
@@ -546,8 +669,11 @@ class OutgoingQueue():
     This class controls packets to be delivered to the remote client.
     It encapsulates the logic to send packets and start new publish flows.
     """
-    def __init__(self, outgoing_publishes):
-        self.max_inflight = 1
+    def __init__(self, outgoing_publishes, max_inflight=1):
+        # how many QoS 1 and 2 publish flows may be in-flight at once. Flows
+        # are started in the queue order, thus the publishes are always sent
+        # for the first time in the order they were queued
+        self.max_inflight = max_inflight
 
         assert isinstance(outgoing_publishes, OutgoingPublishesBase)
         self.publishes = outgoing_publishes
@@ -557,6 +683,19 @@ class OutgoingQueue():
 
         self.future = DummyFuture()
 
+        # counters of :attr:`depth`
+        self._ready_publishes = 0
+        self._pending_flows = 0
+
+    @property
+    def depth(self):
+        """
+        Gets how many publishes put since the client connected are
+        outstanding: QoS 0 publishes not written yet, and QoS 1 and 2
+        publishes whose flow isn't completed.
+        """
+        return self._ready_publishes + self._pending_flows
+
     def retry_pending(self):
         for packet in self.publishes.get_all_inflight():
             self.retrial_handles[packet.id] = None
@@ -582,8 +721,11 @@ class OutgoingQueue():
         assert isinstance(packet, Publish)
 
         if packet.qos == 0:
+            if self.future.done():
+                self._ready_publishes += 1
             self.put(packet)
         else:
+            self._pending_flows += 1
             self.publishes.insert(packet)
             self._start_next_flow()
 
@@ -619,10 +761,29 @@ class OutgoingQueue():
         started = self._start_next_flow()
 
         if not started and self.packets:
-            self.future.set_result(self.packets.popleft())
+            self.future.set_result(self._pop_packet())
 
         return self.future
 
+    def get_nowait(self):
+        """
+        Gets the next packet to be sent to the remote client, if there is one
+        ready, without waiting for it.
+        :return: a packet or None
+        """
+        self._start_next_flow()
+
+        if self.packets:
+            return self._pop_packet()
+
+        return None
+
+    def _pop_packet(self):
+        packet = self.packets.popleft()
+        if packet.qos == 0 and isinstance(packet, Publish):
+            self._ready_publishes -= 1
+        return packet
+
     def clear(self):
         """
         Clears the in-memory state of the outgoing queue. The data in
@@ -635,6 +796,10 @@ class OutgoingQueue():
         self.packets.clear()
         self.retrial_handles.clear()
 
+        # the flows are left in the persistence, to be retried
+        self._ready_publishes = 0
+        self._pending_flows = 0
+
         if not self.future.done():
             msg = 'Outgoing queue was cleansed'
             self.future.set_exception(CancelledException(msg))
@@ -647,6 +812,8 @@ class OutgoingQueue():
         set and from persistence.
         """
         if packet_id:
+            if self.publishes.is_inflight(packet_id):
+                self._pending_flows = max(self._pending_flows - 1, 0)
             self.publishes.remove(packet_id)
         if packet_id in self.retrial_handles:
             self.cancel_retrial(packet_id)
@@ -655,14 +822,23 @@ class OutgoingQueue():
         self._start_next_flow()
 
     def _start_next_flow(self):
-        if self.publishes.inflight_len < self.max_inflight:
+        """
+        Starts as many publish flows as the in-flight window allows.
+
+        :return: True if any flow was started.
+        """
+        started = False
+
+        while self.publishes.inflight_len < self.max_inflight:
             packet = self.publishes.get_next()
-            if packet:
-                self.retrial_handles[packet.id] = None
-                self.put(packet)
-                return True
+            if not packet:
+                break
 
-        return False
+            self.retrial_handles[packet.id] = None
+            self.put(packet)
+            started = True
+
+        return started
 
     def _retry_flow(self, packet_id):
         if self.publishes.is_inflight(packet_id):
@@ -1,8 +1,10 @@
+from collections import deque
 from datetime import timedelta
 import logging
 
 from tornado import gen
 from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
 
 from broker import MQTTConstants
 
@@ -26,6 +28,11 @@ class MQTTConnection():
 
         self._read_async_result = None
 
+        # bytes read from the stream, not yet parsed, and parsed frames not
+        # yet handed to the reader
+        self._read_buffer = bytearray()
+        self._frames = deque()
+
         self._on_close_callback_fcn = None
         self._stream.set_close_callback(self._on_close_callback)
 
@@ -98,26 +105,126 @@ class MQTTConnection():
         return self._read_async_result.get(self._get_next_timeout())
 
     def read_data_available(self):
-        return self._stream._read_buffer_size > 0
+        return len(self._frames) > 0 or len(self._read_buffer) > 0 or \
+            self._stream._read_buffer_size > 0
 
     @gen.coroutine
     def read_message(self):
-        buffer = bytearray()
-        chunk = yield self.read_bytes_async(MQTTConstants.MESSAGE_FIXED_HEADER_MINIMUM_SIZE)
-        buffer.extend(chunk)
+        """
+        Reads a single frame. Frames received along with it are kept for the
+        next :meth:`read_message` or :meth:`read_messages` call.
+
+        :return: The raw frame (as a Future)
+        """
+        if not self._frames:
+            yield self._fill_frames()
+
+        return self._frames.popleft()
 
-        while not MQTTUtils.is_length_field_complete(buffer[MQTTConstants.MESSAGE_TYPE_LENGTH:]):
-            chunk = yield self.read_bytes_async(1)
-            buffer.extend(chunk)
+    @gen.coroutine
+    def read_messages(self):
+        """
+        Reads all the complete frames available. Everything the stream has
+        buffered is parsed at once, so the coroutine only waits on the stream
+        while there isn't a single complete frame.
 
-        msg_length, field_size = MQTTUtils.decode_length(buffer[MQTTConstants.MESSAGE_TYPE_LENGTH:])
+        :return: A list of raw frames (as a Future)
+        """
+        if not self._frames:
+            yield self._fill_frames()
 
-        if msg_length > 0:
-            chunk = yield self.read_bytes_async(msg_length)
-            buffer.extend(chunk)
+        frames = list(self._frames)
+        self._frames.clear()
+        return frames
+
+    @gen.coroutine
+    def _fill_frames(self):
+        while not self._parse_frames():
+            # reads everything the stream has buffered, but at least what is
+            # missing to complete the current frame
+            available = self._stream._read_buffer_size
+            chunk = yield self.read_bytes_async(max(self._missing_bytes(),
+                                                    available))
+            self._read_buffer += chunk
 
         self._update_timeout()
-        return bytes(buffer)
+
+    def _missing_bytes(self):
+        """
+        How many bytes are still missing to complete the first frame of the
+        read buffer, or to find out its length.
+        """
+        buffer = self._read_buffer
+        header_size = MQTTConstants.MESSAGE_FIXED_HEADER_MINIMUM_SIZE
+
+        if len(buffer) < header_size:
+            return header_size - len(buffer)
+
+        length_field = buffer[MQTTConstants.MESSAGE_TYPE_LENGTH:
+                              MQTTConstants.MESSAGE_TYPE_LENGTH +
+                              MQTTConstants.REMAINING_LENGTH_MAXIMUM_SIZE]
+        if not self._is_length_complete(length_field):
+            return 1
+
+        msg_length, field_size = MQTTUtils.decode_length(length_field)
+        frame_size = MQTTConstants.MESSAGE_TYPE_LENGTH + field_size + msg_length
+
+        return frame_size - len(buffer)
+
+    def _parse_frames(self):
+        """
+        Moves the complete frames of the read buffer to `self._frames`. A
+        remaining length field longer than 4 bytes is malformed: the stream
+        is closed and :class:`StreamClosedError` raised.
+
+        :return: The number of frames parsed.
+        """
+        buffer = self._read_buffer
+        view = memoryview(buffer)
+        cursor = 0
+        parsed = 0
+
+        try:
+            while len(buffer) - cursor >= MQTTConstants.MESSAGE_FIXED_HEADER_MINIMUM_SIZE:
+                start = cursor + MQTTConstants.MESSAGE_TYPE_LENGTH
+                length_field = buffer[start:start + MQTTConstants.REMAINING_LENGTH_MAXIMUM_SIZE]
+                if not self._is_length_complete(length_field):
+                    if len(length_field) == MQTTConstants.REMAINING_LENGTH_MAXIMUM_SIZE:
+                        self._close_malformed()
+                    break
+
+                msg_length, field_size = MQTTUtils.decode_length(length_field)
+                end = cursor + MQTTConstants.MESSAGE_TYPE_LENGTH + field_size + msg_length
+                if end > len(buffer):
+                    break
+
+                self._frames.append(bytes(view[cursor:end]))
+                cursor = end
+                parsed += 1
+
+        finally:
+            view.release()
+
+        if cursor:
+            del buffer[:cursor]
+
+        return parsed
+
+    def _close_malformed(self):
+        logger.warning('malformed remaining length from %s, closing the '
+                       'connection' % (self._address, ))
+
+        # the close callback disconnects the client, as when the peer closes
+        self._stream.close()
+        raise StreamClosedError('Malformed remaining length')
+
+    @staticmethod
+    def _is_length_complete(length_field):
+        for b in length_field:
+            if not b & 0x80:
+                return True
+
+        return False
 
     def _stop_reading(self):
         if self._read_async_result is not None and \
@@ -127,7 +234,17 @@ class MQTTConnection():
     @gen.coroutine
     def write_message(self, msg):
         assert isinstance(msg, BaseMQTTMessage)
-        yield gen.Task(self._stream.write, msg.raw_data)
+        yield gen.Task(self._stream.write, b''.join(msg.raw_parts()))
+
+    @gen.coroutine
+    def write_parts(self, parts):
+        """
+        Writes the raw parts of one or more messages. They are joined and
+        handed to the stream in a single write, thus a single send call.
+
+        :param list parts: The `bytes` to write, in order.
+        """
+        yield gen.Task(self._stream.write, b''.join(parts))
 
     def _remove_timeout(self):
         if self._timeout_callback is not None:
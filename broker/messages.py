@@ -1,11 +1,25 @@
-import copy
 from itertools import chain
+from operator import attrgetter
 from broker import MQTTConstants
 
 from broker.util import MQTTUtils
 
 
 class BaseMQTTMessage():
+    """
+    Messages are slotted objects. Their fields are plain attributes and the
+    raw data is kept in sync through an explicit snapshot: when encoded, the
+    values of the fields are recorded, and the message is encoded again only
+    if they have changed by the time :attr:`raw_data` is looked up. Fields
+    mutated in place (ie, appending to a list) must be reassigned or the
+    message marked with ``_pending_update = True``.
+
+    Subclasses declare the slots for their own fields; the slots and the
+    snapshot getter are collected by :meth:`__init_subclass__`.
+    """
+    __slots__ = ('type', 'dup', 'qos', 'retain', 'length',
+                 '_raw_data', '_encoded_state')
+
     _message_type = 0x00
     _fixed_header = ('type', 'dup', 'qos', 'retain', 'length')
     _message_fields = tuple()
@@ -15,15 +29,44 @@ class BaseMQTTMessage():
         'retain': False,
     }
 
+    # attributes holding the fields' values, when they differ from the
+    # field name (ie, a field exposed by a property)
+    _state_attributes = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._build_accessors()
+
+    @classmethod
+    def _build_accessors(cls):
+        slots = []
+        for klass in reversed(cls.__mro__):
+            for name in klass.__dict__.get('__slots__', ()):
+                if name not in slots:
+                    slots.append(name)
+
+        fields = chain(cls._fixed_header, cls._message_fields)
+        cls._slot_names = tuple(slots)
+        cls._initial_values = tuple(
+            (name, cls._default_values.get(name, None)) for name in slots)
+        cls._slot_values = attrgetter(*slots)
+        cls._state = attrgetter(*(cls._state_attributes.get(f, f)
+                                  for f in fields))
+
     @classmethod
     def from_bytes(cls, bytes_):
+        """
+        Decodes a message from its raw data. The data is read through a
+        `memoryview`, so the fields are decoded without slicing copies of
+        the frame.
+        """
         assert type(bytes_) == bytes
         obj = cls()
 
-        _raw_data = bytes(bytes_)
+        _raw_data = bytes_
 
         obj.type, obj.dup, obj.qos, obj.retain, obj.length, remaining_data \
-            = MQTTUtils.strip_fixed_header(_raw_data)
+            = MQTTUtils.strip_fixed_header(memoryview(_raw_data))
 
         assert obj.type == obj._message_type
         obj._decode_data(remaining_data)
@@ -39,17 +82,23 @@ class BaseMQTTMessage():
         self._initialize_fields()
 
         for k, v in kwargs.items():
-            self.__setattr__(k, v)
-
-    def __setattr__(self, key, value):
-        if key in self._fixed_header or key in self._message_fields:
-            self._pending_update = True
-
-        return super().__setattr__(key, value)
+            setattr(self, k, v)
 
     def __hash__(self):
         return MQTTUtils.hash_message_bytes(self.raw_data)
 
+    @property
+    def _pending_update(self):
+        """
+        Whether the fields have changed since the raw data was last encoded.
+        """
+        state = self._encoded_state
+        return state is None or state != self._state(self)
+
+    @_pending_update.setter
+    def _pending_update(self, value):
+        self._encoded_state = None if value else self._state(self)
+
     def log_info(self):
         return "[%s]%s" % (
             self.__class__.__name__,
@@ -60,18 +109,16 @@ class BaseMQTTMessage():
         return ''
 
     def _encode_fixed_header(self, data):
-        buffer = bytearray(1)
-        buffer[0] |= self.type << 4
-        buffer[0] |= (self.dup or 0) << 3
-        buffer[0] |= (self.qos or 0) << 1
-        buffer[0] |= self.retain or 0
-        
-        if not data:
-            buffer.extend(MQTTUtils.encode_length(0))
-        else:
-            buffer.extend(MQTTUtils.encode_length(len(data)))
+        return self._encode_header(len(data) if data else 0)
+
+    def _encode_header(self, length):
+        first = self.type << 4 | (self.dup or 0) << 3 | \
+            (self.qos or 0) << 1 | (self.retain or 0)
 
-        return bytearray(buffer)
+        if length < 0x80:
+            return bytes((first, length))
+
+        return bytes((first, )) + MQTTUtils.encode_length(length)
 
     def _encode_data(self):
         return bytes()
@@ -80,14 +127,13 @@ class BaseMQTTMessage():
         pass
 
     def _initialize_fields(self):
-        for item in chain(self._fixed_header, self._message_fields):
-            value = self._default_values.get(item, None)
-            self.__setattr__(item, value)
+        for name, value in self._initial_values:
+            setattr(self, name, value)
 
         self.type = self._message_type
 
         self._raw_data = bytes()
-        self._pending_update = True
+        self._encoded_state = None
 
     def _update_raw_data(self):
         data = self._encode_data()
@@ -105,16 +151,42 @@ class BaseMQTTMessage():
     def raw_data(self):
         if self._pending_update:
             self._update_raw_data()
+            self._pending_update = False
 
         return self._raw_data
 
+    def raw_parts(self):
+        """
+        The raw data split in parts that should be written in sequence. Some
+        messages override it to avoid encoding the whole message again when
+        only its header has changed.
+
+        :rtype: tuple
+        """
+        return self.raw_data,
+
     def copy(self):
-        c = copy.copy(self)
-        c._pending_update = True
+        cls = self.__class__
+        c = cls.__new__(cls)
+
+        for name, value in zip(self._slot_names, self._slot_values(self)):
+            setattr(c, name, value)
+
+        c._encoded_state = None
         return c
 
 
+BaseMQTTMessage._build_accessors()
+
+
 class Connect(BaseMQTTMessage):
+    __slots__ = (
+        'protocol_name', 'protocol_version',
+        'has_username', 'username',
+        'has_passwd', 'password', 'passwd',
+        'will_retain', 'will_topic', 'will_qos', 'will_flag', 'will_message',
+        'clean_session', 'keep_alive', 'client_uid'
+    )
     _message_type = 0x01
     _message_fields = (
         'protocol_name', 'protocol_version',
@@ -216,6 +288,7 @@ class Connect(BaseMQTTMessage):
 
 
 class Connack(BaseMQTTMessage):
+    __slots__ = ('session_present', 'return_code')
     _message_type = 0x02
     _message_fields = ('session_present', 'return_code')
     _return_codes = {
@@ -261,6 +334,7 @@ class Connack(BaseMQTTMessage):
 
 
 class Disconnect(BaseMQTTMessage):
+    __slots__ = ()
     _message_type = 0x0E
 
     @classmethod
@@ -270,12 +344,96 @@ class Disconnect(BaseMQTTMessage):
 
 
 class Publish(BaseMQTTMessage):
+    """
+    The encoded topic is cached and shared with the message copies, so a
+    message fanned out to many subscribers only has its header and packet id
+    encoded for each of them, see :meth:`raw_parts`.
+
+    Decoded messages keep their topic and payload undecoded, in a
+    :class:`_PublishBody` shared with their copies, until they are first
+    accessed. The broker never inspects the payloads it routes, thus they
+    are written as a view on the received frame, and only copied to `bytes`
+    when read through :attr:`payload`.
+    """
+    __slots__ = ('id', '_topic', '_payload', '_body', '_encoded_topic')
     _message_type = 0x03
     _message_fields = ('topic', 'id', 'payload')
+    _state_attributes = {'topic': '_topic', 'payload': '_payload'}
+
+    # the getters leave the undecoded fields as they are: the body caches
+    # the decoded values, and the snapshot of the message stays unchanged,
+    # so reading a field doesn't mark the message for encoding
+
+    @property
+    def topic(self):
+        topic = self._topic
+        if topic is _UNDECODED:
+            return self._body.topic
+        return topic
+
+    @topic.setter
+    def topic(self, value):
+        self._topic = value
+
+    @property
+    def payload(self):
+        payload = self._payload
+        if payload is _UNDECODED:
+            return self._body.payload
+        return payload
+
+    @payload.setter
+    def payload(self, value):
+        self._payload = value
+
+    @property
+    def payload_length(self):
+        if self._payload is _UNDECODED:
+            return self._body.payload_length
+        return len(self._payload)
+
+    def _get_payload_part(self):
+        if self._payload is _UNDECODED:
+            return self._body.payload_view
+        return self._payload
+
+    def _get_encoded_topic(self):
+        if self._topic is _UNDECODED or \
+                (self._body is not None and self._topic is self._body._topic):
+            return self._body.encoded_topic
+
+        cached = self._encoded_topic
+
+        if cached is None or cached[0] is not self.topic:
+            cached = (self.topic, bytes(MQTTUtils.encode_string(self.topic)))
+            self._encoded_topic = cached
+
+        return cached[1]
+
+    def raw_parts(self):
+        if not self._pending_update:
+            return self._raw_data,
+
+        topic = self._get_encoded_topic()
+        length = len(topic) + self.payload_length
+
+        # the parts are joined before being written, thus the payload can be
+        # a view on the received frame
+        payload = self._get_payload_part()
+
+        if self.qos in [MQTTConstants.AT_LEAST_ONCE, MQTTConstants.EXACTLY_ONCE]:
+            packet_id = self.id.to_bytes(2, 'big')
+            length += 2
+            return self._encode_header(length), topic, packet_id, payload
+
+        return self._encode_header(length), topic, payload
+
+    def _update_raw_data(self):
+        self._raw_data = b''.join(self.raw_parts())
 
     def _decode_data(self, _data):
-        self.topic, l = MQTTUtils.decode_string(_data)
-        cursor = l + 2
+        topic_end = 2 + MQTTUtils.decode_value(_data[0:2])
+        cursor = topic_end
 
         if self.qos > MQTTConstants.AT_MOST_ONCE:
             self.id = MQTTUtils.decode_value(_data[cursor:cursor + 2])
@@ -283,16 +441,21 @@ class Publish(BaseMQTTMessage):
         else:
             self.id = None
 
-        self.payload = _data[cursor:]
+        # the body refers to the whole frame, which `_data` is a view on
+        offset = len(_data.obj) - len(_data)
+        self._body = _PublishBody(_data.obj, offset, offset + topic_end,
+                                  offset + cursor)
+        self.topic = _UNDECODED
+        self.payload = _UNDECODED
 
     def _encode_data(self):
         buffer = bytearray()
-        buffer.extend(MQTTUtils.encode_string(self.topic))
+        buffer.extend(self._get_encoded_topic())
 
         if self.qos in [MQTTConstants.AT_LEAST_ONCE, MQTTConstants.EXACTLY_ONCE]:
             buffer.extend(MQTTUtils.encode_value(self.id))
 
-        buffer.extend(self.payload)
+        buffer.extend(self._get_payload_part())
 
         return bytes(buffer)
 
@@ -300,11 +463,67 @@ class Publish(BaseMQTTMessage):
         return ' DUP: %d, QOS: %d, RET: %d, ID: %#05d, LEN: %d' % (
             self.dup, self.qos, self.retain,
             self.id or 0,
-            len(self.payload),
+            self.payload_length,
         )
 
 
+_UNDECODED = object()
+
+
+class _PublishBody():
+    """
+    The topic and payload of a decoded :class:`Publish`, decoded from the
+    received frame on first access and shared by all the copies of the
+    message. The payload is written as a view on the frame, see
+    :attr:`payload_view`.
+    """
+    __slots__ = ('_frame', '_topic_start', '_topic_end', '_payload_start',
+                 '_topic', '_payload', '_payload_view', '_encoded_topic')
+
+    def __init__(self, frame, topic_start, topic_end, payload_start):
+        self._frame = frame
+        self._topic_start = topic_start
+        self._topic_end = topic_end
+        self._payload_start = payload_start
+
+        self._topic = None
+        self._payload = None
+        self._payload_view = None
+        self._encoded_topic = None
+
+    @property
+    def topic(self):
+        if self._topic is None:
+            view = memoryview(self._frame)[self._topic_start + 2:self._topic_end]
+            self._topic = str(view, encoding="UTF-8")
+        return self._topic
+
+    @property
+    def encoded_topic(self):
+        if self._encoded_topic is None:
+            self._encoded_topic = self._frame[self._topic_start:self._topic_end]
+        return self._encoded_topic
+
+    @property
+    def payload(self):
+        if self._payload is None:
+            self._payload = bytes(self.payload_view)
+        return self._payload
+
+    @property
+    def payload_view(self):
+        # the frame is `bytes`, so the view never has to be released
+        if self._payload_view is None:
+            self._payload_view = memoryview(self._frame)[self._payload_start:]
+        return self._payload_view
+
+    @property
+    def payload_length(self):
+        return len(self._frame) - self._payload_start
+
+
 class Subscribe(BaseMQTTMessage):
+    __slots__ = ('id', 'subscription_intents')
     _message_type = 0x08
     _message_fields = ('id', 'subscription_intents')
 
@@ -349,6 +568,7 @@ class Subscribe(BaseMQTTMessage):
 
 
 class Suback(BaseMQTTMessage):
+    __slots__ = ('id', 'payload')
     _message_type = 0x09
     _message_fields = ('id', 'payload')
 
@@ -365,7 +585,7 @@ class Suback(BaseMQTTMessage):
         self.id = MQTTUtils.decode_value(_data[cursor:cursor + 2])
         cursor += 2
 
-        self.payload = _data[cursor:]
+        self.payload = bytes(_data[cursor:])
 
     def _encode_data(self):
         buffer = bytearray()
@@ -391,6 +611,7 @@ class Suback(BaseMQTTMessage):
 
 
 class Unsubscribe(BaseMQTTMessage):
+    __slots__ = ('id', 'unsubscribe_list')
     _message_type = 0x0A
     _message_fields = ('id', 'unsubscribe_list')
 
@@ -427,6 +648,7 @@ class Unsubscribe(BaseMQTTMessage):
 
 
 class Unsuback(BaseMQTTMessage):
+    __slots__ = ('id', )
     _message_type = 0x0B
     _message_fields = ('id',)
 
@@ -446,6 +668,7 @@ class Unsuback(BaseMQTTMessage):
 
 
 class Pingreq(BaseMQTTMessage):
+    __slots__ = ()
     _message_type = 0x0C
 
     @classmethod
@@ -454,6 +677,7 @@ class Pingreq(BaseMQTTMessage):
 
 
 class Pingresp(BaseMQTTMessage):
+    __slots__ = ()
     _message_type = 0x0D
 
     @classmethod
@@ -463,6 +687,7 @@ class Pingresp(BaseMQTTMessage):
 
 
 class Puback(BaseMQTTMessage):
+    __slots__ = ('id', )
     _message_type = 0x04
     _message_fields = ('id', )
 
@@ -487,10 +712,12 @@ class Puback(BaseMQTTMessage):
 
 
 class Pubrec(Puback):
+    __slots__ = ()
     _message_type = 0x05
 
 
 class Pubrel(Puback):
+    __slots__ = ()
     _message_type = 0x06
 
     _default_values = {
@@ -507,6 +734,7 @@ class Pubrel(Puback):
 
 
 class Pubcomp(Puback):
+    __slots__ = ()
     _message_type = 0x07
 
     @classmethod
@@ -1,4 +1,4 @@
-from itertools import cycle
+import re
 
 
 class PersistenceBase():
@@ -28,12 +28,72 @@ class PersistenceBase():
         """
         return ClientPersistenceBase(uid)
 
+    def get_subscriptions(self, uids):
+        """
+        Retrieves the persisted subscriptions of the clients `uids`, to be
+        indexed without accessing the whole sessions.
+        :return: an iterable of (uid, mask, qos)
+        """
+        for uid in uids:
+            for mask, qos in self.get_for_client(uid).subscriptions.items():
+                yield uid, mask, qos
+
     def remove_client_data(self, uid):
         """
         Permanently removes client persistence data
         """
         pass
 
+    def write_many(self, writes):
+        """
+        Applies the changes of many stores of this persistence together, as
+        flushed by :class:`WriteBehindPersistence`. Each write is a (store,
+        added, removed) triple, for a store being:
+
+        - a dict: the dict of the items set, and the keys deleted;
+        - a set: the values added, and the values removed;
+        - outgoing publishes: the packet ids set sent, and set confirmed.
+
+        The changes are applied one by one; the Redis persistences send them
+        all in a single round trip.
+        """
+        for store, added, removed in writes:
+            if isinstance(store, OutgoingPublishesBase):
+                for packet_id in added:
+                    store.set_sent(packet_id)
+                for packet_id in removed:
+                    store.set_pubconf(packet_id)
+
+            elif isinstance(added, dict):
+                for key, value in added.items():
+                    store[key] = value
+                for key in removed:
+                    if key in store:
+                        del store[key]
+
+            else:
+                for value in added:
+                    store.add(value)
+                for value in removed:
+                    store.discard(value)
+
+    def sync(self):
+        """
+        Gets a Future resolved once all the changes made so far are
+        persisted, or None if the changes are persisted as they are made.
+        """
+        return None
+
+    def flush(self):
+        """
+        Persists all the changes made so far and releases the backend, on the
+        broker shutdown: the persistence isn't used afterwards.
+
+        :return: A Future resolved once the changes are persisted, or None
+          if they already are.
+        """
+        return self.sync()
+
 
 class ClientPersistenceBase():
     def __init__(self, uid):
@@ -174,19 +234,128 @@ class OutgoingPublishesBase():
 class PacketIdGenerator():
     """
     Cycles through the allowed range of packet_ids, skipping the ids in use.
+
+    The ids in use are kept in a bitmap, loaded from the keys of `reserved`
+    (the store's in-flight structure) on the first allocation, so the store
+    isn't queried for each candidate id. Thereafter the store must call
+    :meth:`release` whenever an id is freed, or :meth:`reset` when its
+    in-flight structure is cleared.
     """
+    _MAX_ID = 65534
+    _non_full_byte = re.compile(b'[^\xff]')
+
     def __init__(self, reserved):
-        self._ids = cycle(range(1, 65535))
-        self._max_ids = 65534
         self._reserved = reserved
+        self._bitmap = None
+        self._count = 0
+        self._cursor = 1
 
     def next(self):
-        if len(self._reserved) >= self._max_ids:
+        if self._bitmap is None:
+            self._load()
+
+        if self._count >= self._MAX_ID:
             raise PacketIdsDepletedError()
 
-        for packet_id in self._ids:
-            if packet_id not in self._reserved:
-                return packet_id
+        packet_id = self._find_free(self._cursor)
+        if packet_id is None:
+            packet_id = self._find_free(1)
+
+        self._bitmap[packet_id >> 3] |= 1 << (packet_id & 7)
+        self._count += 1
+        self._cursor = packet_id + 1
+
+        return packet_id
+
+    def __contains__(self, packet_id):
+        """
+        Checks whether `packet_id` is in use, without querying the store once
+        the ids in use are loaded.
+        """
+        if self._bitmap is None:
+            self._load()
+
+        return 0 < packet_id <= self._MAX_ID and \
+            bool(self._bitmap[packet_id >> 3] & (1 << (packet_id & 7)))
+
+    def __len__(self):
+        """
+        Gets the count of ids in use.
+        """
+        if self._bitmap is None:
+            self._load()
+
+        return self._count
+
+    def release(self, packet_id):
+        """
+        Frees `packet_id` to be allocated again.
+        """
+        if self._bitmap is None:
+            return
+
+        mask = 1 << (packet_id & 7)
+        if self._bitmap[packet_id >> 3] & mask:
+            self._bitmap[packet_id >> 3] &= ~mask
+            self._count -= 1
+
+    def reset(self):
+        """
+        Discards the ids in use, they are loaded again from `reserved` on the
+        next allocation.
+        """
+        self._bitmap = None
+        self._count = 0
+
+    def _load(self):
+        bitmap = bytearray((self._MAX_ID + 2) // 8)
+
+        # 0 and 65535 are never allocated
+        bitmap[0] |= 1
+        bitmap[-1] |= 0x80
+
+        count = 0
+        for packet_id in self._reserved.keys():
+            bitmap[packet_id >> 3] |= 1 << (packet_id & 7)
+            count += 1
+
+        self._bitmap = bitmap
+        self._count = count
+
+    def _find_free(self, start):
+        bitmap = self._bitmap
+        index = start >> 3
+
+        if index >= len(bitmap):
+            return None
+
+        b = bitmap[index] >> (start & 7)
+        if b != 0xff >> (start & 7):
+            # the lowest zero bit from `start` on, in the same byte
+            return start + ((~b & (b + 1)).bit_length() - 1)
+
+        match = self._non_full_byte.search(bitmap, index + 1)
+        if match is None:
+            return None
+
+        index = match.start()
+        b = bitmap[index]
+        return (index << 3) + ((~b & (b + 1)).bit_length() - 1)
+
+
+def get_many(store, keys):
+    """
+    Reads the values of `keys` from the dict-like `store`, through its
+    `get_many` method if it has one, as the Redis stores do to read them in
+    a single round trip.
+
+    :return: A list of the values, None for the missing keys.
+    """
+    get = getattr(store, 'get_many', None)
+    if get is not None:
+        return get(keys)
+
+    return [store.get(key) for key in keys]
 
 
 class PacketIdsDepletedError(MemoryError):
@@ -197,3 +366,7 @@ class PacketIdsDepletedError(MemoryError):
 
 from .in_memory import InMemoryPersistence, InMemoryClientPersistence
 from .redis import RedisPersistence
+from .async_redis import AsyncRedisPersistence
+from .write_behind import WriteBehindPersistence
+from .file_log import FileLogPersistence
+from .sqlite import SQLitePersistence
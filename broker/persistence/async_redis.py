@@ -0,0 +1,573 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from broker.factory import MQTTMessageFactory
+from broker.persistence import PersistenceBase, ClientPersistenceBase
+from broker.persistence.in_memory import InMemoryOutgoingPublishes
+
+
+logger = logging.getLogger('persistence.async_redis')
+
+
+class RedisCommandQueue():
+    """
+    Runs Redis commands on a dedicated thread, in the order they were queued,
+    so a Redis round trip never blocks the IOLoop. Each command returns a
+    `concurrent.futures.Future`, which Tornado coroutines may yield.
+
+    :param redis: A `StrictRedis` instance, or any object providing the same
+      commands (ie. an in-process fake, for testing).
+    """
+    def __init__(self, redis):
+        self.redis = redis
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def execute(self, command, *args):
+        future = self._executor.submit(getattr(self.redis, command), *args)
+        future.add_done_callback(self._log_failure)
+        return future
+
+    def execute_pipeline(self, *commands):
+        """
+        Runs several commands, as (command, arg, ...) tuples, atomically and
+        in a single round trip.
+        """
+        future = self._executor.submit(self._run_pipeline, commands)
+        future.add_done_callback(self._log_failure)
+        return future
+
+    def _run_pipeline(self, commands):
+        pipe = self.redis.pipeline()
+        for command in commands:
+            getattr(pipe, command[0])(*command[1:])
+
+        return pipe.execute()
+
+    def sync(self):
+        """
+        :return: A Future resolved once all the commands queued so far have
+          been run.
+        """
+        return self._executor.submit(_noop)
+
+    def shutdown(self):
+        """
+        Runs the pending commands and stops the command thread.
+        """
+        self._executor.shutdown(wait=True)
+
+    @staticmethod
+    def _log_failure(future):
+        if future.exception() is not None:
+            logger.error('redis command failed: %s' % future.exception())
+
+
+def _noop():
+    pass
+
+
+class AsyncRedisPersistence(PersistenceBase):
+    """
+    A Redis persistence that doesn't block the IOLoop once a session is
+    loaded: only the client uids are read on init. A session is read when
+    it's requested, in a single pipelined round trip run on the
+    :class:`RedisCommandQueue`, and kept in memory, where reads are served
+    from; the dormant sessions are only indexed, by :meth:`get_subscriptions`.
+    Writes update the memory and are queued on the
+    :class:`RedisCommandQueue`; they return the command's Future.
+
+    The keys are the same used by :class:`RedisPersistence`.
+    """
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = RedisCommandQueue(redis)
+
+        # it's created on the broker startup, thus the loading Future is
+        # waited for: the sessions are indexed right after
+        uids = [uid.decode('utf-8') for uid in self.commands.execute(
+            'smembers', 'mqtt_broker:client_uids').result()]
+        self.client_uids = AsyncRedisSet(self.commands,
+                                         'mqtt_broker:client_uids', uids)
+
+        self._clients = dict()
+
+    def get_client_uids(self):
+        return self.client_uids
+
+    def get_retained_messages(self):
+        return AsyncRedisRetainedMessages(self.commands)
+
+    def get_for_client(self, uid):
+        client = self._clients.get(uid, None)
+
+        if client is None:
+            if uid in self.client_uids:
+                state = self.commands.execute_pipeline(
+                    *AsyncRedisClientPersistence.load_commands(uid)).result()
+                client = AsyncRedisClientPersistence(self.commands, uid, state)
+            else:
+                # unknown clients have nothing persisted to be loaded
+                client = AsyncRedisClientPersistence(self.commands, uid)
+                self.client_uids.add(uid)
+
+            self._clients[uid] = client
+
+        return client
+
+    def get_subscriptions(self, uids, chunk_size=1000):
+        # the dormant sessions' hashes are read in pipelines of `chunk_size`,
+        # without loading the sessions
+        dormant = list()
+        for uid in uids:
+            client = self._clients.get(uid, None)
+
+            if client is not None:
+                for mask, qos in client.subscriptions.items():
+                    yield uid, mask, qos
+            elif uid in self.client_uids:
+                dormant.append(uid)
+
+        for start in range(0, len(dormant), chunk_size):
+            chunk = dormant[start:start + chunk_size]
+            results = self.commands.execute_pipeline(
+                *(('hgetall', '%s:subscriptions' % uid) for uid in chunk)) \
+                .result()
+
+            for uid, subscriptions in zip(chunk, results):
+                for mask, qos in subscriptions.items():
+                    yield uid, mask.decode('utf-8'), int(qos)
+
+    def write_many(self, writes):
+        # every change is queued on a single pipeline
+        commands = list()
+        for store, added, removed in writes:
+            commands.extend(store.write_commands(added, removed))
+
+        if commands:
+            return self.commands.execute_pipeline(*commands)
+
+    def remove_client_data(self, uid):
+        self.client_uids.discard(uid)
+
+        client = self._clients.pop(uid, None)
+        if client is not None:
+            client.delete_data()
+
+    def sync(self):
+        return self.commands.sync()
+
+    def flush(self):
+        self.commands.shutdown()
+
+
+class AsyncRedisClientPersistence(ClientPersistenceBase):
+    """
+    :param RedisCommandQueue commands: Where the writes are queued;
+    :param str uid: The client's uid;
+    :param list state: The results of the :meth:`load_commands`, or None
+      for a new session.
+    """
+    def __init__(self, commands, uid, state=None):
+        super().__init__(uid)
+        self.commands = commands
+
+        subscriptions, incoming_ids, publishes = dict(), (), None
+        if state is not None:
+            subscriptions, incoming_ids = state[0], state[1]
+            publishes = state[2:]
+
+        self._subscriptions = AsyncRedisHash(
+            commands, '%s:subscriptions' % uid,
+            ((k.decode('utf-8'), int(v)) for k, v in subscriptions.items()))
+
+        self._incoming_packet_ids = AsyncRedisSet(
+            commands, '%s:incoming_packet_ids' % uid,
+            (int(packet_id) for packet_id in incoming_ids))
+
+        self._outgoing_publishes = AsyncRedisOutgoingPublishes(commands, uid,
+                                                               publishes)
+
+    @staticmethod
+    def load_commands(uid):
+        """
+        The commands reading the persisted session of a client, to be run
+        on a pipeline. Their results are the `state` of a new instance.
+        """
+        return (('hgetall', '%s:subscriptions' % uid),
+                ('smembers', '%s:incoming_packet_ids' % uid)) + \
+            AsyncRedisOutgoingPublishes.load_commands(uid)
+
+    @property
+    def subscriptions(self):
+        return self._subscriptions
+
+    @property
+    def incoming_packet_ids(self):
+        return self._incoming_packet_ids
+
+    @property
+    def outgoing_publishes(self):
+        return self._outgoing_publishes
+
+    def delete_data(self):
+        self._subscriptions.clear()
+        self._incoming_packet_ids.clear()
+        return self._outgoing_publishes.remove_all()
+
+
+class AsyncRedisHash():
+    """
+    A dict mirrored to a Redis hash. Reads are served from memory.
+    """
+    def __init__(self, commands, name, items=()):
+        self.commands = commands
+        self.name = name
+        self._data = dict(items)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        self.delete(key)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def keys(self):
+        return self._data.keys()
+
+    def values(self):
+        return self._data.values()
+
+    def items(self):
+        return self._data.items()
+
+    def set(self, key, value):
+        self._data[key] = value
+        return self.commands.execute('hset', self.name, key, value)
+
+    def delete(self, key):
+        del self._data[key]
+        return self.commands.execute('hdel', self.name, key)
+
+    def write_commands(self, items, deleted):
+        """
+        Applies many changes, returning the commands writing them, to be
+        queued on a pipeline by the owner.
+
+        :param dict items: The items set;
+        :param deleted: The keys deleted.
+        """
+        commands = [('hset', self.name, k, v) for k, v in items.items()]
+        commands.extend(('hdel', self.name, k) for k in deleted
+                        if k in self._data)
+
+        self._data.update(items)
+        for key in deleted:
+            self._data.pop(key, None)
+
+        return commands
+
+    def clear(self):
+        self._data.clear()
+        return self.commands.execute('delete', self.name)
+
+
+class AsyncRedisSet():
+    """
+    A set mirrored to a Redis set. Reads are served from memory.
+    """
+    def __init__(self, commands, key, items=()):
+        self.commands = commands
+        self.key = key
+        self._data = set(items)
+
+    def __contains__(self, item):
+        return item in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def add(self, value):
+        self._data.add(value)
+        return self.commands.execute('sadd', self.key, value)
+
+    def remove(self, value):
+        self._data.remove(value)
+        return self.commands.execute('srem', self.key, value)
+
+    def discard(self, value):
+        self._data.discard(value)
+        return self.commands.execute('srem', self.key, value)
+
+    def write_commands(self, added, removed):
+        """
+        Applies many changes, returning the commands writing them, as
+        :meth:`AsyncRedisHash.write_commands` does.
+        """
+        removed = [value for value in removed if value in self._data]
+        commands = [('sadd', self.key, value) for value in added]
+        commands.extend(('srem', self.key, value) for value in removed)
+
+        self._data.update(added)
+        self._data.difference_update(removed)
+
+        return commands
+
+    def clear(self):
+        self._data.clear()
+        return self.commands.execute('delete', self.key)
+
+
+class AsyncRedisRetainedMessages():
+    """
+    The retained messages, as a dict[topic, (raw_data, sender_uid)]. The raw
+    data and the sender uids are kept on two Redis hashes, of which only the
+    topics are loaded, on the broker startup. A message is read from Redis
+    when looked up, once the writes queued before are run: the lookups are
+    left to the hot tier misses of :class:`broker.server.RetainedMessages`,
+    those of a subscription being read together by :meth:`get_many`, in a
+    single round trip.
+    """
+    def __init__(self, commands):
+        self.commands = commands
+        self.name = '_retained_messages'
+
+        self._topics = set(topic.decode('utf-8') for topic in
+                           commands.execute('hkeys', self.name).result())
+
+    def __contains__(self, topic):
+        return topic in self._topics
+
+    def __getitem__(self, topic):
+        value = self.get(topic)
+        if value is None:
+            raise KeyError(topic)
+        return value
+
+    def __setitem__(self, topic, value):
+        self.set(topic, value)
+
+    def __delitem__(self, topic):
+        self.delete(topic)
+
+    def __len__(self):
+        return len(self._topics)
+
+    def __iter__(self):
+        return iter(self._topics)
+
+    def get(self, topic, default=None):
+        value, = self.get_many([topic])
+        return default if value is None else value
+
+    def get_many(self, topics):
+        """
+        Reads the messages of `topics`, in a single round trip.
+
+        :return: A list of the (raw_data, sender_uid) of each topic, None for
+          the topics without a retained message.
+        """
+        known = [topic for topic in topics if topic in self._topics]
+        if not known:
+            return [None] * len(topics)
+
+        frames, senders = self.commands.execute_pipeline(
+            ('hmget', self.name, known),
+            ('hmget', '_retained_senders', known)).result()
+
+        messages = dict()
+        for topic, raw_data, sender_uid in zip(known, frames, senders):
+            if raw_data is not None:
+                messages[topic] = raw_data, (sender_uid or b'').decode('utf-8')
+
+        return [messages.get(topic) for topic in topics]
+
+    def keys(self):
+        return self._topics
+
+    def values(self):
+        return [value for _, value in self.items()]
+
+    def items(self):
+        """
+        Reads all the retained messages, in a single round trip.
+        """
+        messages, senders = self.commands.execute_pipeline(
+            ('hgetall', self.name),
+            ('hgetall', '_retained_senders')).result()
+
+        return [(topic.decode('utf-8'),
+                 (raw, senders.get(topic, b'').decode('utf-8')))
+                for topic, raw in messages.items()]
+
+    def set(self, topic, value):
+        raw_data, sender_uid = value
+        self._topics.add(topic)
+
+        return self.commands.execute_pipeline(
+            ('hset', '_retained_senders', topic, sender_uid or ''),
+            ('hset', self.name, topic, raw_data))
+
+    def write_commands(self, items, deleted):
+        commands = list()
+        for topic, (raw_data, sender_uid) in items.items():
+            self._topics.add(topic)
+            commands.append(('hset', '_retained_senders', topic,
+                             sender_uid or ''))
+            commands.append(('hset', self.name, topic, raw_data))
+
+        for topic in deleted:
+            self._topics.discard(topic)
+            commands.append(('hdel', '_retained_senders', topic))
+            commands.append(('hdel', self.name, topic))
+
+        return commands
+
+    def delete(self, topic):
+        self._topics.remove(topic)
+
+        return self.commands.execute_pipeline(
+            ('hdel', '_retained_senders', topic),
+            ('hdel', self.name, topic))
+
+    def clear(self):
+        self._topics.clear()
+        return self.commands.execute('delete', self.name, '_retained_senders')
+
+
+class AsyncRedisOutgoingPublishes(InMemoryOutgoingPublishes):
+    """
+    The in-memory outgoing publishes store, with every change mirrored to
+    the Redis structures used by :class:`RedisOutgoingPublishes`.
+    """
+    def __init__(self, commands, uid, state=None):
+        super().__init__()
+        self.commands = commands
+        self.uid = uid
+
+        self._queue_key, self._inflight_key, self._ids_key, self._sent_key, \
+            self._conf_key = self._keys(uid)
+
+        if state is not None:
+            self._load(*state)
+
+    @staticmethod
+    def _keys(uid):
+        return ('%s:outgoing_queue' % uid, '%s:outgoing_inflight' % uid,
+                '%s:outgoing_ids' % uid, '%s:outgoing_sent_ids' % uid,
+                '%s:outgoing_conf_ids' % uid)
+
+    @classmethod
+    def load_commands(cls, uid):
+        queue_key, inflight_key, ids_key, sent_key, conf_key = cls._keys(uid)
+        return (('lrange', queue_key, 0, -1), ('hgetall', inflight_key),
+                ('lrange', ids_key, 0, -1), ('smembers', sent_key),
+                ('smembers', conf_key))
+
+    def _load(self, queue, inflight, ids, sent_ids, conf_ids):
+        for raw_data in queue:
+            self._queue.append(MQTTMessageFactory.make(raw_data))
+
+        sent_ids = {int(i) for i in sent_ids}
+        conf_ids = {int(i) for i in conf_ids}
+
+        for packet_id in (int(i) for i in ids):
+            raw_data = inflight.get(str(packet_id).encode())
+            if raw_data is None:
+                continue
+
+            # the frames may be stored with a dummy id (see
+            # RedisOutgoingPublishes), the actual one is the key
+            msg = MQTTMessageFactory.make(raw_data)
+            msg.id = packet_id
+
+            entry = {
+                'id': packet_id,
+                'msg': msg,
+            }
+            if packet_id in sent_ids:
+                entry['sent'] = True
+            if packet_id in conf_ids:
+                entry['conf'] = True
+
+            self._inflight[packet_id] = entry
+
+    def insert(self, msg):
+        super().insert(msg)
+
+        # the queued messages may be shared, the dummy id is set on a copy
+        # just to make it encode, the actual id is set on `get_next`
+        queued = msg.copy()
+        queued.id = 0
+        return self.commands.execute('rpush', self._queue_key, queued.raw_data)
+
+    def get_next(self):
+        msg = super().get_next()
+
+        if msg is not None:
+            self.commands.execute_pipeline(
+                ('lpop', self._queue_key),
+                ('rpush', self._ids_key, msg.id),
+                ('hset', self._inflight_key, msg.id, msg.raw_data))
+
+        return msg
+
+    def set_sent(self, packet_id):
+        super().set_sent(packet_id)
+        return self.commands.execute('sadd', self._sent_key, packet_id)
+
+    def set_pubconf(self, packet_id):
+        super().set_pubconf(packet_id)
+        return self.commands.execute('sadd', self._conf_key, packet_id)
+
+    def write_commands(self, sent, confirmed):
+        """
+        Sets many flows sent and confirmed, returning the commands writing
+        them, to be queued on a pipeline by the owner.
+        """
+        sent = [packet_id for packet_id in sent if self.is_inflight(packet_id)]
+        confirmed = [packet_id for packet_id in confirmed
+                     if self.is_inflight(packet_id)]
+
+        for packet_id in sent:
+            super().set_sent(packet_id)
+        for packet_id in confirmed:
+            super().set_pubconf(packet_id)
+
+        return [('sadd', self._sent_key, packet_id) for packet_id in sent] + \
+            [('sadd', self._conf_key, packet_id) for packet_id in confirmed]
+
+    def remove(self, packet_id):
+        if packet_id in self._inflight:
+            super().remove(packet_id)
+
+            return self.commands.execute_pipeline(
+                ('lrem', self._ids_key, 1, packet_id),
+                ('srem', self._sent_key, packet_id),
+                ('srem', self._conf_key, packet_id),
+                ('hdel', self._inflight_key, packet_id))
+
+    def remove_all(self):
+        self._queue.clear()
+        self._inflight.clear()
+        self._ids_gen.reset()
+
+        return self.commands.execute('delete', self._queue_key,
+                                     self._inflight_key, self._ids_key,
+                                     self._sent_key, self._conf_key)
@@ -0,0 +1,709 @@
+import logging
+import mmap
+import os
+import re
+import struct
+import zlib
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from tornado.ioloop import IOLoop
+
+from broker.factory import MQTTMessageFactory
+from broker.persistence import PersistenceBase, ClientPersistenceBase
+from broker.persistence.in_memory import InMemoryOutgoingPublishes
+
+
+logger = logging.getLogger('persistence.file_log')
+
+
+# the record operations
+SNAPSHOT, CLIENT, REMOVE_CLIENT, SUBSCRIBE, UNSUBSCRIBE, INCOMING_ADD, \
+    INCOMING_REMOVE, QUEUE, START_FLOW, SENT, CONF, COMPLETE, RETAIN, \
+    UNRETAIN = range(14)
+
+# the fields of each operation's records: (s)tring, (b)ytes or (i)nteger
+_FIELDS = {
+    SNAPSHOT: '',
+    CLIENT: 's',
+    REMOVE_CLIENT: 's',
+    SUBSCRIBE: 'ssi',
+    UNSUBSCRIBE: 'ss',
+    INCOMING_ADD: 'si',
+    INCOMING_REMOVE: 'si',
+    QUEUE: 'sb',
+    START_FLOW: 'si',
+    SENT: 'si',
+    CONF: 'si',
+    COMPLETE: 'si',
+    RETAIN: 'sbs',
+    UNRETAIN: 's',
+}
+
+# body length, crc32 of the operation and body, operation
+_HEADER = struct.Struct('<IIB')
+_STR_LEN = struct.Struct('<H')
+_BYTES_LEN = struct.Struct('<I')
+# qos levels and packet ids
+_INT = struct.Struct('<H')
+
+
+def _checksum(op, body):
+    return zlib.crc32(body, zlib.crc32(bytes((op,))))
+
+
+def encode_record(op, *fields):
+    body = bytearray()
+
+    for kind, value in zip(_FIELDS[op], fields):
+        if kind == 's':
+            value = value.encode('utf-8')
+            body += _STR_LEN.pack(len(value))
+            body += value
+        elif kind == 'b':
+            body += _BYTES_LEN.pack(len(value))
+            body += value
+        else:
+            body += _INT.pack(value)
+
+    return _HEADER.pack(len(body), _checksum(op, body), op) + body
+
+
+def _decode_fields(op, body):
+    fields = list()
+    offset = 0
+
+    for kind in _FIELDS[op]:
+        if kind == 's':
+            length, = _STR_LEN.unpack_from(body, offset)
+            offset += _STR_LEN.size
+            fields.append(body[offset:offset + length].decode('utf-8'))
+            offset += length
+        elif kind == 'b':
+            length, = _BYTES_LEN.unpack_from(body, offset)
+            offset += _BYTES_LEN.size
+            fields.append(body[offset:offset + length])
+            offset += length
+        else:
+            fields.append(_INT.unpack_from(body, offset)[0])
+            offset += _INT.size
+
+    return fields
+
+
+def read_records(buffer, apply):
+    """
+    Calls `apply(op, fields)` for each record on `buffer`, stopping at the
+    first torn or corrupt one.
+
+    :return: The offset where the valid records end.
+    """
+    offset, end = 0, len(buffer)
+
+    while offset + _HEADER.size <= end:
+        length, checksum, op = _HEADER.unpack_from(buffer, offset)
+        start = offset + _HEADER.size
+
+        if op not in _FIELDS or start + length > end:
+            break
+
+        body = buffer[start:start + length]
+        if _checksum(op, body) != checksum:
+            break
+
+        apply(op, _decode_fields(op, body))
+        offset = start + length
+
+    return offset
+
+
+class LogState():
+    """
+    The sessions and retained messages recorded on a log, as replayed from
+    it. A snapshot record resets it, since what follows a snapshot is the
+    whole state.
+    """
+    def __init__(self):
+        self.clients = dict()
+        self.retained_messages = dict()
+
+    def apply(self, op, fields):
+        if op == SNAPSHOT:
+            self.clients.clear()
+            self.retained_messages.clear()
+
+        elif op == RETAIN:
+            topic, raw_data, sender_uid = fields
+            self.retained_messages[topic] = (raw_data, sender_uid or None)
+
+        elif op == UNRETAIN:
+            self.retained_messages.pop(fields[0], None)
+
+        elif op == REMOVE_CLIENT:
+            self.clients.pop(fields[0], None)
+
+        else:
+            client = self.clients.get(fields[0], None)
+            if client is None:
+                client = ClientState()
+                self.clients[fields[0]] = client
+
+            client.apply(op, fields[1:])
+
+    def records(self):
+        """
+        Yields the records of a snapshot of this state.
+        """
+        yield encode_record(SNAPSHOT)
+
+        for topic, (raw_data, sender_uid) in self.retained_messages.items():
+            yield encode_record(RETAIN, topic, raw_data, sender_uid or '')
+
+        for uid, client in self.clients.items():
+            yield from client.records(uid)
+
+
+class ClientState():
+    def __init__(self):
+        self.subscriptions = dict()
+        self.incoming_packet_ids = set()
+        self.queue = deque()
+
+        # packet_id -> [raw_data, sent, confirmed], in the order the flows
+        # were started
+        self.inflight = OrderedDict()
+
+    def apply(self, op, fields):
+        if op == SUBSCRIBE:
+            mask, qos = fields
+            self.subscriptions[mask] = qos
+
+        elif op == UNSUBSCRIBE:
+            self.subscriptions.pop(fields[0], None)
+
+        elif op == INCOMING_ADD:
+            self.incoming_packet_ids.add(fields[0])
+
+        elif op == INCOMING_REMOVE:
+            self.incoming_packet_ids.discard(fields[0])
+
+        elif op == QUEUE:
+            self.queue.append(fields[0])
+
+        elif op == START_FLOW:
+            if self.queue:
+                self.inflight[fields[0]] = [self.queue.popleft(), False, False]
+
+        elif op == SENT:
+            if fields[0] in self.inflight:
+                self.inflight[fields[0]][1] = True
+
+        elif op == CONF:
+            if fields[0] in self.inflight:
+                self.inflight[fields[0]][2] = True
+
+        elif op == COMPLETE:
+            self.inflight.pop(fields[0], None)
+
+    def records(self, uid):
+        yield encode_record(CLIENT, uid)
+
+        for mask, qos in self.subscriptions.items():
+            yield encode_record(SUBSCRIBE, uid, mask, qos)
+
+        for packet_id in self.incoming_packet_ids:
+            yield encode_record(INCOMING_ADD, uid, packet_id)
+
+        # the in-flight publishes are queued first, for their flows to be
+        # started before the queued ones
+        for packet_id, (raw_data, sent, confirmed) in self.inflight.items():
+            yield encode_record(QUEUE, uid, raw_data)
+            yield encode_record(START_FLOW, uid, packet_id)
+            if sent:
+                yield encode_record(SENT, uid, packet_id)
+            if confirmed:
+                yield encode_record(CONF, uid, packet_id)
+
+        for raw_data in self.queue:
+            yield encode_record(QUEUE, uid, raw_data)
+
+
+class AppendOnlyLog():
+    """
+    A log of records kept on numbered segment files on `directory`.
+
+    The records appended during an IOLoop iteration are written and synced
+    to the disk together (group commit), by a dedicated thread, so the disk
+    never blocks the IOLoop: :meth:`sync` waits for that commit, instead of
+    starting another one. The last segment is written until it reaches
+    `segment_size` bytes, then a new one is started.
+
+    Once `compact_segments` segments are full, they are compacted on another
+    thread: they are replayed and replaced by a snapshot of the resulting
+    state.
+
+    :param str directory: Where the segments are kept, created if needed;
+    :param int segment_size: The segments' size, in bytes;
+    :param int compact_segments: How many full segments trigger a compaction.
+    """
+    _SEGMENT_NAME = re.compile(r'^(\d+)\.log$')
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024,
+                 compact_segments=8):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.compact_segments = compact_segments
+
+        os.makedirs(directory, exist_ok=True)
+
+        self._buffer = bytearray()
+        # resolved by the commit scheduled at the end of the IOLoop iteration
+        self._next_commit = None
+        self._last_commit = None
+
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._compactor = ThreadPoolExecutor(max_workers=1)
+        self._compacting = False
+
+        self._file = None
+        self._segment = None
+        self._size = 0
+
+    def replay(self):
+        """
+        Reads the log, truncating a torn last record (ie. if the broker
+        crashed while writing it), and starts a new segment to be written.
+        Must be called once, before appending.
+
+        :return: The :class:`LogState` recorded on the log.
+        """
+        for name in os.listdir(self.directory):
+            if name.endswith('.compacting'):
+                # left by an interrupted compaction
+                os.remove(os.path.join(self.directory, name))
+
+        state = LogState()
+        segments = self._segments()
+
+        for number in segments:
+            path = self._path(number)
+            end, size = self._read_segment(path, state.apply)
+
+            if end < size:
+                logger.warning('truncating %d torn bytes from %s' %
+                               (size - end, path))
+                with open(path, 'r+b') as f:
+                    f.truncate(end)
+
+        self._open_segment(segments[-1] + 1 if segments else 0)
+        return state
+
+    def append(self, op, *fields):
+        self._buffer += encode_record(op, *fields)
+
+        if self._next_commit is None:
+            self._next_commit = Future()
+            IOLoop.instance().add_callback(self.commit)
+
+    def sync(self):
+        """
+        :return: A `concurrent.futures.Future` resolved once every record
+          appended so far is synced to the disk, by the commit scheduled at
+          the end of the IOLoop iteration, or None if none was ever appended.
+        """
+        if self._next_commit is not None:
+            return self._next_commit
+
+        return self._last_commit
+
+    def commit(self):
+        """
+        Writes the records appended so far, instead of waiting for the end
+        of the IOLoop iteration.
+
+        :return: A `concurrent.futures.Future` resolved once every record
+          appended so far is synced to the disk, or None if none was ever
+          appended.
+        """
+        next_commit, self._next_commit = self._next_commit, None
+
+        if self._buffer:
+            data = bytes(self._buffer)
+            self._buffer.clear()
+
+            self._last_commit = self._writer.submit(self._write, data)
+            self._last_commit.add_done_callback(_log_failure)
+
+        if next_commit is not None:
+            _chain_future(self._last_commit, next_commit)
+
+        return self._last_commit
+
+    def close(self):
+        """
+        Writes the pending records and waits for a running compaction.
+        """
+        self.commit()
+        self._writer.shutdown(wait=True)
+        self._compactor.shutdown(wait=True)
+        self._file.close()
+
+    def _write(self, data):
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+        self._size += len(data)
+        if self._size >= self.segment_size:
+            self._file.close()
+            self._open_segment(self._segment + 1)
+            self._maybe_compact()
+
+    def _open_segment(self, number):
+        self._file = open(self._path(number), 'ab')
+        self._segment = number
+        self._size = self._file.tell()
+        self._sync_directory()
+
+    def _maybe_compact(self):
+        full = [n for n in self._segments() if n < self._segment]
+
+        if len(full) >= self.compact_segments and not self._compacting:
+            self._compacting = True
+            self._compactor.submit(self._compact, full) \
+                .add_done_callback(self._compacted)
+
+    def _compact(self, segments):
+        state = LogState()
+        for number in segments:
+            self._read_segment(self._path(number), state.apply)
+
+        # the snapshot replaces the last compacted segment, the former ones
+        # are only removed once it's on the disk
+        last = self._path(segments[-1])
+        with open(last + '.compacting', 'wb') as f:
+            for record in state.records():
+                f.write(record)
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(last + '.compacting', last)
+        self._sync_directory()
+
+        for number in segments[:-1]:
+            os.remove(self._path(number))
+
+    def _compacted(self, future):
+        self._compacting = False
+        _log_failure(future)
+
+    @staticmethod
+    def _read_segment(path, apply):
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return 0, 0
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                return read_records(buffer, apply), size
+
+    def _segments(self):
+        segments = list()
+        for name in os.listdir(self.directory):
+            match = self._SEGMENT_NAME.match(name)
+            if match:
+                segments.append(int(match.group(1)))
+
+        return sorted(segments)
+
+    def _path(self, number):
+        return os.path.join(self.directory, '%010d.log' % number)
+
+    def _sync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _log_failure(future):
+    if future.exception() is not None:
+        logger.error('log write failed: %s' % future.exception())
+
+
+def _chain_future(future, target):
+    def copy(future):
+        if future.exception() is not None:
+            target.set_exception(future.exception())
+        else:
+            target.set_result(future.result())
+
+    future.add_done_callback(copy)
+
+
+class FileLogPersistence(PersistenceBase):
+    """
+    Persists the sessions and the retained messages on an
+    :class:`AppendOnlyLog`, replayed on startup and kept in memory, where
+    reads are served from. Each change is appended to the log, :meth:`sync`
+    returns a Future resolved once they're all on the disk.
+
+    :param str directory: Where the log is kept;
+    :param int segment_size: See :class:`AppendOnlyLog`;
+    :param int compact_segments: See :class:`AppendOnlyLog`.
+    """
+    def __init__(self, directory, segment_size=64 * 1024 * 1024,
+                 compact_segments=8):
+        self.log = AppendOnlyLog(directory, segment_size, compact_segments)
+        state = self.log.replay()
+
+        # the loaded sessions are only wrapped once requested, so the dormant
+        # ones are indexed from their state by get_subscriptions
+        self._uids = set(state.clients)
+        self._sessions = state.clients
+        self._clients = dict()
+
+        self._retained_messages = FileLogRetainedMessages(
+            self.log, state.retained_messages.items())
+
+    def get_client_uids(self):
+        return self._uids
+
+    def get_retained_messages(self):
+        return self._retained_messages
+
+    def get_for_client(self, uid):
+        client = self._clients.get(uid, None)
+
+        if client is None:
+            state = self._sessions.pop(uid, None)
+            client = FileLogClientPersistence(self.log, uid, state)
+            self._clients[uid] = client
+
+            if state is None:
+                self._uids.add(uid)
+                self.log.append(CLIENT, uid)
+
+        return client
+
+    def get_subscriptions(self, uids):
+        for uid in uids:
+            # a ClientState, or the persistence of a requested session
+            session = self._clients.get(uid, None) or \
+                self._sessions.get(uid, None)
+
+            if session is not None:
+                for mask, qos in session.subscriptions.items():
+                    yield uid, mask, qos
+
+    def remove_client_data(self, uid):
+        if uid in self._uids:
+            self._uids.discard(uid)
+            self._sessions.pop(uid, None)
+            self._clients.pop(uid, None)
+            self.log.append(REMOVE_CLIENT, uid)
+
+    def sync(self):
+        return self.log.sync()
+
+    def flush(self):
+        self.log.close()
+
+
+class FileLogClientPersistence(ClientPersistenceBase):
+    """
+    :param AppendOnlyLog log: Where the changes are appended, or any object
+      recording them with the same `append` (ie. a SQLiteStatementQueue);
+    :param str uid: The client's uid;
+    :param ClientState state: The replayed session, or None for a new one.
+    """
+    def __init__(self, log, uid, state=None):
+        super().__init__(uid)
+        state = state or ClientState()
+
+        self._subscriptions = FileLogSubscriptions(
+            log, uid, state.subscriptions.items())
+        self._incoming_packet_ids = FileLogPacketIds(
+            log, uid, state.incoming_packet_ids)
+        self._outgoing_publishes = FileLogOutgoingPublishes(log, uid, state)
+
+    @property
+    def subscriptions(self):
+        return self._subscriptions
+
+    @property
+    def incoming_packet_ids(self):
+        return self._incoming_packet_ids
+
+    @property
+    def outgoing_publishes(self):
+        return self._outgoing_publishes
+
+
+class LoggedDict():
+    """
+    A dict whose changes are appended to a log, as :meth:`_log_set` and
+    :meth:`_log_delete` records.
+    """
+    def __init__(self, log, items=()):
+        self.log = log
+        self._data = dict(items)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        self._log_set(key, value)
+
+    def __delitem__(self, key):
+        del self._data[key]
+        self._log_delete(key)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def keys(self):
+        return self._data.keys()
+
+    def values(self):
+        return self._data.values()
+
+    def items(self):
+        return self._data.items()
+
+    def _log_set(self, key, value):
+        raise NotImplementedError()
+
+    def _log_delete(self, key):
+        raise NotImplementedError()
+
+
+class FileLogSubscriptions(LoggedDict):
+    def __init__(self, log, uid, items=()):
+        super().__init__(log, items)
+        self.uid = uid
+
+    def _log_set(self, mask, qos):
+        self.log.append(SUBSCRIBE, self.uid, mask, qos)
+
+    def _log_delete(self, mask):
+        self.log.append(UNSUBSCRIBE, self.uid, mask)
+
+
+class FileLogRetainedMessages(LoggedDict):
+    """
+    The retained messages, as a dict[topic, (raw_data, sender_uid)].
+    """
+    def _log_set(self, topic, value):
+        raw_data, sender_uid = value
+        self.log.append(RETAIN, topic, raw_data, sender_uid or '')
+
+    def _log_delete(self, topic):
+        self.log.append(UNRETAIN, topic)
+
+
+class FileLogPacketIds():
+    """
+    A set of packet ids whose changes are appended to a log.
+    """
+    def __init__(self, log, uid, items=()):
+        self.log = log
+        self.uid = uid
+        self._data = set(items)
+
+    def __contains__(self, item):
+        return item in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def add(self, packet_id):
+        self._data.add(packet_id)
+        self.log.append(INCOMING_ADD, self.uid, packet_id)
+
+    def remove(self, packet_id):
+        self._data.remove(packet_id)
+        self.log.append(INCOMING_REMOVE, self.uid, packet_id)
+
+    def discard(self, packet_id):
+        if packet_id in self._data:
+            self.remove(packet_id)
+
+
+class FileLogOutgoingPublishes(InMemoryOutgoingPublishes):
+    """
+    The in-memory outgoing publishes store, with every change appended to a
+    log.
+    """
+    def __init__(self, log, uid, state=None):
+        super().__init__()
+        self.log = log
+        self.uid = uid
+
+        if state is not None:
+            self._load(state)
+
+    def _load(self, state):
+        for raw_data in state.queue:
+            self._queue.append(MQTTMessageFactory.make(raw_data))
+
+        for packet_id, (raw_data, sent, confirmed) in state.inflight.items():
+            # the frames are stored with a dummy id, see `insert`
+            msg = MQTTMessageFactory.make(raw_data)
+            msg.id = packet_id
+
+            entry = {
+                'id': packet_id,
+                'msg': msg,
+            }
+            if sent:
+                entry['sent'] = True
+            if confirmed:
+                entry['conf'] = True
+
+            self._inflight[packet_id] = entry
+
+    def insert(self, msg):
+        super().insert(msg)
+
+        # the queued messages may be shared, the dummy id is set on a copy
+        # just to make it encode, the actual id is recorded on `get_next`
+        queued = msg.copy()
+        queued.id = 0
+        self.log.append(QUEUE, self.uid, queued.raw_data)
+
+    def get_next(self):
+        msg = super().get_next()
+
+        if msg is not None:
+            self.log.append(START_FLOW, self.uid, msg.id)
+
+        return msg
+
+    def set_sent(self, packet_id):
+        super().set_sent(packet_id)
+        self.log.append(SENT, self.uid, packet_id)
+
+    def set_pubconf(self, packet_id):
+        super().set_pubconf(packet_id)
+        self.log.append(CONF, self.uid, packet_id)
+
+    def remove(self, packet_id):
+        if packet_id in self._inflight:
+            super().remove(packet_id)
+            self.log.append(COMPLETE, self.uid, packet_id)
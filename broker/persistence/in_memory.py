@@ -1,3 +1,5 @@
+from collections import deque, OrderedDict
+
 from broker.factory import MQTTMessageFactory
 from broker.persistence import PersistenceBase, ClientPersistenceBase, OutgoingPublishesBase, PacketIdGenerator
 
@@ -49,10 +51,10 @@ class InMemoryClientPersistence(ClientPersistenceBase):
 
 class InMemoryOutgoingPublishes(OutgoingPublishesBase):
     def __init__(self):
-        self._queue = list()
+        self._queue = deque()
 
-        self._inflight_ids = list()
-        self._inflight = dict()
+        # packet_id -> entry, kept in the order the flows were started
+        self._inflight = OrderedDict()
 
         self._ids_gen = PacketIdGenerator(self._inflight)
 
@@ -61,13 +63,14 @@ class InMemoryOutgoingPublishes(OutgoingPublishesBase):
 
     def get_next(self):
         if len(self._queue) > 0:
-            msg = self._queue.pop(0)
+            # queued publishes may be shared by many subscribers (see
+            # MQTTServer.dispatch_message), thus the id is set on a copy
+            msg = self._queue.popleft().copy()
             msg.id = self._ids_gen.next()
             entry = {
                 'id': msg.id,
                 'msg': msg,
             }
-            self._inflight_ids.append(msg.id)
             self._inflight[msg.id] = entry
             return msg.copy()
         else:
@@ -75,22 +78,19 @@ class InMemoryOutgoingPublishes(OutgoingPublishesBase):
 
     @property
     def inflight_len(self):
-        return len(self._inflight_ids)
+        return len(self._inflight)
 
     def is_inflight(self, packet_id):
-        return packet_id in self._inflight_ids
+        return packet_id in self._inflight
 
     def get_all_inflight(self):
-        for packet_id in self._inflight_ids:
-            entry = self._inflight.get(packet_id)
-            if entry is not None:
-                yield entry['msg'].copy()
+        for entry in list(self._inflight.values()):
+            yield entry['msg'].copy()
 
     def get_inflight(self, packet_id):
-        if packet_id in self._inflight_ids:
-            entry = self._inflight.get(packet_id)
-            if entry is not None:
-                return entry['msg'].copy()
+        entry = self._inflight.get(packet_id)
+        if entry is not None:
+            return entry['msg'].copy()
         else:
             raise KeyError('Unknown packet id')
 
@@ -123,8 +123,5 @@ class InMemoryOutgoingPublishes(OutgoingPublishesBase):
             raise KeyError('Unknown packet id')
 
     def remove(self, packet_id):
-        if packet_id in self._inflight:
-            del self._inflight[packet_id]
-
-        if packet_id in self._inflight_ids:
-            self._inflight_ids.remove(packet_id)
+        if self._inflight.pop(packet_id, None) is not None:
+            self._ids_gen.release(packet_id)
@@ -1,7 +1,9 @@
 import logging
+from collections import OrderedDict
+
 from broker.factory import MQTTMessageFactory
 from broker.persistence import PersistenceBase, ClientPersistenceBase, OutgoingPublishesBase, PacketIdGenerator
-from .redis_types import RedisHashDict, RedisIntSet, RedisUnicodeSet, RedisIntList, RedisList
+from .redis_types import RedisUnicodeSet, RedisList, RedisHashCache, RedisSetCache
 
 
 logger = logging.getLogger('persistence.redis')
@@ -18,7 +20,21 @@ class RedisPersistence(PersistenceBase):
         return self.client_uids
 
     def get_retained_messages(self):
-        return RedisHashDict(self.redis, '_retained_messages')
+        return RedisRetainedMessages(self.redis)
+
+    def get_subscriptions(self, uids, chunk_size=1000):
+        # the sessions' hashes are read in pipelines of `chunk_size`
+        uids = list(uids)
+        for start in range(0, len(uids), chunk_size):
+            chunk = uids[start:start + chunk_size]
+
+            pipe = self.redis.pipeline(transaction=False)
+            for uid in chunk:
+                pipe.hgetall('%s:subscriptions' % uid)
+
+            for uid, subscriptions in zip(chunk, pipe.execute()):
+                for mask, qos in subscriptions.items():
+                    yield uid, mask.decode('utf-8'), int(qos)
 
     def get_for_client(self, uid):
         client = self._clients.get(uid, None)
@@ -30,6 +46,15 @@ class RedisPersistence(PersistenceBase):
 
         return client
 
+    def write_many(self, writes):
+        # every change is written on a single pipeline
+        pipe = self.redis.pipeline(transaction=False)
+        for store, added, removed in writes:
+            for command in store.write_commands(added, removed):
+                getattr(pipe, command[0])(*command[1:])
+
+        pipe.execute()
+
     def remove_client_data(self, uid):
         self.client_uids.remove(uid)
 
@@ -40,17 +65,123 @@ class RedisPersistence(PersistenceBase):
             del self._clients[uid]
 
 
+class RedisRetainedMessages():
+    """
+    The retained messages, as a dict[topic, (raw_data, sender_uid)]. The raw
+    data and the sender uids are kept on two Redis hashes, the layout of
+    :class:`AsyncRedisRetainedMessages`; the topics and the sender uids are
+    decoded as they're read.
+    """
+    def __init__(self, redis):
+        self.redis = redis
+        self.name = '_retained_messages'
+
+    def __contains__(self, topic):
+        return self.redis.hexists(self.name, topic)
+
+    def __getitem__(self, topic):
+        value = self.get(topic)
+        if value is None:
+            raise KeyError(topic)
+        return value
+
+    def __setitem__(self, topic, value):
+        raw_data, sender_uid = value
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hset('_retained_senders', topic, sender_uid or '')
+        pipe.hset(self.name, topic, raw_data)
+        pipe.execute()
+
+    def __delitem__(self, topic):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hdel('_retained_senders', topic)
+        pipe.hdel(self.name, topic)
+        pipe.execute()
+
+    def __len__(self):
+        return self.redis.hlen(self.name)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, topic, default=None):
+        value, = self.get_many([topic])
+        return default if value is None else value
+
+    def get_many(self, topics):
+        """
+        Reads the messages of `topics`, in a single round trip.
+
+        :return: A list of the (raw_data, sender_uid) of each topic, None for
+          the topics without a retained message.
+        """
+        if not topics:
+            return []
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hmget(self.name, topics)
+        pipe.hmget('_retained_senders', topics)
+        frames, senders = pipe.execute()
+
+        return [None if raw_data is None else
+                (raw_data, (sender_uid or b'').decode('utf-8'))
+                for raw_data, sender_uid in zip(frames, senders)]
+
+    def write_commands(self, items, deleted):
+        commands = list()
+        for topic, (raw_data, sender_uid) in items.items():
+            commands.append(('hset', '_retained_senders', topic,
+                             sender_uid or ''))
+            commands.append(('hset', self.name, topic, raw_data))
+
+        for topic in deleted:
+            commands.append(('hdel', '_retained_senders', topic))
+            commands.append(('hdel', self.name, topic))
+
+        return commands
+
+    def keys(self):
+        return [topic.decode('utf-8') for topic in self.redis.hkeys(self.name)]
+
+    def values(self):
+        return [value for _, value in self.items()]
+
+    def items(self):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hgetall(self.name)
+        pipe.hgetall('_retained_senders')
+        messages, senders = pipe.execute()
+
+        return [(topic.decode('utf-8'),
+                 (raw, senders.get(topic, b'').decode('utf-8')))
+                for topic, raw in messages.items()]
+
+
 class RedisClientPersistence(ClientPersistenceBase):
+    """
+    A client session stored on Redis. The session is read once, when it's
+    created, and cached: reads (ie. the subscriptions, on routing) are served
+    from memory and writes go through to Redis, which stays the durable
+    store. Thus the session keys must not be written by anyone else.
+    """
     def __init__(self, redis, uid):
         super().__init__(uid)
         self.redis = redis
 
-        self._subscriptions = RedisSubscriptionsDict(
-            hash_name="%s:subscriptions" % uid,
-            redis=self.redis)
+        pipe = redis.pipeline(transaction=False)
+        pipe.hgetall('%s:subscriptions' % uid)
+        pipe.smembers('%s:incoming_packet_ids' % uid)
+        subscriptions, incoming_ids = pipe.execute()
+
+        self._subscriptions = RedisHashCache(
+            redis, '%s:subscriptions' % uid,
+            ((k.decode('utf-8'), int(v)) for k, v in subscriptions.items()))
+
+        self._incoming_packet_ids = RedisSetCache(
+            redis, '%s:incoming_packet_ids' % uid,
+            (int(packet_id) for packet_id in incoming_ids))
 
-        self._incoming_packet_ids = RedisIntSet(redis=self.redis,
-                                                key="%s:incoming_packet_ids" % uid)
         self._outgoing_publishes = RedisOutgoingPublishes(redis=self.redis, uid=uid)
 
     @property
@@ -73,141 +204,166 @@ class RedisClientPersistence(ClientPersistenceBase):
         self._outgoing_publishes.remove_all()
 
 
-class RedisSubscriptionsDict(RedisHashDict):
-    @staticmethod
-    def _decode_key(k):
-        return k.decode("utf-8") if k else k
-
-    @staticmethod
-    def _decode_value(v):
-        return int(v) if v else v
-
-    def __getitem__(self, key):
-        return self._decode_value(super().__getitem__(key))
-
-    def items(self):
-        yield from ((self._decode_key(k), self._decode_value(v))
-                    for k, v in super().items())
-
-    def keys(self):
-        yield from (self._decode_key(k)
-                    for k in super().keys())
-
-    def values(self):
-        yield from (self._decode_value(v)
-                    for v in super().values())
-
-
 class RedisOutgoingPublishes(OutgoingPublishesBase):
+    """
+    Outgoing publishes stored on Redis. Each flow transition costs a single
+    round trip: starting a flow runs :attr:`START_FLOW_SCRIPT`, completing it
+    runs a pipeline. The in-flight publishes and their 'sent' and
+    'confirmed' flags are read once and cached, so checking them costs none.
+
+    The in-flight frames are stored with a dummy packet id, the actual id is
+    the key they are stored under.
+    """
+
+    # pops the next queued publish and stores it in-flight under the packet
+    # id given as argument
+    START_FLOW_SCRIPT = """
+    local raw_data = redis.call('LPOP', KEYS[1])
+    if raw_data then
+        redis.call('RPUSH', KEYS[2], ARGV[1])
+        redis.call('HSET', KEYS[3], ARGV[1], raw_data)
+    end
+    return raw_data
+    """
+
     def __init__(self, redis, uid):
         self.redis = redis
         self.uid = uid
 
-        self._queue = RedisList(redis, "%s:outgoing_queue" % uid)
-        self._inflight = RedisPacketsDict(redis, "%s:outgoing_inflight" % uid)
+        self._queue_key = '%s:outgoing_queue' % uid
+        self._inflight_key = '%s:outgoing_inflight' % uid
+        self._ids_key = '%s:outgoing_ids' % uid
+        self._sent_key = '%s:outgoing_sent_ids' % uid
+        self._conf_key = '%s:outgoing_conf_ids' % uid
+
+        self._queue = RedisList(redis, self._queue_key)
+
+        pipe = redis.pipeline(transaction=False)
+        pipe.lrange(self._ids_key, 0, -1)
+        pipe.hgetall(self._inflight_key)
+        pipe.smembers(self._sent_key)
+        pipe.smembers(self._conf_key)
+        packet_ids, inflight, sent_ids, conf_ids = pipe.execute()
+
+        # packet id -> raw data, in the order the flows were started
+        self._inflight = OrderedDict()
+        for packet_id in packet_ids:
+            raw_data = inflight.get(packet_id)
+            if raw_data is not None:
+                self._inflight[int(packet_id)] = raw_data
 
-        self._inflight_ids = RedisIntList(redis, '%s:outgoing_ids' % uid)
-        self._sent_ids = RedisIntSet(redis, "%s:outgoing_sent_ids" % uid)
-        self._confirmed_ids = RedisIntSet(redis, "%s:outgoing_conf_ids" % uid)
+        self._sent_ids = {int(i) for i in sent_ids}
+        self._confirmed_ids = {int(i) for i in conf_ids}
 
         self._ids_gen = PacketIdGenerator(self._inflight)
+        self._start_flow = redis.register_script(self.START_FLOW_SCRIPT)
 
     def insert(self, msg):
-        msg.id = 0  # sets a dummy id just to make it encode,
-                    # the actual id is set on `get_next` method.
-        self._queue.append(msg.raw_data)
+        # the queued messages may be shared, the dummy id is set on a copy
+        # just to make it encode, the actual id is set on `get_next`
+        queued = msg.copy()
+        queued.id = 0
+        self._queue.append(queued.raw_data)
 
     def get_next(self):
         """
         Gets the next packet to be published.
         Should be used to start a new flow.
         """
-        # todo: do in a transaction
-        if len(self._queue) > 0:
-            raw_data = self._queue.pop()
+        packet_id = self._ids_gen.next()
+        raw_data = self._start_flow(
+            keys=[self._queue_key, self._ids_key, self._inflight_key],
+            args=[packet_id])
 
-            msg = MQTTMessageFactory.make(raw_data)
-            msg.id = self._ids_gen.next()
-            self._inflight_ids.append(msg.id)
-            self._inflight[msg.id] = msg.raw_data
-            return msg
-
-        else:
+        if raw_data is None:
+            self._ids_gen.release(packet_id)
             return None
 
+        self._inflight[packet_id] = raw_data
+        return self._make_inflight(packet_id, raw_data)
+
     @property
     def inflight_len(self):
-        return len(self._inflight)
+        return len(self._ids_gen)
 
     def is_inflight(self, packet_id):
-        return packet_id in self._inflight
+        return packet_id in self._ids_gen
 
     def get_all_inflight(self):
-        for packet_id in self._inflight_ids:
-            raw = self._inflight.get(packet_id)
-            if raw is not None:
-                yield MQTTMessageFactory.make(raw)
+        for packet_id, raw in list(self._inflight.items()):
+            yield self._make_inflight(packet_id, raw)
 
     def get_inflight(self, packet_id):
-        if packet_id in self._inflight:
-            raw = self._inflight.get(packet_id)
-            if raw is not None:
-                return MQTTMessageFactory.make(raw)
+        if packet_id in self._ids_gen:
+            return self._make_inflight(packet_id, self._inflight[packet_id])
         else:
             raise KeyError('Unknown packet id')
 
     def set_sent(self, packet_id):
-        if packet_id in self._inflight:
+        if packet_id in self._ids_gen:
+            self.redis.sadd(self._sent_key, packet_id)
             self._sent_ids.add(packet_id)
         else:
             raise KeyError('Unknown packet id')
 
     def is_sent(self, packet_id):
-        if packet_id in self._inflight:
+        if packet_id in self._ids_gen:
             return packet_id in self._sent_ids
         else:
             raise KeyError('Unknown packet id')
 
     def set_pubconf(self, packet_id):
-        if packet_id in self._inflight:
+        if packet_id in self._ids_gen:
+            self.redis.sadd(self._conf_key, packet_id)
             self._confirmed_ids.add(packet_id)
         else:
             raise KeyError('Unknown packet id')
 
     def is_pubconf(self, packet_id):
-        if packet_id in self._inflight:
+        if packet_id in self._ids_gen:
             return packet_id in self._confirmed_ids
         else:
             raise KeyError('Unknown packet id')
 
-    def remove(self, packet_id):
-        # todo: do in a transaction
-        if packet_id in self._inflight:
-            self._inflight_ids.remove(packet_id)
-            self._sent_ids.remove(packet_id)
-            self._confirmed_ids.remove(packet_id)
-            del self._inflight[packet_id]
+    def write_commands(self, sent, confirmed):
+        """
+        Sets many flows sent and confirmed, returning the commands writing
+        them, to be run on a pipeline by the owner.
+        """
+        sent = [packet_id for packet_id in sent if packet_id in self._ids_gen]
+        confirmed = [packet_id for packet_id in confirmed
+                     if packet_id in self._ids_gen]
 
-    def remove_all(self):
-        self.redis.delete(
-            '%s:outgoing_queue' % self.uid,
-            '%s:outgoing_inflight' % self.uid,
-            '%s:outgoing_ids' % self.uid,
-            '%s:outgoing_sent_ids' % self.uid,
-            "%s:outgoing_conf_ids" % self.uid,
-            )
+        self._sent_ids.update(sent)
+        self._confirmed_ids.update(confirmed)
 
+        return [('sadd', self._sent_key, packet_id) for packet_id in sent] + \
+            [('sadd', self._conf_key, packet_id) for packet_id in confirmed]
 
-class RedisPacketsDict(RedisHashDict):
-    @staticmethod
-    def _decode_key(k):
-        return int(k) if k else k
+    def remove(self, packet_id):
+        if packet_id in self._ids_gen:
+            pipe = self.redis.pipeline()
+            pipe.lrem(self._ids_key, 1, packet_id)
+            pipe.srem(self._sent_key, packet_id)
+            pipe.srem(self._conf_key, packet_id)
+            pipe.hdel(self._inflight_key, packet_id)
+            pipe.execute()
 
-    def items(self):
-        yield from ((self._decode_key(k), v)
-                    for k, v in super().items())
+            del self._inflight[packet_id]
+            self._sent_ids.discard(packet_id)
+            self._confirmed_ids.discard(packet_id)
+            self._ids_gen.release(packet_id)
 
-    def keys(self):
-        yield from (self._decode_key(k)
-                    for k in super().keys())
+    def remove_all(self):
+        self.redis.delete(self._queue_key, self._inflight_key, self._ids_key,
+                          self._sent_key, self._conf_key)
+        self._inflight.clear()
+        self._sent_ids.clear()
+        self._confirmed_ids.clear()
+        self._ids_gen.reset()
 
+    @staticmethod
+    def _make_inflight(packet_id, raw_data):
+        msg = MQTTMessageFactory.make(raw_data)
+        msg.id = packet_id
+        return msg
@@ -170,3 +170,113 @@ class RedisUnicodeSet(RedisSet):
 class RedisIntSet(RedisSet):
     def _decode(self, val):
         return int(val) if val else val
+
+
+class RedisHashCache():
+    """
+    A dict mirrored to a Redis hash, as read once by the owner: reads are
+    served from memory, writes go through to Redis before being applied.
+    It assumes nobody else writes the hash.
+    """
+    def __init__(self, redis, hash_name, items=()):
+        self.redis = redis
+        self.name = hash_name
+        self._data = dict(items)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self.redis.hset(self.name, key, value)
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        self.redis.hdel(self.name, key)
+        del self._data[key]
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def write_commands(self, items, deleted):
+        """
+        Applies many changes, returning the commands writing them, to be run
+        on a pipeline by the owner.
+
+        :param dict items: The items set;
+        :param deleted: The keys deleted.
+        """
+        commands = [('hset', self.name, k, v) for k, v in items.items()]
+        commands.extend(('hdel', self.name, k) for k in deleted
+                        if k in self._data)
+
+        self._data.update(items)
+        for key in deleted:
+            self._data.pop(key, None)
+
+        return commands
+
+    def items(self):
+        return self._data.items()
+
+    def keys(self):
+        return self._data.keys()
+
+    def values(self):
+        return self._data.values()
+
+
+class RedisSetCache():
+    """
+    A set mirrored to a Redis set, the same way :class:`RedisHashCache` is.
+    """
+    def __init__(self, redis, key, items=()):
+        self.redis = redis
+        self.key = key
+        self._data = set(items)
+
+    def __contains__(self, item):
+        return item in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def add(self, value):
+        self.redis.sadd(self.key, value)
+        self._data.add(value)
+
+    def remove(self, value):
+        if value not in self._data:
+            raise KeyError(value)
+
+        self.redis.srem(self.key, value)
+        self._data.remove(value)
+
+    def discard(self, value):
+        if value in self._data:
+            self.remove(value)
+
+    def write_commands(self, added, removed):
+        """
+        Applies many changes, returning the commands writing them, as
+        :meth:`RedisHashCache.write_commands` does.
+        """
+        removed = [value for value in removed if value in self._data]
+        commands = [('sadd', self.key, value) for value in added]
+        commands.extend(('srem', self.key, value) for value in removed)
+
+        self._data.update(added)
+        self._data.difference_update(removed)
+
+        return commands
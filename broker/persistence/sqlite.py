@@ -0,0 +1,295 @@
+import logging
+import sqlite3
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from tornado.ioloop import IOLoop
+
+from broker.persistence import PersistenceBase
+from broker.persistence.file_log import ClientState, FileLogClientPersistence, \
+    FileLogRetainedMessages, CLIENT, REMOVE_CLIENT, SUBSCRIBE, UNSUBSCRIBE, \
+    INCOMING_ADD, INCOMING_REMOVE, QUEUE, START_FLOW, SENT, CONF, COMPLETE, \
+    RETAIN, UNRETAIN, _chain_future
+
+
+logger = logging.getLogger('persistence.sqlite')
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS clients (
+    uid TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS subscriptions (
+    uid TEXT,
+    mask TEXT,
+    qos INTEGER,
+    PRIMARY KEY (uid, mask)
+);
+CREATE TABLE IF NOT EXISTS incoming_packet_ids (
+    uid TEXT,
+    packet_id INTEGER,
+    PRIMARY KEY (uid, packet_id)
+);
+CREATE TABLE IF NOT EXISTS outgoing_publishes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    uid TEXT,
+    raw_data BLOB,
+    packet_id INTEGER,
+    sent INTEGER DEFAULT 0,
+    conf INTEGER DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS outgoing_publishes_flow
+    ON outgoing_publishes (uid, packet_id);
+CREATE TABLE IF NOT EXISTS retained_messages (
+    topic TEXT PRIMARY KEY,
+    raw_data BLOB,
+    sender_uid TEXT
+);
+"""
+
+# the statements run for each change record (see broker.persistence.file_log)
+_STATEMENTS = {
+    CLIENT: (
+        'INSERT OR IGNORE INTO clients (uid) VALUES (?)',
+    ),
+    REMOVE_CLIENT: (
+        'DELETE FROM clients WHERE uid = ?',
+        'DELETE FROM subscriptions WHERE uid = ?',
+        'DELETE FROM incoming_packet_ids WHERE uid = ?',
+        'DELETE FROM outgoing_publishes WHERE uid = ?',
+    ),
+    SUBSCRIBE: (
+        'INSERT OR REPLACE INTO subscriptions (uid, mask, qos) VALUES (?, ?, ?)',
+    ),
+    UNSUBSCRIBE: (
+        'DELETE FROM subscriptions WHERE uid = ? AND mask = ?',
+    ),
+    INCOMING_ADD: (
+        'INSERT OR IGNORE INTO incoming_packet_ids (uid, packet_id) VALUES (?, ?)',
+    ),
+    INCOMING_REMOVE: (
+        'DELETE FROM incoming_packet_ids WHERE uid = ? AND packet_id = ?',
+    ),
+    QUEUE: (
+        'INSERT INTO outgoing_publishes (uid, raw_data) VALUES (?, ?)',
+    ),
+    # flows are started in the queue order, the first queued row gets the id
+    START_FLOW: (
+        'UPDATE outgoing_publishes SET packet_id = ?2 WHERE seq = ('
+        'SELECT MIN(seq) FROM outgoing_publishes '
+        'WHERE uid = ?1 AND packet_id IS NULL)',
+    ),
+    SENT: (
+        'UPDATE outgoing_publishes SET sent = 1 WHERE uid = ? AND packet_id = ?',
+    ),
+    CONF: (
+        'UPDATE outgoing_publishes SET conf = 1 WHERE uid = ? AND packet_id = ?',
+    ),
+    COMPLETE: (
+        'DELETE FROM outgoing_publishes WHERE uid = ? AND packet_id = ?',
+    ),
+    RETAIN: (
+        'INSERT OR REPLACE INTO retained_messages (topic, raw_data, sender_uid) '
+        'VALUES (?, ?, ?)',
+    ),
+    UNRETAIN: (
+        'DELETE FROM retained_messages WHERE topic = ?',
+    ),
+}
+
+
+class SQLiteStatementQueue():
+    """
+    Runs the statements of the change records appended during an IOLoop
+    iteration in a single transaction, on a dedicated thread, so the
+    database never blocks the IOLoop: :meth:`sync` waits for that
+    transaction, instead of starting another one. It takes the place of the
+    :class:`AppendOnlyLog` for the file log's session objects.
+
+    :param str path: The database file, created if needed.
+    """
+    def __init__(self, path):
+        self.path = path
+
+        self._pending = list()
+        # resolved by the commit scheduled at the end of the IOLoop iteration
+        self._next_commit = None
+        self._last_commit = None
+
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._connection = self._executor.submit(self._connect).result()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.executescript(_SCHEMA)
+        return connection
+
+    def load(self):
+        """
+        :return: The clients' :class:`ClientState` by uid, and the retained
+          messages.
+        """
+        return self._executor.submit(self._load).result()
+
+    def _load(self):
+        db = self._connection
+        clients = dict((uid, ClientState()) for uid, in
+                       db.execute('SELECT uid FROM clients'))
+
+        def client(uid):
+            # rows of removed clients are deleted with them, though
+            return clients.setdefault(uid, ClientState())
+
+        for uid, mask, qos in db.execute(
+                'SELECT uid, mask, qos FROM subscriptions'):
+            client(uid).subscriptions[mask] = qos
+
+        for uid, packet_id in db.execute(
+                'SELECT uid, packet_id FROM incoming_packet_ids'):
+            client(uid).incoming_packet_ids.add(packet_id)
+
+        for uid, raw_data, packet_id, sent, conf in db.execute(
+                'SELECT uid, raw_data, packet_id, sent, conf '
+                'FROM outgoing_publishes ORDER BY seq'):
+            if packet_id is None:
+                client(uid).queue.append(bytes(raw_data))
+            else:
+                client(uid).inflight[packet_id] = [bytes(raw_data), bool(sent),
+                                                   bool(conf)]
+
+        retained_messages = dict(
+            (topic, (bytes(raw_data), sender_uid or None))
+            for topic, raw_data, sender_uid in db.execute(
+                'SELECT topic, raw_data, sender_uid FROM retained_messages'))
+
+        return clients, retained_messages
+
+    def append(self, op, *fields):
+        self._pending.append((op, fields))
+
+        if self._next_commit is None:
+            self._next_commit = Future()
+            IOLoop.instance().add_callback(self.commit)
+
+    def sync(self):
+        """
+        :return: A `concurrent.futures.Future` resolved once every statement
+          appended so far is committed, by the transaction scheduled at the
+          end of the IOLoop iteration, or None if none was ever appended.
+        """
+        if self._next_commit is not None:
+            return self._next_commit
+
+        return self._last_commit
+
+    def commit(self):
+        """
+        Runs the statements appended so far, instead of waiting for the end
+        of the IOLoop iteration.
+
+        :return: A `concurrent.futures.Future` resolved once every statement
+          appended so far is committed, or None if none was ever appended.
+        """
+        next_commit, self._next_commit = self._next_commit, None
+
+        if self._pending:
+            pending, self._pending = self._pending, list()
+
+            self._last_commit = self._executor.submit(self._execute, pending)
+            self._last_commit.add_done_callback(_log_failure)
+
+        if next_commit is not None:
+            _chain_future(self._last_commit, next_commit)
+
+        return self._last_commit
+
+    def close(self):
+        """
+        Commits the pending statements and closes the database. Closing it
+        again is a no-op.
+        """
+        if self._connection is None:
+            return
+
+        self.commit()
+        self._executor.submit(self._connection.close)
+        self._executor.shutdown(wait=True)
+        self._connection = None
+
+    def _execute(self, pending):
+        with self._connection:
+            for op, fields in pending:
+                for statement in _STATEMENTS[op]:
+                    self._connection.execute(statement, fields)
+
+
+def _log_failure(future):
+    if future.exception() is not None:
+        logger.error('sqlite transaction failed: %s' % future.exception())
+
+
+class SQLitePersistence(PersistenceBase):
+    """
+    Persists the sessions and the retained messages on a SQLite database in
+    WAL mode, loaded on startup and kept in memory, where reads are served
+    from. The changes are recorded as in :class:`FileLogPersistence`, and
+    written by a :class:`SQLiteStatementQueue`: :meth:`sync` returns a
+    Future resolved once they're all committed.
+
+    :param str path: The database file.
+    """
+    def __init__(self, path):
+        self.statements = SQLiteStatementQueue(path)
+        clients, retained_messages = self.statements.load()
+
+        # the loaded sessions are only wrapped once requested, so the dormant
+        # ones are indexed from their state by get_subscriptions
+        self._uids = set(clients)
+        self._sessions = clients
+        self._clients = dict()
+
+        self._retained_messages = FileLogRetainedMessages(
+            self.statements, retained_messages.items())
+
+    def get_client_uids(self):
+        return self._uids
+
+    def get_retained_messages(self):
+        return self._retained_messages
+
+    def get_for_client(self, uid):
+        client = self._clients.get(uid, None)
+
+        if client is None:
+            state = self._sessions.pop(uid, None)
+            client = FileLogClientPersistence(self.statements, uid, state)
+            self._clients[uid] = client
+
+            if state is None:
+                self._uids.add(uid)
+                self.statements.append(CLIENT, uid)
+
+        return client
+
+    def get_subscriptions(self, uids):
+        for uid in uids:
+            # a ClientState, or the persistence of a requested session
+            session = self._clients.get(uid, None) or \
+                self._sessions.get(uid, None)
+
+            if session is not None:
+                for mask, qos in session.subscriptions.items():
+                    yield uid, mask, qos
+
+    def remove_client_data(self, uid):
+        if uid in self._uids:
+            self._uids.discard(uid)
+            self._sessions.pop(uid, None)
+            self._clients.pop(uid, None)
+            self.statements.append(REMOVE_CLIENT, uid)
+
+    def sync(self):
+        return self.statements.sync()
+
+    def flush(self):
+        self.statements.close()
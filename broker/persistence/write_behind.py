@@ -0,0 +1,399 @@
+from datetime import timedelta
+from weakref import WeakValueDictionary
+
+from tornado.ioloop import IOLoop
+
+from broker.persistence import PersistenceBase, ClientPersistenceBase, OutgoingPublishesBase, \
+    get_many
+
+
+_DELETED = object()
+
+
+class WriteBehindPersistence(PersistenceBase):
+    """
+    Wraps any persistence, coalescing the changes made to the subscriptions,
+    the incoming QoS 2 packet ids, the in-flight 'sent' and 'confirmed'
+    flags and the retained messages: they are kept pending and written to
+    the wrapped persistence together, by :meth:`write_pending`. Reads see
+    the pending changes. Only the stores with pending changes are visited,
+    and their changes are handed to the wrapped persistence's
+    :meth:`PersistenceBase.write_many` together, written by the Redis
+    backends in a single round trip.
+
+    The wrappers of the sessions are only kept while the sessions use them,
+    or while they have pending changes.
+
+    A flush is scheduled upon the first pending change, so changes are not
+    pending for longer than `interval` milliseconds (the durability window).
+    Zero flushes on the next IOLoop iteration. A flush is also done as soon
+    as `max_pending` changes are pending.
+
+    The changes that can't be deferred (queueing a publish, starting or
+    completing a flow) are written straight away, so :meth:`sync`, upon which
+    publishes are acknowledged, doesn't wait for the pending ones.
+
+    :param PersistenceBase persistence: The wrapped persistence;
+    :param int interval: The durability window, in milliseconds;
+    :param int max_pending: How many changes may be pending.
+    """
+    def __init__(self, persistence, interval=100, max_pending=10000):
+        assert isinstance(persistence, PersistenceBase)
+        self.persistence = persistence
+        self.interval = interval
+        self.max_pending = max_pending
+
+        self._clients = WeakValueDictionary()
+        self._retained_messages = None
+        # the wrappers with pending changes
+        self._dirty = set()
+
+        self._pending = 0
+        self._scheduled = None
+
+    def get_client_uids(self):
+        return self.persistence.get_client_uids()
+
+    def get_retained_messages(self):
+        if self._retained_messages is None:
+            self._retained_messages = WriteBehindDict(
+                self, self.persistence.get_retained_messages())
+
+        return self._retained_messages
+
+    def get_for_client(self, uid):
+        client = self._clients.get(uid, None)
+
+        if client is None:
+            client = WriteBehindClientPersistence(
+                self, self.persistence.get_for_client(uid))
+            self._clients[uid] = client
+
+        return client
+
+    def get_subscriptions(self, uids):
+        # the sessions with pending changes are read through their wrappers
+        uids = list(uids)
+        for uid in uids:
+            client = self._clients.get(uid, None)
+            if client is not None:
+                for mask, qos in client.subscriptions.items():
+                    yield uid, mask, qos
+
+        yield from self.persistence.get_subscriptions(
+            uid for uid in uids if uid not in self._clients)
+
+    def remove_client_data(self, uid):
+        client = self._clients.pop(uid, None)
+        if client is not None:
+            client.discard_pending()
+
+        self.persistence.remove_client_data(uid)
+
+    def sync(self):
+        return self.persistence.sync()
+
+    def flush(self):
+        """
+        Writes all the pending changes and flushes the wrapped persistence.
+
+        :return: The wrapped persistence's :meth:`flush` result.
+        """
+        self.write_pending()
+        return self.persistence.flush()
+
+    def write_pending(self):
+        """
+        Writes all the pending changes to the wrapped persistence.
+
+        :return: The wrapped persistence's :meth:`sync` result.
+        """
+        if self._scheduled is not None:
+            IOLoop.instance().remove_timeout(self._scheduled)
+            self._scheduled = None
+
+        if self._dirty:
+            self._pending = 0
+            dirty, self._dirty = self._dirty, set()
+
+            writes = list()
+            for wrapper in dirty:
+                writes.extend(wrapper.take_pending())
+
+            self.persistence.write_many(writes)
+
+        return self.persistence.sync()
+
+    def changed(self, wrapper):
+        """
+        Called by the wrappers on each pending change.
+        """
+        self._dirty.add(wrapper)
+        self._pending += 1
+
+        if self._pending >= self.max_pending:
+            self.write_pending()
+
+        elif self._scheduled is None:
+            self._scheduled = IOLoop.instance().add_timeout(
+                timedelta(milliseconds=self.interval), self._on_interval)
+
+    def _on_interval(self):
+        self._scheduled = None
+        self.write_pending()
+
+
+class WriteBehindClientPersistence(ClientPersistenceBase):
+    def __init__(self, owner, persistence):
+        super().__init__(persistence.uid)
+        self._owner = owner
+
+        self._subscriptions = WriteBehindDict(self, persistence.subscriptions)
+        self._incoming_packet_ids = WriteBehindSet(
+            self, persistence.incoming_packet_ids)
+        self._outgoing_publishes = WriteBehindOutgoingPublishes(
+            self, persistence.outgoing_publishes)
+
+    @property
+    def subscriptions(self):
+        return self._subscriptions
+
+    @property
+    def incoming_packet_ids(self):
+        return self._incoming_packet_ids
+
+    @property
+    def outgoing_publishes(self):
+        return self._outgoing_publishes
+
+    def changed(self, wrapper):
+        # the session is flushed as a whole, and kept until then
+        self._owner.changed(self)
+
+    def take_pending(self):
+        return self._subscriptions.take_pending() + \
+            self._incoming_packet_ids.take_pending() + \
+            self._outgoing_publishes.take_pending()
+
+    def discard_pending(self):
+        self._subscriptions.discard_pending()
+        self._incoming_packet_ids.discard_pending()
+        self._outgoing_publishes.discard_pending()
+
+
+class WriteBehindDict():
+    """
+    A dict whose changes are kept pending until flushed to `wrapped`. Many
+    changes of a key are coalesced into the last one.
+    """
+    def __init__(self, owner, wrapped):
+        self._owner = owner
+        self._wrapped = wrapped
+        self._pending = dict()
+
+    def __contains__(self, key):
+        value = self._pending.get(key, None)
+        if value is not None:
+            return value is not _DELETED
+
+        return key in self._wrapped
+
+    def __getitem__(self, key):
+        value = self._pending.get(key, None)
+        if value is _DELETED:
+            raise KeyError(key)
+        elif value is not None:
+            return value
+
+        return self._wrapped[key]
+
+    def __setitem__(self, key, value):
+        self._pending[key] = value
+        self._owner.changed(self)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+
+        self._pending[key] = _DELETED
+        self._owner.changed(self)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def get_many(self, keys):
+        """
+        Reads the values of `keys`, the ones not pending being read from the
+        wrapped dict together, see :func:`broker.persistence.get_many`.
+        """
+        unknown = [key for key in keys if key not in self._pending]
+        values = dict(zip(unknown, get_many(self._wrapped, unknown)))
+
+        for key in keys:
+            value = self._pending.get(key, None)
+            if value is not None:
+                values[key] = None if value is _DELETED else value
+
+        return [values[key] for key in keys]
+
+    def keys(self):
+        keys = [k for k in self._wrapped.keys() if k not in self._pending]
+        keys.extend(k for k, v in self._pending.items() if v is not _DELETED)
+        return keys
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def take_pending(self):
+        """
+        :return: The pending changes, as the writes of
+          :meth:`PersistenceBase.write_many`.
+        """
+        if not self._pending:
+            return []
+
+        pending, self._pending = self._pending, dict()
+
+        items = dict((k, v) for k, v in pending.items() if v is not _DELETED)
+        deleted = [k for k, v in pending.items() if v is _DELETED]
+        return [(self._wrapped, items, deleted)]
+
+    def discard_pending(self):
+        self._pending.clear()
+
+
+class WriteBehindSet():
+    """
+    A set whose changes are kept pending until flushed to `wrapped`.
+    """
+    def __init__(self, owner, wrapped):
+        self._owner = owner
+        self._wrapped = wrapped
+        self._pending = dict()  # value -> whether it is added
+
+    def __contains__(self, item):
+        added = self._pending.get(item, None)
+        if added is not None:
+            return added
+
+        return item in self._wrapped
+
+    def __iter__(self):
+        return iter(self._items())
+
+    def __len__(self):
+        return len(self._items())
+
+    def add(self, value):
+        self._pending[value] = True
+        self._owner.changed(self)
+
+    def remove(self, value):
+        if value not in self:
+            raise KeyError(value)
+
+        self._pending[value] = False
+        self._owner.changed(self)
+
+    def discard(self, value):
+        if value in self:
+            self.remove(value)
+
+    def _items(self):
+        items = {i for i in self._wrapped if i not in self._pending}
+        items.update(i for i, added in self._pending.items() if added)
+        return items
+
+    def take_pending(self):
+        if not self._pending:
+            return []
+
+        pending, self._pending = self._pending, dict()
+
+        added = [v for v, is_added in pending.items() if is_added]
+        removed = [v for v, is_added in pending.items() if not is_added]
+        return [(self._wrapped, added, removed)]
+
+    def discard_pending(self):
+        self._pending.clear()
+
+
+class WriteBehindOutgoingPublishes(OutgoingPublishesBase):
+    """
+    Defers the 'sent' and 'confirmed' flags of the in-flight publishes, the
+    other operations are done on `wrapped` straight away.
+    """
+    def __init__(self, owner, wrapped):
+        self._owner = owner
+        self._wrapped = wrapped
+
+        self._sent = set()
+        self._confirmed = set()
+
+    def insert(self, msg):
+        return self._wrapped.insert(msg)
+
+    def get_next(self):
+        return self._wrapped.get_next()
+
+    @property
+    def inflight_len(self):
+        return self._wrapped.inflight_len
+
+    def is_inflight(self, packet_id):
+        return self._wrapped.is_inflight(packet_id)
+
+    def get_all_inflight(self):
+        return self._wrapped.get_all_inflight()
+
+    def get_inflight(self, packet_id):
+        return self._wrapped.get_inflight(packet_id)
+
+    def set_sent(self, packet_id):
+        if not self._wrapped.is_inflight(packet_id):
+            raise KeyError('Unknown packet id')
+
+        self._sent.add(packet_id)
+        self._owner.changed(self)
+
+    def is_sent(self, packet_id):
+        return packet_id in self._sent or self._wrapped.is_sent(packet_id)
+
+    def set_pubconf(self, packet_id):
+        if not self._wrapped.is_inflight(packet_id):
+            raise KeyError('Unknown packet id')
+
+        self._confirmed.add(packet_id)
+        self._owner.changed(self)
+
+    def is_pubconf(self, packet_id):
+        return packet_id in self._confirmed or \
+            self._wrapped.is_pubconf(packet_id)
+
+    def remove(self, packet_id):
+        # the flags of a completed flow are moot
+        self._sent.discard(packet_id)
+        self._confirmed.discard(packet_id)
+
+        return self._wrapped.remove(packet_id)
+
+    def take_pending(self):
+        if not self._sent and not self._confirmed:
+            return []
+
+        sent, self._sent = self._sent, set()
+        confirmed, self._confirmed = self._confirmed, set()
+        return [(self._wrapped, sent, confirmed)]
+
+    def discard_pending(self):
+        self._sent.clear()
+        self._confirmed.clear()
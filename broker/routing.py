@@ -0,0 +1,616 @@
+from collections import OrderedDict
+
+from broker.util import MQTTUtils, TopicFilter
+
+
+class SubscriptionIndex():
+    """
+    Broker-wide index of the clients' subscriptions, organized as a trie of
+    topic levels. The single level (``+``) and multi level (``#``) wildcards
+    are kept in dedicated branches of each node, so routing a topic only walks
+    the branches that may match it instead of testing every subscription of
+    every known client.
+
+    The resolved delivery plans of the most recently routed topics are kept
+    in :attr:`plans`, see :meth:`resolve`, and the most recently routed
+    topics without subscribers in :attr:`unsubscribed`, see :meth:`route`.
+    The :class:`TopicFilter` of each
+    subscribed mask is kept in :attr:`filters`, shared by all the clients
+    subscribed on it.
+
+    Shared subscriptions (``$share/<group>/<filter>``) are indexed on the node
+    of their filter as a :class:`SharedGroup`, apart from the other
+    subscriptions: they are resolved by :meth:`resolve_shared`, and their
+    plans cached in :attr:`shared_plans`.
+
+    :param int cache_size: How many topics have their delivery plan cached.
+      Zero disables the cache.
+    :param int unsubscribed_cache_size: How many topics without subscribers
+      are cached, apart from the plans. Zero disables the cache.
+    :param bool single_delivery: Whether a client with many subscriptions
+      matching a topic gets a single delivery, at the maximum QoS granted by
+      them, instead of one per subscription.
+    """
+    def __init__(self, cache_size=1024, single_delivery=False,
+                 unsubscribed_cache_size=256):
+        self._root = _TopicNode()
+        self._client_masks = dict()
+
+        self.single_delivery = single_delivery
+        self._extend = _extend_max if single_delivery else _extend
+
+        # counters of :meth:`has_subscribers` and :meth:`route`
+        self.routed = 0
+        self.skipped = 0
+
+        self.plans = DeliveryPlanCache(cache_size)
+
+        # the topics without subscribers have their own cache, so publishes
+        # on many unsubscribed topics don't evict the plans of the others
+        self.unsubscribed = DeliveryPlanCache(unsubscribed_cache_size)
+        self.shared_plans = DeliveryPlanCache(cache_size)
+        self.filters = TopicFilterStore()
+
+        self._groups_count = 0
+
+    def add(self, uid, mask, qos):
+        """
+        Adds (or updates) the subscription of the client `uid` on `mask`.
+
+        :param str uid: The subscribing client's uid;
+        :param str mask: A MQTT valid subscription mask;
+        :param int qos: The granted QoS level.
+        """
+        group_name, topic_filter = MQTTUtils.split_shared_subscription(mask)
+        if group_name is not None:
+            self._add_shared(uid, mask, qos, group_name, topic_filter)
+            return
+
+        node = self._root
+        for level in mask.split('/'):
+            node = node.get_or_create(level)
+
+        if uid not in node.subscribers:
+            self.filters.acquire(mask)
+
+        node.subscribers[uid] = qos
+        self._client_masks.setdefault(uid, dict())[mask] = qos
+
+        self.plans.invalidate(mask, self.filters)
+        self.unsubscribed.invalidate(mask, self.filters)
+
+    def remove(self, uid, mask):
+        """
+        Removes the subscription of the client `uid` on `mask`. It's safe to
+        call this method for unknown subscriptions.
+        """
+        masks = self._client_masks.get(uid)
+        if masks is None or mask not in masks:
+            return
+
+        del masks[mask]
+        if not masks:
+            del self._client_masks[uid]
+
+        group_name, topic_filter = MQTTUtils.split_shared_subscription(mask)
+        levels = topic_filter.split('/')
+
+        path = [self._root]
+        for level in levels:
+            path.append(path[-1].get(level))
+
+        if group_name is None:
+            del path[-1].subscribers[uid]
+            self.plans.invalidate(mask, self.filters)
+        else:
+            self._remove_shared(uid, path[-1], group_name, topic_filter)
+
+        # prunes the nodes left without subscribers or descendants
+        for i in range(len(levels), 0, -1):
+            if not path[i].is_empty():
+                break
+            path[i - 1].discard(levels[i - 1])
+
+        self.filters.release(mask)
+
+    def _add_shared(self, uid, mask, qos, group_name, topic_filter):
+        node = self._root
+        for level in topic_filter.split('/'):
+            node = node.get_or_create(level)
+
+        if node.groups is None:
+            node.groups = dict()
+
+        group = node.groups.get(group_name)
+        if group is None:
+            group = node.groups[group_name] = SharedGroup(group_name,
+                                                          topic_filter)
+            self._groups_count += 1
+            self.shared_plans.invalidate(topic_filter)
+            self.unsubscribed.invalidate(topic_filter)
+
+        if uid not in group.members:
+            self.filters.acquire(mask)
+
+        group.add(uid, qos)
+        self._client_masks.setdefault(uid, dict())[mask] = qos
+
+    def _remove_shared(self, uid, node, group_name, topic_filter):
+        group = node.groups[group_name]
+        group.remove(uid)
+
+        if not group.members:
+            del node.groups[group_name]
+            if not node.groups:
+                node.groups = None
+
+            self._groups_count -= 1
+            self.shared_plans.invalidate(topic_filter)
+
+    def remove_client(self, uid):
+        """
+        Removes all the subscriptions of the client `uid`.
+        """
+        for mask in tuple(self._client_masks.get(uid, ())):
+            self.remove(uid, mask)
+
+    def masks(self, uid):
+        """
+        Gets the subscription masks (and their QoS) indexed for a client.
+
+        :return: a dict[mask, qos]
+        """
+        return dict(self._client_masks.get(uid, ()))
+
+    def __len__(self):
+        return sum(len(masks) for masks in self._client_masks.values())
+
+    def has_subscribers(self, topic):
+        """
+        Checks whether any subscription, shared or not, matches `topic`. The
+        trie is walked without collecting the matches, and the walk stops on
+        the first one: the root's children are the first levels subscribed
+        on, so most topics without subscribers are told apart on their first
+        level. The checks are counted, see :meth:`stats`.
+
+        :param str topic: The topic of a published message.
+        :rtype: bool
+        """
+        found = bool(self._client_masks) and \
+            '+' not in topic and '#' not in topic and \
+            self._root.has_match(topic.split('/'), 0)
+
+        if found:
+            self.routed += 1
+        else:
+            self.skipped += 1
+
+        return found
+
+    def stats(self):
+        """
+        :return: a dict with the counts of the topics checked by
+          :meth:`has_subscribers` or :meth:`route` that were routed and
+          skipped, and the skipped ratio.
+        """
+        checked = self.routed + self.skipped
+        return {
+            'routed': self.routed,
+            'skipped': self.skipped,
+            'skipped_ratio': self.skipped / checked if checked else 0.0,
+        }
+
+    def match(self, topic):
+        """
+        Finds the subscriptions matching `topic`.
+
+        :param str topic: The topic of a published message.
+        :rtype: dict
+        :return: A dict mapping each matching client uid to the list of the
+          QoS levels of its matching subscriptions, ie {'uid': [0, 2]}. With
+          :attr:`single_delivery` set, the list only holds the maximum QoS,
+          ie {'uid': [2]}.
+        """
+        matches = dict()
+
+        # wildcard characters are not allowed on topic names, thus such a
+        # topic can't match any subscription
+        if '+' not in topic and '#' not in topic:
+            self._root.collect(topic.split('/'), 0, matches, self._extend)
+
+        return matches
+
+    def resolve(self, topic):
+        """
+        Gets the delivery plan of `topic`: the same matches of :meth:`match`,
+        as a tuple of (uid, tuple of QoS levels) pairs. Plans are cached until
+        a subscription matching the topic is added or removed.
+
+        :param str topic: The topic of a published message.
+        :rtype: tuple
+        """
+        plan = self.plans.get(topic)
+
+        if plan is None:
+            plan = self._build_plan(topic)
+
+        return plan
+
+    def route(self, topic):
+        """
+        Gets the delivery plan and the shared subscription groups of `topic`,
+        as returned by :meth:`resolve` and :meth:`resolve_shared`. The cached
+        plan is looked up first, and only on a miss is the topic checked by
+        :meth:`has_subscribers`: a topic without subscribers is cached in
+        :attr:`unsubscribed`, so its next publishes skip the trie. The routed
+        topics are counted, see :meth:`stats`.
+
+        :param str topic: The topic of a published message.
+        :rtype: tuple
+        :return: A (plan, groups) pair, both empty if nobody subscribed on
+          `topic`.
+        """
+        plan = self.plans.get(topic)
+
+        if plan is None:
+            if self.unsubscribed.get(topic) is not None:
+                self.skipped += 1
+                return (), ()
+
+            if not self.has_subscribers(topic):
+                self.unsubscribed.put(topic, ())
+                return (), ()
+
+            return self._build_plan(topic), self.resolve_shared(topic)
+
+        groups = self.resolve_shared(topic)
+        if plan or groups:
+            self.routed += 1
+        else:
+            self.skipped += 1
+
+        return plan, groups
+
+    def _build_plan(self, topic):
+        plan = tuple((uid, tuple(qos_list))
+                     for uid, qos_list in self.match(topic).items())
+        self.plans.put(topic, plan)
+
+        return plan
+
+    def resolve_shared(self, topic):
+        """
+        Gets the shared subscription groups matching `topic`, each of them to
+        deliver the message to one of its members. The groups are cached as
+        the plans of :meth:`resolve`.
+
+        :param str topic: The topic of a published message.
+        :rtype: tuple[SharedGroup]
+        """
+        if not self._groups_count:
+            return ()
+
+        plan = self.shared_plans.get(topic)
+
+        if plan is None:
+            groups = []
+            if '+' not in topic and '#' not in topic:
+                self._root.collect_groups(topic.split('/'), 0, groups)
+
+            plan = tuple(groups)
+            self.shared_plans.put(topic, plan)
+
+        return plan
+
+
+class SharedGroup():
+    """
+    The members of a shared subscription group on a topic filter, each
+    message matching the filter being delivered to one of them. The members
+    are rotated by :meth:`rotation` and :meth:`picked`, to balance the
+    messages between them.
+    """
+    __slots__ = ('name', 'topic_filter', 'members', '_order', '_cursor')
+
+    def __init__(self, name, topic_filter):
+        self.name = name
+        self.topic_filter = topic_filter
+
+        # uid -> granted QoS
+        self.members = dict()
+
+        self._order = []
+        self._cursor = 0
+
+    def __repr__(self):
+        return '<%s %r on %r>' % (self.__class__.__name__, self.name,
+                                  self.topic_filter)
+
+    def add(self, uid, qos):
+        if uid not in self.members:
+            self._order.append(uid)
+        self.members[uid] = qos
+
+    def remove(self, uid):
+        if uid in self.members:
+            del self.members[uid]
+
+            index = self._order.index(uid)
+            del self._order[index]
+            if index < self._cursor:
+                self._cursor -= 1
+
+    def rotation(self):
+        """
+        Gets the members uids, starting with the one next to the last picked.
+
+        :rtype: list
+        """
+        cursor = self._cursor % len(self._order) if self._order else 0
+        return self._order[cursor:] + self._order[:cursor]
+
+    def picked(self, uid):
+        """
+        Marks `uid` as the last member a message was delivered to.
+        """
+        self._cursor = self._order.index(uid) + 1
+
+
+class DeliveryPlanCache():
+    """
+    A bounded LRU cache mapping concrete topics to their delivery plans. The
+    cache doesn't observe the subscriptions itself: :meth:`invalidate` must
+    be called whenever a subscription on a mask is added, updated or removed.
+
+    :param int maxsize: How many plans are kept. Zero disables the cache.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._plans = OrderedDict()
+
+    def __len__(self):
+        return len(self._plans)
+
+    def __contains__(self, topic):
+        return topic in self._plans
+
+    def get(self, topic):
+        plan = self._plans.get(topic)
+
+        if plan is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._plans.move_to_end(topic)
+
+        return plan
+
+    def put(self, topic, plan):
+        if self.maxsize <= 0:
+            return
+
+        self._plans[topic] = plan
+        self._plans.move_to_end(topic)
+
+        if len(self._plans) > self.maxsize:
+            self._plans.popitem(last=False)
+
+    def invalidate(self, mask, filters=None):
+        """
+        Drops the plans of the cached topics matched by `mask`.
+
+        :param TopicFilterStore filters: Where the filter of `mask` is taken
+          from, if it's acquired there.
+        """
+        if not self._plans:
+            return
+
+        if '+' not in mask and '#' not in mask:
+            self._plans.pop(mask, None)
+            return
+
+        if filters is not None and mask in filters:
+            topic_filter = filters.get(mask)
+        else:
+            topic_filter = TopicFilter(mask)
+        for topic in [t for t in self._plans if topic_filter.match(t)]:
+            del self._plans[topic]
+
+    def clear(self):
+        self._plans.clear()
+
+    def stats(self):
+        """
+        :return: a dict with the cache size and its hit/miss counters.
+        """
+        return {
+            'size': len(self._plans),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class TopicFilterStore():
+    """
+    Broker-wide store of :class:`TopicFilter`, interned by mask and shared by
+    every subscription on the same mask. Each subscription holds a reference,
+    see :meth:`acquire`, and the filter is dropped once its last reference is
+    released. Filters are only built when first requested with :meth:`get`,
+    so masks never matched by the clients (ie the dormant sessions') cost no
+    more than their reference count.
+    """
+    def __init__(self):
+        # mask -> [references, filter or None]
+        self._entries = dict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, mask):
+        return mask in self._entries
+
+    def acquire(self, mask):
+        """
+        Adds a reference to the filter of `mask`.
+        """
+        entry = self._entries.get(mask)
+
+        if entry is None:
+            entry = self._entries[mask] = [0, None]
+
+        entry[0] += 1
+
+    def release(self, mask):
+        """
+        Drops a reference to the filter of `mask`, discarding the filter with
+        its last reference. It's safe to call this method for unknown masks.
+        """
+        entry = self._entries.get(mask)
+
+        if entry is not None:
+            entry[0] -= 1
+            if entry[0] <= 0:
+                del self._entries[mask]
+
+    def references(self, mask):
+        """
+        Gets the count of references to the filter of `mask`.
+        """
+        entry = self._entries.get(mask)
+        return entry[0] if entry is not None else 0
+
+    def get(self, mask):
+        """
+        Gets the shared filter of `mask`, which must be acquired. The filter
+        of a shared subscription mask matches the topics of its filter.
+
+        :rtype: TopicFilter
+        """
+        entry = self._entries[mask]
+
+        if entry[1] is None:
+            _, topic_filter = MQTTUtils.split_shared_subscription(mask)
+            entry[1] = TopicFilter(topic_filter)
+
+        return entry[1]
+
+
+class _TopicNode():
+    __slots__ = ('children', 'single_level', 'multi_level', 'subscribers',
+                 'groups')
+
+    def __init__(self):
+        self.children = dict()
+        self.single_level = None
+        self.multi_level = None
+        self.subscribers = dict()
+
+        # name -> SharedGroup, created on the first shared subscription
+        self.groups = None
+
+    def get(self, level):
+        if level == '+':
+            return self.single_level
+        elif level == '#':
+            return self.multi_level
+        else:
+            return self.children.get(level)
+
+    def get_or_create(self, level):
+        node = self.get(level)
+
+        if node is None:
+            node = _TopicNode()
+            if level == '+':
+                self.single_level = node
+            elif level == '#':
+                self.multi_level = node
+            else:
+                self.children[level] = node
+
+        return node
+
+    def discard(self, level):
+        if level == '+':
+            self.single_level = None
+        elif level == '#':
+            self.multi_level = None
+        else:
+            self.children.pop(level, None)
+
+    def is_empty(self):
+        return not self.subscribers and not self.children and \
+            self.single_level is None and self.multi_level is None and \
+            self.groups is None
+
+    def collect(self, levels, depth, matches, extend):
+        # '#' also matches the parent level, ie 'foo/#' matches 'foo'
+        if self.multi_level is not None:
+            extend(matches, self.multi_level.subscribers)
+
+        if depth == len(levels):
+            extend(matches, self.subscribers)
+            return
+
+        level = levels[depth]
+
+        child = self.children.get(level)
+        if child is not None:
+            child.collect(levels, depth + 1, matches, extend)
+
+        if self.single_level is not None:
+            self.single_level.collect(levels, depth + 1, matches, extend)
+
+    def has_match(self, levels, depth):
+        # '#' nodes have no children, thus an existing one has subscriptions
+        # as the empty nodes are pruned
+        if self.multi_level is not None:
+            return True
+
+        if depth == len(levels):
+            return bool(self.subscribers) or self.groups is not None
+
+        child = self.children.get(levels[depth])
+        if child is not None and child.has_match(levels, depth + 1):
+            return True
+
+        return self.single_level is not None and \
+            self.single_level.has_match(levels, depth + 1)
+
+    def collect_groups(self, levels, depth, groups):
+        # the same walk of :meth:`collect`, on the shared subscriptions
+        if self.multi_level is not None and \
+                self.multi_level.groups is not None:
+            groups.extend(self.multi_level.groups.values())
+
+        if depth == len(levels):
+            if self.groups is not None:
+                groups.extend(self.groups.values())
+            return
+
+        level = levels[depth]
+
+        child = self.children.get(level)
+        if child is not None:
+            child.collect_groups(levels, depth + 1, groups)
+
+        if self.single_level is not None:
+            self.single_level.collect_groups(levels, depth + 1, groups)
+
+
+def _extend(matches, subscribers):
+    for uid, qos in subscribers.items():
+        matches.setdefault(uid, []).append(qos)
+
+
+def _extend_max(matches, subscribers):
+    # keeps a single QoS per client, the maximum of its subscriptions
+    for uid, qos in subscribers.items():
+        current = matches.get(uid)
+        if current is None:
+            matches[uid] = [qos]
+        elif qos > current[0]:
+            current[0] = qos
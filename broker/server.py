@@ -1,4 +1,9 @@
 import tornado.concurrent
+from collections import OrderedDict
+from sys import intern
+from time import time
+
+from tornado.ioloop import IOLoop
 from tornado.iostream import StreamClosedError
 from tornado.tcpserver import TCPServer
 from tornado.log import access_log
@@ -7,12 +12,13 @@ from logging import getLogger
 import toro
 from broker import MQTTConstants
 from broker.access_control import NoAuthentication, Authorization
-from broker.client import MQTTClient
+from broker.client import MQTTClient, DormantSession
 from broker.exceptions import ConnectError
 from broker.messages import Publish, Connect, Connack, Subscribe
 from broker.connection import MQTTConnection
 from broker.factory import MQTTMessageFactory
-from broker.persistence import InMemoryPersistence
+from broker.persistence import InMemoryPersistence, get_many
+from broker.routing import SubscriptionIndex
 from paho.mqtt.paho_partner_pair import Paho_Partner_Pair
 
 client_logger = getLogger('activity.clients')
@@ -27,21 +33,52 @@ class MQTTServer(TCPServer):
     """
 
     def __init__(self, authentication=None, persistence=None, clients=None,
-                 ssl_options=None):
+                 ssl_options=None, subscriptions=None, write_budget=64 * 1024,
+                 max_inflight=1, client_max_inflight=None,
+                 retained_messages=None, shared_balancing='round_robin'):
         super().__init__(ssl_options=ssl_options)
 
+        # how many bytes of ready packets a client may coalesce in one write
+        self.write_budget = write_budget
+
+        # the in-flight window of the clients connected to this listener,
+        # unless overridden per client uid
+        self.max_inflight = max_inflight
+        self.client_max_inflight = client_max_inflight or dict()
+
+        # how the members of a shared subscription group are picked:
+        # 'round_robin', or 'least_outstanding' to pick the connected member
+        # with the shortest outgoing queue
+        assert shared_balancing in ('round_robin', 'least_outstanding')
+        self.shared_balancing = shared_balancing
+
         self.clients = clients if clients is not None else dict()
         assert isinstance(self.clients, dict)
 
+        # uid -> DormantSession, for the persistent sessions whose client is
+        # disconnected and that publishes were routed to. These records are
+        # views of the persistence, so servers may keep their own
+        self.dormant_sessions = dict()
+
+        # servers sharing the `clients` dict must share the index as well
+        self.subscriptions = subscriptions if subscriptions is not None \
+            else SubscriptionIndex()
+        assert isinstance(self.subscriptions, SubscriptionIndex)
+
         self.persistence = persistence or InMemoryPersistence()
         self.authentication = authentication or NoAuthentication()
 
         self.recreate_sessions(self.persistence.get_client_uids())
 
-        self._retained_messages = RetainedMessages(self.persistence.get_retained_messages())
+        # as the index, the retained messages must be shared by the servers
+        # sharing a persistence
+        self._retained_messages = retained_messages if \
+            retained_messages is not None else \
+            RetainedMessages(self.persistence.get_retained_messages())
         assert isinstance(self._retained_messages, RetainedMessages)
 
-        self.hacked_topic_list = []
+        # the (topic, qos) pairs published, checked on each publish
+        self.hacked_topic_list = set()
         self.paho_partner_pair = None  # Paho_Partner_Pair(external_address="m2m.eclipse.org")
         self.uplink = None  # self.paho_partner_pair.internal_client
 
@@ -58,10 +95,67 @@ class MQTTServer(TCPServer):
         return not self.paho_partner_pair is None
 
     def recreate_sessions(self, uids):
-        access_log.info("recreating %s sessions" % len(uids))
-        for uid in uids:
-            if uid not in self.clients:
-                self.add_client(self.recreate_client(str(uid)))
+        """
+        Indexes the subscriptions of the persisted sessions. Their clients are
+        only recreated once they connect, see :meth:`wake_session`, so the
+        sessions left dormant cost no more than their subscriptions.
+        """
+        access_log.info("indexing %s persisted sessions" % len(uids))
+        for uid, mask, qos in self.persistence.get_subscriptions(uids):
+            self.subscriptions.add(uid, mask, qos)
+
+    def wake_session(self, uid):
+        """
+        Recreates and registers the client of a dormant session: one that is
+        persisted, but whose client is disconnected.
+
+        :param str uid: The client's uid.
+        :return: The client, or None if no session is persisted for `uid`.
+        """
+        if uid not in self.persistence.get_client_uids():
+            return None
+
+        self.dormant_sessions.pop(uid, None)
+        client = self.recreate_client(uid)
+        self.add_client(client)
+        access_log.info("[uid: %s] dormant session recreated" % uid)
+
+        return client
+
+    def get_dormant_session(self, uid):
+        """
+        Gets the record of a dormant session, to route publishes to.
+
+        :param str uid: The client's uid.
+        :return: A :class:`DormantSession`, or None if no session is persisted
+          for `uid`.
+        """
+        session = self.dormant_sessions.get(uid)
+
+        if session is None and uid in self.persistence.get_client_uids():
+            session = DormantSession(uid, self.persistence.get_for_client(uid))
+            self.dormant_sessions[uid] = session
+
+        return session
+
+    def client_disconnected(self, client):
+        """
+        Called by a persistent client upon disconnection. Unless it reconnects
+        meanwhile (ie. a connection taking over its previous one), its session
+        is made dormant on the next IOLoop iteration, dropping the client.
+
+        :param MQTTClient client: A :class:`broker.client.MQTTClient` instance.
+        """
+        IOLoop.current().add_callback(self._make_dormant, client)
+
+    def _make_dormant(self, client):
+        if self.clients.get(client.uid) is client and \
+                not client.is_connected():
+            del self.clients[client.uid]
+            self.dormant_sessions[client.uid] = DormantSession(
+                client.uid, client.persistence, time())
+
+            access_log.info("[uid: %s] session made dormant" % client.uid)
 
     def get_known_client(self, connect_msg):
         """
@@ -77,7 +171,8 @@ class MQTTServer(TCPServer):
         """
         assert isinstance(connect_msg, Connect)
 
-        client = self.clients.get(connect_msg.client_uid)
+        client = self.clients.get(connect_msg.client_uid) or \
+            self.wake_session(connect_msg.client_uid)
         if client is not None:
             assert isinstance(client, MQTTClient)
             if connect_msg.clean_session:
@@ -113,6 +208,7 @@ class MQTTServer(TCPServer):
                 clean_session=msg.clean_session,
                 keep_alive=msg.keep_alive,
                 persistence=client_persistence,
+                max_inflight=self.get_max_inflight(msg.client_uid),
         )
 
         # verbosity... testing
@@ -129,7 +225,8 @@ class MQTTServer(TCPServer):
                 connection=None,
                 uid=client_uid,
                 clean_session=False,
-                persistence=self.persistence.get_for_client(client_uid)
+                persistence=self.persistence.get_for_client(client_uid),
+                max_inflight=self.get_max_inflight(client_uid),
         )
 
     def update_client(self, connection, msg, authorization, client):
@@ -137,12 +234,22 @@ class MQTTServer(TCPServer):
                 clean_session=msg.clean_session,
                 keep_alive=msg.keep_alive
         )
+        # the client may be reconnecting through another listener
+        client.max_inflight = self.get_max_inflight(client.uid)
+
         client.update_connection(connection)
         client.update_authorization(authorization)
 
         access_log.info("[uid: %s] Reconfigured client upon "
                         "reconnection." % client.uid)
 
+    def get_max_inflight(self, uid):
+        """
+        Gets the in-flight window of a client: how many QoS 1 and 2 publishes
+        may be sent to it before the first one is acknowledged.
+        """
+        return self.client_max_inflight.get(uid, self.max_inflight)
+
     def configure_last_will(self, client, connect_msg):
         """
         Configures the last will message options for a given client on its
@@ -237,7 +344,9 @@ class MQTTServer(TCPServer):
         yield connection.write_message(ack)
 
     def is_session_present(self, msg):
-        return not msg.clean_session and msg.client_uid in self.clients
+        return not msg.clean_session and (
+            msg.client_uid in self.clients or
+            msg.client_uid in self.persistence.get_client_uids())
 
     def add_client(self, client):
         """
@@ -261,30 +370,39 @@ class MQTTServer(TCPServer):
         """
         assert isinstance(client, MQTTClient)
 
+        self.subscriptions.remove_client(client.uid)
         self.persistence.remove_client_data(client.uid)
+        self.dormant_sessions.pop(client.uid, None)
 
         if client.uid in self.clients:
             del self.clients[client.uid]
             access_log.info("[uid: %s] session cleaned" % client.uid)
 
-    def dispatch_message(self, client, msg, cache=None):
+    def dispatch_message(self, client, msg, cache=None, qos_list=None):
         """
         Dispatches a message to a client based on its subscriptions. It is safe
         to call this method without checking if the client has matching
         subscriptions.
 
         :param MQTTClient client: The client which will possibly receive the
-          message;
+          message, or the :class:`DormantSession` of a disconnected one;
         :param Publish msg: The message to be delivered.
         :param dict cache: A dict that will be used for raw data caching.
           Defaults to a empty dictionary if None.
+        :param list qos_list: The QoS levels of the client's subscriptions
+          matching the message, as resolved by :attr:`self.subscriptions`. If
+          None, the client's subscriptions are matched against the message
+          (for a :class:`MQTTClient` only).
         """
         assert isinstance(msg, Publish)
-        assert isinstance(client, MQTTClient)
-        assert client.uid in self.clients
+        assert isinstance(client, (MQTTClient, DormantSession))
 
         cache = cache if cache is not None else {}
-        qos_list = client.get_list_of_delivery_qos(msg)
+
+        if qos_list is None:
+            qos_list = client.get_list_of_delivery_qos(msg)
+        else:
+            qos_list = [min(qos, msg.qos) for qos in qos_list]
 
         for qos in qos_list:
 
@@ -311,7 +429,7 @@ class MQTTServer(TCPServer):
         # 1.
         if not (msg.topic, msg.qos) in self.hacked_topic_list:
             print("Added Topic to Publishlist: {} QoS: {} Payload: {}".format(msg.topic, msg.qos, msg.payload))
-            self.hacked_topic_list.append((msg.topic, msg.qos))
+            self.hacked_topic_list.add((msg.topic, msg.qos))
         # 2.
         if not self.has_uplink():
             return
@@ -333,7 +451,11 @@ class MQTTServer(TCPServer):
     def broadcast_message(self, msg, sender_uid):
         """
         Broadcasts a message to all clients with matching subscriptions,
-        respecting the subscription QoS and restrictions on packet loops.
+        respecting the subscription QoS and restrictions on packet loops. Only
+        the subscribers resolved by :attr:`self.subscriptions` are visited, and
+        repeated publishes on a topic reuse its cached delivery plan, even an
+        empty one. Messages on topics without subscribers are only passed to
+        the uplink.
 
         :param Publish msg: A :class:`broker.messages.Publish` instance.
         :param MQTTClient sender: The client which sent the message.
@@ -341,6 +463,12 @@ class MQTTServer(TCPServer):
         assert isinstance(msg, Publish)
         assert isinstance(sender_uid, str)
 
+        # most telemetry topics have no subscribers, they skip the routing
+        plan, groups = self.subscriptions.route(msg.topic)
+        if not plan and not groups:
+            self.decide_uplink_publish(msg, sender_uid)
+            return
+
         # Broadcasted messages must always be delivered with the retain flag
         # set to false to clients which are plain clients (non-brokers)
         msg_reduced = msg.copy()
@@ -348,18 +476,75 @@ class MQTTServer(TCPServer):
 
         cache = {}
 
-        for client in self.clients.values():
+        for uid, qos_list in plan:
+            client = self.clients.get(uid) or self.get_dormant_session(uid)
+            if client is None:
+                continue
+
             # XXX Packet loop restriction #4: no forwarding to sender if sender
             # also receives subscriptions.
             if client.uid == sender_uid and client.receive_subscriptions:
                 continue
             if client.is_broker():
-                self.dispatch_message(client, msg, cache)
+                self.dispatch_message(client, msg, cache, qos_list)
             else:
-                self.dispatch_message(client, msg_reduced, cache)
+                self.dispatch_message(client, msg_reduced, cache, qos_list)
+
+        for group in groups:
+            client = self.pick_shared_member(group, sender_uid)
+            if client is None:
+                continue
+
+            qos_list = (group.members[client.uid], )
+            if client.is_broker():
+                self.dispatch_message(client, msg, cache, qos_list)
+            else:
+                self.dispatch_message(client, msg_reduced, cache, qos_list)
         # print("CALL DECIDE UPLINK PUBLISH")
         self.decide_uplink_publish(msg, sender_uid)
 
+    def pick_shared_member(self, group, sender_uid):
+        """
+        Picks the member of a shared subscription group to deliver a message
+        to, as set by :attr:`self.shared_balancing`. Connected members are
+        preferred; the message is queued on a disconnected member's session
+        only if no member is connected.
+
+        :param SharedGroup group: A group resolved by :attr:`self.subscriptions`.
+        :param str sender_uid: The uid of the message's sender.
+        :return: A :class:`MQTTClient` or :class:`DormantSession`, or None if
+          the group has no member to deliver to.
+        """
+        picked = None
+        disconnected = None
+
+        for uid in group.rotation():
+            client = self.clients.get(uid) or self.get_dormant_session(uid)
+            if client is None:
+                continue
+
+            # XXX Packet loop restriction #4: no forwarding to sender if sender
+            # also receives subscriptions.
+            if uid == sender_uid and client.receive_subscriptions:
+                continue
+
+            if not client.is_connected():
+                disconnected = disconnected or client
+
+            elif self.shared_balancing == 'round_robin':
+                picked = client
+                break
+
+            elif picked is None or \
+                    client.outgoing_queue.depth < picked.outgoing_queue.depth:
+                picked = client
+
+        picked = picked or disconnected
+        if picked is not None:
+            group.picked(picked.uid)
+
+        return picked
+
     def forward_subscription(self, topic, granted_qos, sender_uid):
         """
         :param topic_qos: A list of topic-qos-pairs to forward.
@@ -426,6 +611,9 @@ class MQTTServer(TCPServer):
 
         :param Publish msg: The Publish message to be processed.
         :param MQTTClient sender: The client which sent the message.
+        :return: A Future resolved once the message is persisted for its
+          subscribers, or None if it already is (see
+          :meth:`PersistenceBase.sync`).
         """
         assert isinstance(sender_uid, str)
 
@@ -435,6 +623,8 @@ class MQTTServer(TCPServer):
         # access_log.info("[.....] broadcasting payload: \"%s\"" % msg.payload)
         self.broadcast_message(msg, sender_uid)
 
+        return self.persistence.sync()
+
     def enqueue_retained_message(self, client, subscription_mask):
         """
         Enqueues all retained messages matching the `subscription_mask` to be
@@ -444,26 +634,20 @@ class MQTTServer(TCPServer):
         :param str subscription_mask: The subscription mask to match the
           messages against.
         """
-
-        # print(self._retained_messages._messages)
         assert isinstance(client, MQTTClient)
-        for e in self._retained_messages.items():
-            print("INFO: {}".format(e))
-        for topic, (message, sender_uid) in self._retained_messages.items():
+        max_qos = client.subscriptions.qos(subscription_mask)
+
+        for msg, sender_uid in self._retained_messages.match(subscription_mask):
             # XXX Packet loop restriction #4: no forwarding to sender if sender
             # also receives subscriptions.
             if client.uid == sender_uid and client.receive_subscriptions:
                 continue
 
-            if message is not None:
-                msg_obj = Publish.from_bytes(message)
-                qos = client.get_matching_qos(msg_obj, subscription_mask)
-
-                if qos is not None:
-                    # creates a copy of the object to avoid reference errors
-                    msg_copy = msg_obj.copy()
-                    msg_copy.qos = qos
-                    client.publish(msg_copy)
+            # the copies share the decoded topic and payload, only their
+            # header is encoded again
+            msg_copy = msg.copy()
+            msg_copy.qos = min(max_qos, msg.qos)
+            client.publish(msg_copy)
 
 
 class stream_handle_context():
@@ -501,16 +685,227 @@ class stream_handle_context():
 
 
 class RetainedMessages():
-    def __init__(self, retained_messages):
+    """
+    The retained messages, persisted on `retained_messages` (a dict[topic,
+    (raw_data, sender_uid)]) and indexed on a trie of topic levels, so
+    :meth:`match` only visits the retained topics matching a subscription
+    mask instead of every retained message.
+
+    The messages are kept in two tiers: the persistence holds all of them,
+    while the most recently saved or matched ones are also kept in memory,
+    decoded, up to `max_bytes` of raw data. The least recently used are
+    evicted from memory first and read from the persistence again once
+    matched, those of a subscription mask in a single lookup (see
+    :func:`broker.persistence.get_many`). Only the topics are loaded on
+    init.
+
+    :param int max_bytes: The raw data size of the messages kept in memory,
+      unbounded if None.
+    """
+    def __init__(self, retained_messages, max_bytes=None):
         self._messages = retained_messages
+        self._root = _RetainedNode()
+
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # topic -> node, in the least recently used order
+        self._hot = OrderedDict()
+        self._hot_bytes = 0
+
+        for topic in self._messages.keys():
+            self._get_or_create(topic).topic = topic
 
     def save(self, msg, sender_uid):
         assert isinstance(msg, Publish)
-        if len(msg.payload) == 0:
+        # the payload of a received message is left undecoded
+        if msg.payload_length == 0:
             if msg.topic in self._messages:
                 del self._messages[msg.topic]
+            self._discard(msg.topic)
         else:
             self._messages[msg.topic] = (msg.raw_data, sender_uid)
 
+            node = self._get_or_create(msg.topic)
+            node.topic = msg.topic
+            self._load(node, msg.raw_data, sender_uid)
+
     def items(self):
         return self._messages.items()
+
+    def __len__(self):
+        return len(self._messages)
+
+    def match(self, mask):
+        """
+        Finds the retained messages matching the subscription `mask`.
+
+        :param str mask: A MQTT valid subscription mask.
+        :return: an iterable of (Publish, sender_uid). The messages must be
+          copied before being changed.
+        """
+        nodes = []
+        self._root.collect(mask.split('/'), 0, nodes)
+
+        # the messages missing from memory are read from the persistence
+        # together; loading them may evict the others before they're
+        # yielded, thus those are kept aside as well
+        cold = [node for node in nodes if node.raw_data is None]
+        stored = dict()
+        if cold:
+            stored.update(zip(cold, get_many(self._messages,
+                                             [node.topic for node in cold])))
+
+        for node in nodes:
+            if node.raw_data is not None:
+                stored[node] = node.raw_data, node.sender_uid
+
+        self.hits += len(nodes) - len(cold)
+        self.misses += sum(1 for node in cold if stored[node] is not None)
+
+        for node in nodes:
+            message = stored[node]
+            if message is None:
+                continue
+
+            if node.raw_data is None:
+                self._load(node, *message)
+            else:
+                self._hot.move_to_end(node.topic)
+
+            yield node.get_message(), node.sender_uid
+
+    def stats(self):
+        """
+        :return: a dict with the count and size of the messages kept in
+          memory, their hit/miss counters and the evictions count.
+        """
+        return {
+            'size': len(self._hot),
+            'bytes': self._hot_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def _load(self, node, raw_data, sender_uid):
+        self._unload(node)
+
+        node.set(raw_data, sender_uid)
+        self._hot[node.topic] = node
+        self._hot_bytes += len(raw_data)
+
+        # the message just loaded is kept, even if it exceeds the budget
+        if self.max_bytes is not None:
+            while self._hot_bytes > self.max_bytes and len(self._hot) > 1:
+                _, evicted = self._hot.popitem(last=False)
+                self._unload(evicted)
+                self.evictions += 1
+
+    def _unload(self, node):
+        if node.raw_data is not None:
+            self._hot.pop(node.topic, None)
+            self._hot_bytes -= len(node.raw_data)
+            node.set(None, None)
+
+    def _get_or_create(self, topic):
+        node = self._root
+        for level in topic.split('/'):
+            if node.children is None:
+                node.children = dict()
+
+            child = node.children.get(level)
+            if child is None:
+                # the levels repeated across topics, ie 'status' on
+                # 'devices/+/status', are kept once
+                child = node.children[intern(level)] = _RetainedNode()
+            node = child
+
+        return node
+
+    def _discard(self, topic):
+        levels = topic.split('/')
+        path = [self._root]
+        for level in levels:
+            node = path[-1].children and path[-1].children.get(level)
+            if node is None:
+                return
+            path.append(node)
+
+        self._unload(path[-1])
+        path[-1].topic = None
+
+        # prunes the nodes left without messages or children
+        for i in range(len(levels), 0, -1):
+            if path[i].topic is not None or path[i].children:
+                break
+            del path[i - 1].children[levels[i - 1]]
+
+
+class _RetainedNode():
+    """
+    A topic level of :class:`RetainedMessages`. The nodes of retained topics
+    have their `topic` set, and their message while it's kept in memory. The
+    `children` dict is only created for the nodes with children.
+    """
+    __slots__ = ('children', 'topic', 'raw_data', 'sender_uid', '_message')
+
+    def __init__(self):
+        self.children = None
+        self.topic = None
+        self.raw_data = None
+        self.sender_uid = None
+        self._message = None
+
+    def set(self, raw_data, sender_uid):
+        self.raw_data = raw_data
+        self.sender_uid = sender_uid
+        self._message = None
+
+    def get_message(self):
+        if self._message is None:
+            self._message = Publish.from_bytes(self.raw_data)
+        return self._message
+
+    def collect(self, levels, depth, nodes):
+        """
+        Appends to `nodes` the descendants holding a retained topic matching
+        the mask `levels`, from `depth` on.
+        """
+        if depth == len(levels):
+            if self.topic is not None:
+                nodes.append(self)
+            return
+
+        level = levels[depth]
+
+        if level == '#':
+            # '#' also matches the parent level, ie 'foo/#' matches 'foo'
+            if self.topic is not None:
+                nodes.append(self)
+            if self.children:
+                for child in self.children.values():
+                    child.collect_all(nodes)
+
+        elif not self.children:
+            return
+
+        elif level == '+':
+            for child in self.children.values():
+                child.collect(levels, depth + 1, nodes)
+
+        else:
+            child = self.children.get(level)
+            if child is not None:
+                child.collect(levels, depth + 1, nodes)
+
+    def collect_all(self, nodes):
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.topic is not None:
+                nodes.append(node)
+            if node.children:
+                stack.extend(node.children.values())
@@ -1,10 +1,13 @@
 import re
 from hashlib import sha256
+from operator import itemgetter
 
 from broker import MQTTConstants
 
 
 class MQTTUtils:
+    SHARED_SUBSCRIPTION_PREFIX = '$share/'
+
     def __init__(self):
         raise RuntimeError("One should not instantiate this class")
 
@@ -107,11 +110,47 @@ class MQTTUtils:
                 ereg = re.sub("(/?)#\$", "(\g<1>[^\x00#+]*$|$)", ereg)
             return ereg
 
+    @classmethod
+    def compile_filter(cls, subscription_mask, allow_wildcards=False):
+        """
+        Regex-free counterpart of :meth:`convert_to_ereg`. Returns a
+        :class:`TopicFilter` for a valid `subscription_mask`, None otherwise.
+        """
+        if cls.subscription_is_valid(subscription_mask):
+            return TopicFilter(subscription_mask, allow_wildcards)
+
     @classmethod
     def subscription_is_valid(cls, subscription_mask):
+        group, topic_filter = cls.split_shared_subscription(subscription_mask)
+        if group is not None:
+            if not group or '+' in group or '#' in group:
+                return False
+            subscription_mask = topic_filter
+
         pattern = "^(([^\x00#+/]+|\+|)(/[^\x00#+/]+|/\+|/)*(/#|/)?|#)$"
         return re.match(pattern, subscription_mask) is not None
 
+    @classmethod
+    def split_shared_subscription(cls, subscription_mask):
+        """
+        Splits a ``$share/<group>/<filter>`` shared subscription mask into its
+        group name and topic filter.
+
+        :return: a tuple of (group, filter), or (None, subscription_mask) for
+          non shared subscriptions. The group is empty if the mask has no
+          filter.
+        """
+        if not subscription_mask.startswith(cls.SHARED_SUBSCRIPTION_PREFIX):
+            return None, subscription_mask
+
+        group, separator, topic_filter = subscription_mask[
+            len(cls.SHARED_SUBSCRIPTION_PREFIX):].partition('/')
+
+        if not separator:
+            return '', topic_filter
+
+        return group, topic_filter
+
     @classmethod
     def hash_message_bytes(cls, bytes_):
         """
@@ -127,6 +166,163 @@ class MQTTUtils:
         return bytes_
 
 
+class TopicFilter():
+    """
+    A subscription mask split into its topic levels, matched against topic
+    names without regular expressions. It follows the same rules of the
+    expressions built by :meth:`MQTTUtils.convert_to_ereg`:
+
+      * ``+`` matches a single, possibly empty, level;
+      * ``#`` matches the parent level and any number of child levels;
+      * when `allow_wildcards` is set, the matched topic may itself be a
+        subscription mask, ie ``foo/#`` matches ``foo/+/bar``. Otherwise
+        topics holding ``+`` or ``#`` are never matched by wildcards.
+
+    The mask must be valid, see :meth:`MQTTUtils.subscription_is_valid`.
+
+    :meth:`match` is built on init for the shape of the mask, so exact and
+    ``foo/bar/#`` like masks are matched with plain string comparisons and the
+    topic is only split into levels for masks with single level wildcards,
+    up to the level of a trailing ``#``.
+    """
+    __slots__ = ('mask', 'levels', 'allow_wildcards', 'match')
+
+    def __init__(self, mask, allow_wildcards=False):
+        self.mask = mask
+        self.levels = tuple(mask.split('/'))
+        self.allow_wildcards = allow_wildcards
+
+        if '+' in self.levels:
+            self.match = self._build_level_matcher()
+        elif self.levels[-1] == '#':
+            self.match = self._build_prefix_matcher()
+        else:
+            self.match = self._build_exact_matcher()
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.mask)
+
+    def _build_exact_matcher(self):
+        mask = self.mask
+
+        def match(topic, levels=None):
+            return topic == mask
+
+        return match
+
+    def _build_prefix_matcher(self):
+        # the prefix holds no wildcard characters, as the mask is valid
+        prefix = ''.join(level + '/' for level in self.levels[:-1])
+        parent = prefix[:-1] if prefix else None
+
+        if self.allow_wildcards:
+            def match(topic, levels=None):
+                return topic.startswith(prefix) or topic == parent
+        else:
+            def match(topic, levels=None):
+                return (topic.startswith(prefix) or topic == parent) and \
+                    '+' not in topic and '#' not in topic
+
+        return match
+
+    def _build_level_matcher(self):
+        if self.allow_wildcards:
+            match_masks = self._match_masks
+
+            def match(topic, levels=None):
+                return match_masks(topic.split('/') if levels is None
+                                   else levels)
+
+            return match
+
+        # the literal levels before the first wildcard reject most topics
+        # before splitting them
+        first = self.levels.index('+')
+        prefix = ''.join(level + '/' for level in self.levels[:first])
+
+        # the literal levels after it are compared by index, before scanning
+        # the topic for wildcards, so mismatching topics are never scanned
+        positions = tuple(i for i, level in enumerate(self.levels)
+                          if i > first and level not in ('+', '#'))
+        compare = self._build_literal_comparison(
+            positions, tuple(self.levels[i] for i in positions))
+
+        count = len(self.levels)
+
+        if self.levels[-1] == '#':
+            # '#' also matches the parent level. Levels below it are never
+            # compared, thus they are left unsplit.
+            def match(topic, levels=None):
+                if not topic.startswith(prefix):
+                    return False
+
+                if levels is None:
+                    levels = topic.split('/', count - 1)
+
+                return len(levels) >= count - 1 and compare(levels) and \
+                    '+' not in topic and '#' not in topic
+
+        else:
+            def match(topic, levels=None):
+                if not topic.startswith(prefix):
+                    return False
+
+                if levels is None:
+                    if topic.count('/') != count - 1:
+                        return False
+                    levels = topic.split('/')
+
+                elif len(levels) != count:
+                    return False
+
+                return compare(levels) and \
+                    '+' not in topic and '#' not in topic
+
+        return match
+
+    @staticmethod
+    def _build_literal_comparison(positions, literals):
+        # comparing a tuple built by an itemgetter costs more than a few
+        # indexed comparisons, the usual masks having one to three literals
+        if not positions:
+            return lambda levels: True
+
+        if len(positions) == 1:
+            (i, ), (a, ) = positions, literals
+            return lambda levels: levels[i] == a
+
+        if len(positions) == 2:
+            (i, j), (a, b) = positions, literals
+            return lambda levels: levels[i] == a and levels[j] == b
+
+        if len(positions) == 3:
+            (i, j, k), (a, b, c) = positions, literals
+            return lambda levels: \
+                levels[i] == a and levels[j] == b and levels[k] == c
+
+        getter = itemgetter(*positions)
+        return lambda levels: getter(levels) == literals
+
+    def _match_masks(self, levels):
+        count = len(levels)
+
+        for i, level in enumerate(self.levels):
+            if level == '#':
+                return True
+
+            if i >= count:
+                return False
+
+            if level == '+':
+                if '#' in levels[i]:
+                    return False
+
+            elif level != levels[i]:
+                return False
+
+        return count == len(self.levels)
+
+
 class HaltObject():
     """
     A class which instances raises exception on any get/set/del or method call.
@@ -5,15 +5,21 @@ from tornado.ioloop import IOLoop
 import signal
 from logging import getLogger
 from broker.access_control import SinglePasswordAuthentication, NoAuthentication, FileAuthentication, WebAuthentication
-from broker.persistence import InMemoryPersistence, RedisPersistence
+from broker.persistence import InMemoryPersistence, RedisPersistence, AsyncRedisPersistence, \
+    WriteBehindPersistence, FileLogPersistence, SQLitePersistence
 
-from broker.server import MQTTServer
+from broker.routing import SubscriptionIndex
+from broker.server import MQTTServer, RetainedMessages
 from paho.mqtt.paho_partner_pair import Paho_Partner_Pair
 
 define('rhost', 'localhost', str, "Redis host address")
 define('rport', 6379, int, "Redis host port")
 define('rpassword', None, str, "Redis password")
 define('redis', False, bool, "Use redis as queue backend")
+define('redis_async', False, bool, "Keep the redis state in memory, writing it without blocking the server")
+define('file_log', None, str, "Directory of an append-only log to store the sessions and messages on")
+define('sqlite', None, str, "SQLite database file to store the sessions and messages on")
+define('write_behind', None, int, "Milliseconds the subscription and session state changes may be kept pending, to be persisted together")
 
 define('ssl', False, bool, "Use SSL/TLS on socket")
 define('sslkey', None, str, "SSL/TLS Key file path")
@@ -23,10 +29,21 @@ define('authfile', None, str, "Authentication and authorization config file path
 define('webauth', None, str, "Authentication and authorization web API address")
 define('password', None, str, "Password for client authentication")
 
+define('routing_cache', 1024, int, "Number of topics with a cached delivery plan")
+define('single_delivery', False, bool, "Deliver a message once per client, at the maximum QoS of its matching subscriptions")
+define('retained_memory', None, int, "Bytes of retained messages kept in memory, the rest is read from the persistence when matched")
+define('shared_balancing', 'round_robin', str, "How a shared subscription group member is picked for each message: round_robin or least_outstanding")
+define('write_budget', 64 * 1024, int, "Bytes of ready packets coalesced in a single write per client")
+
+define('max_inflight', 1, int, "QoS 1 and 2 publishes in-flight per client")
+define('ssl_max_inflight', None, int, "QoS 1 and 2 publishes in-flight per client on the SSL/TLS listener, defaults to max_inflight")
+define('client_inflight', [], str, "Per client in-flight windows, as uid=window", multiple=True)
+
 
 class OsSignalHandler():
-    def __init__(self, log):
+    def __init__(self, log, persistence=None):
         self.log = log
+        self.persistence = persistence
         self.servers = list()
 
         # handle interrupts
@@ -51,6 +68,19 @@ class OsSignalHandler():
         for server in self.servers:
             server.disconnect_all_clients()
 
+        if self.servers:
+            # the listeners share the subscription index
+            stats = self.servers[0].subscriptions.stats()
+            self.log.info('routing: %d publishes routed, %d skipped (%.1f%%)'
+                          % (stats['routed'], stats['skipped'],
+                             100 * stats['skipped_ratio']))
+
+        if self.persistence is not None:
+            self.log.info('flushing persistence')
+            flushed = self.persistence.flush()
+            if flushed is not None:
+                flushed.result()
+
         IOLoop.instance().stop()
 
 
@@ -67,6 +97,11 @@ def create_redis_persistence(options, log):
     log.info("[option] Using redis at (%s, %d)" %
              (options.rhost, options.rport))
 
+    if options.redis_async:
+        print("[option] Using non-blocking redis persistence")
+        log.info("[option] Using non-blocking redis persistence")
+        return AsyncRedisPersistence(redis_client)
+
     return RedisPersistence(redis_client)
 
 
@@ -88,13 +123,19 @@ def create_ssl_options(options):
     return ssl_options
 
 
-def start_mqtt_server(persistence, clients,
+def start_mqtt_server(persistence, clients, subscriptions, retained_messages,
                       authentication_agent, log):
     EXTERNAL_ADDRESS = "test.mosquitto.org"
 
     server = MQTTServer(authentication=authentication_agent,
                         persistence=persistence,
                         clients=clients,
+                        subscriptions=subscriptions,
+                        retained_messages=retained_messages,
+                        shared_balancing=options.shared_balancing,
+                        write_budget=options.write_budget,
+                        max_inflight=options.max_inflight,
+                        client_max_inflight=get_client_max_inflight(options),
                         ssl_options=None)
     ppp = Paho_Partner_Pair()
     server.listen(1883)
@@ -105,13 +146,19 @@ def start_mqtt_server(persistence, clients,
     return server
 
 
-def start_secure_mqtt_server(persistence, clients,
-                             authentication_agent, log):
+def start_secure_mqtt_server(persistence, clients, subscriptions,
+                             retained_messages, authentication_agent, log):
     ssl_options = create_ssl_options(options)
 
     server = MQTTServer(authentication=authentication_agent,
                         persistence=persistence,
                         clients=clients,
+                        subscriptions=subscriptions,
+                        retained_messages=retained_messages,
+                        shared_balancing=options.shared_balancing,
+                        write_budget=options.write_budget,
+                        max_inflight=options.ssl_max_inflight or options.max_inflight,
+                        client_max_inflight=get_client_max_inflight(options),
                         ssl_options=ssl_options)
 
     server.listen(8883)
@@ -121,13 +168,41 @@ def start_secure_mqtt_server(persistence, clients,
     return server
 
 
+def get_client_max_inflight(options):
+    client_max_inflight = dict()
+
+    for entry in options.client_inflight:
+        uid, _, window = entry.rpartition('=')
+        client_max_inflight[uid] = int(window)
+
+    return client_max_inflight
+
+
 def get_persistence(options, log):
     if options.redis:
         log.info('persistence: redis')
-        return create_redis_persistence(options, log)
+        persistence = create_redis_persistence(options, log)
+    elif options.file_log is not None:
+        print("[option] Using the log at %s" % options.file_log)
+        log.info('persistence: file log at %s' % options.file_log)
+        persistence = FileLogPersistence(options.file_log)
+    elif options.sqlite is not None:
+        print("[option] Using the SQLite database at %s" % options.sqlite)
+        log.info('persistence: sqlite at %s' % options.sqlite)
+        persistence = SQLitePersistence(options.sqlite)
     else:
         log.info('persistence: memory')
-        return InMemoryPersistence()
+        persistence = InMemoryPersistence()
+
+    if options.write_behind is not None:
+        print("[option] Persisting state changes every %d ms" %
+              options.write_behind)
+        log.info("[option] Persisting state changes every %d ms" %
+                 options.write_behind)
+        persistence = WriteBehindPersistence(persistence,
+                                             interval=options.write_behind)
+
+    return persistence
 
 
 def get_authentication_agent(options, log):
@@ -159,13 +234,18 @@ def main():
     persistence = get_persistence(options, log)
     authentication_agent = get_authentication_agent(options, log)
 
-    signal_handler = OsSignalHandler(log)
+    signal_handler = OsSignalHandler(log, persistence)
 
     clients = dict()
+    subscriptions = SubscriptionIndex(cache_size=options.routing_cache,
+                                      single_delivery=options.single_delivery)
+    retained_messages = RetainedMessages(
+        persistence.get_retained_messages(),
+        max_bytes=options.retained_memory)
 
     log.info('starting server')
-    server = start_mqtt_server(persistence, clients,
-                               authentication_agent, log)
+    server = start_mqtt_server(persistence, clients, subscriptions,
+                               retained_messages, authentication_agent, log)
 
     signal_handler.add(server)
 
@@ -173,6 +253,7 @@ def main():
         print("starting secure server")
         log.info('starting secure server')
         sserver = start_secure_mqtt_server(persistence, clients,
+                                           subscriptions, retained_messages,
                                            authentication_agent,
                                            log)
 
@@ -193,5 +274,6 @@ def main():
     log.info('broker stopped')
 
 
-parse_command_line()
-main()
+if __name__ == '__main__':
+    parse_command_line()
+    main()
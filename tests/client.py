@@ -0,0 +1,202 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from tornado.concurrent import Future
+from tornado.testing import AsyncTestCase, gen_test
+
+from broker.access_control import Authorization
+from broker.client import OutgoingQueue
+from broker.connection import MQTTConnection
+from broker.messages import Connect, Publish
+from broker.persistence import InMemoryClientPersistence
+from broker.server import MQTTServer
+
+
+def done_future():
+    future = Future()
+    future.set_result(None)
+    return future
+
+
+class TestWriteCoalescing(AsyncTestCase):
+    # a QoS 1 publish on 'foo' with a 100 bytes payload takes 109 bytes
+    packet_size = 109
+
+    def setUp(self):
+        super().setUp()
+        self.server = MQTTServer(write_budget=300, max_inflight=100)
+        self.client = self.server.recreate_client('bob')
+        self.client._connected.set()
+
+        # the bytes handed to each write, every packet going through
+        # write_parts
+        self.writes = []
+        self.client.write = MagicMock(side_effect=AssertionError)
+        self.client.write_parts = self.record_write_parts
+
+        # the connection is open as long as there are packets to write
+        self.connection = MagicMock()
+        self.connection.closed.side_effect = \
+            lambda: not self.client.outgoing_queue.packets
+
+    def record_write_parts(self, parts):
+        self.writes.append(list(parts))
+        return done_future()
+
+    def publish(self, count):
+        for n in range(count):
+            msg = Publish(qos=1)
+            msg.topic = 'foo'
+            msg.payload = bytes([n]) * 100
+            self.client.publish(msg)
+
+    def written_publishes(self, parts):
+        packets = list()
+        data = b''.join(parts)
+        while data:
+            size = data[1] + 2
+            packets.append(Publish.from_bytes(data[:size]))
+            data = data[size:]
+
+        return packets
+
+    def all_written_publishes(self):
+        return [msg for parts in self.writes
+                for msg in self.written_publishes(parts)]
+
+    @gen_test
+    def test_packets_joined_up_to_budget(self):
+        self.publish(7)
+        yield self.client._process_outgoing_packets(self.connection)
+
+        # packets are drained while less than the budget has been gathered
+        sizes = [len(b''.join(parts)) for parts in self.writes]
+        self.assertEqual(sizes, [3 * self.packet_size, 3 * self.packet_size,
+                                 self.packet_size])
+
+        # in the queue order
+        payloads = [msg.payload for msg in self.all_written_publishes()]
+        self.assertEqual(payloads, [bytes([n]) * 100 for n in range(7)])
+
+    @gen_test
+    def test_nothing_merged_above_budget(self):
+        self.client.write_budget = self.packet_size
+        self.publish(3)
+        yield self.client._process_outgoing_packets(self.connection)
+
+        self.assertEqual([len(self.written_publishes(parts))
+                          for parts in self.writes], [1, 1, 1])
+
+        for parts in self.writes:
+            size = len(b''.join(parts))
+            self.assertEqual(size, self.packet_size)
+
+    @gen_test
+    def test_post_write_runs_for_every_packet(self):
+        self.publish(5)
+        yield self.client._process_outgoing_packets(self.connection)
+
+        self.assertEqual(len(self.writes), 2)
+
+        outgoing_queue = self.client.outgoing_queue
+        written = self.all_written_publishes()
+        self.assertEqual(len(written), 5)
+
+        for msg in written:
+            self.assertTrue(outgoing_queue.is_sent(msg.id))
+            self.assertIn(msg.id, outgoing_queue.retrial_handles)
+            self.assertIsNotNone(outgoing_queue.retrial_handles[msg.id])
+
+
+class TestInflightWindow(TestCase):
+    def setUp(self):
+        self.persistence = InMemoryClientPersistence('bob')
+        self.queue = OutgoingQueue(self.persistence.outgoing_publishes,
+                                   max_inflight=3)
+
+    def publish(self, count):
+        for n in range(count):
+            msg = Publish(qos=1)
+            msg.topic = 'foo/%d' % n
+            msg.payload = b'x'
+            self.queue.put_publish(msg)
+
+    def test_window_is_filled(self):
+        self.publish(5)
+
+        self.assertEqual(self.queue.publishes.inflight_len, 3)
+        self.assertEqual([msg.topic for msg in self.queue.packets],
+                         ['foo/0', 'foo/1', 'foo/2'])
+        self.assertEqual(self.queue.depth, 5)
+
+    def test_completed_flow_starts_the_next(self):
+        self.publish(5)
+        first = self.queue.packets[0].id
+
+        self.queue.flow_completed(first)
+
+        self.assertEqual(self.queue.publishes.inflight_len, 3)
+        self.assertEqual(self.queue.packets[-1].topic, 'foo/3')
+        self.assertEqual(self.queue.depth, 4)
+
+    def test_widened_window(self):
+        self.publish(5)
+        self.queue.max_inflight = 5
+
+        # the next lookup starts the flows the window now allows
+        while self.queue.get_nowait() is not None:
+            pass
+
+        self.assertEqual(self.queue.publishes.inflight_len, 5)
+
+    def test_single_flow_by_default(self):
+        queue = OutgoingQueue(self.persistence.outgoing_publishes)
+        self.queue = queue
+        self.publish(2)
+
+        self.assertEqual(queue.publishes.inflight_len, 1)
+        self.assertEqual(len(queue.packets), 1)
+
+
+class TestReconnect(TestCase):
+    def setUp(self):
+        # two listeners sharing the clients, as started by start_broker.py
+        client_max_inflight = {'bridge': 16}
+        self.server = MQTTServer(max_inflight=2,
+                                 client_max_inflight=client_max_inflight)
+        self.other_server = MQTTServer(
+            persistence=self.server.persistence, clients=self.server.clients,
+            subscriptions=self.server.subscriptions, max_inflight=4,
+            client_max_inflight=client_max_inflight)
+
+        for uid in ('bob', 'bridge'):
+            self.server.add_client(self.server.recreate_client(uid))
+
+    def connect(self, server, uid):
+        msg = Connect()
+        msg.client_uid = uid
+        msg.clean_session = False
+        msg.keep_alive = 60
+
+        connection = MagicMock(spec=MQTTConnection)
+        connection.closed.return_value = False
+
+        return server.get_or_create_client(connection, msg,
+                                           Authorization.no_restrictions())
+
+    def test_known_client_is_reused(self):
+        client = self.server.clients['bob']
+
+        self.assertIs(self.connect(self.server, 'bob'), client)
+        self.assertTrue(client.is_connected())
+
+    def test_window_of_the_listener(self):
+        client = self.connect(self.other_server, 'bob')
+        self.assertEqual(client.max_inflight, 4)
+
+        client = self.connect(self.server, 'bob')
+        self.assertEqual(client.max_inflight, 2)
+
+    def test_window_of_the_client(self):
+        client = self.connect(self.other_server, 'bridge')
+        self.assertEqual(client.max_inflight, 16)
@@ -0,0 +1,137 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from tornado.iostream import StreamClosedError
+
+from broker.connection import MQTTConnection
+from broker.messages import Publish, Pingreq
+from broker.util import MQTTUtils
+
+
+class FakeStream():
+    def __init__(self):
+        self._read_buffer_size = 0
+        self.is_closed = False
+
+    def set_close_callback(self, callback):
+        pass
+
+    def close(self):
+        self.is_closed = True
+
+
+class RecordingStream(FakeStream):
+    def __init__(self):
+        super().__init__()
+        self.written = []
+
+    def write(self, data, callback=None):
+        self.written.append(data)
+        if callback is not None:
+            callback()
+
+
+class TestFrameParsing(TestCase):
+    def setUp(self):
+        self.connection = MQTTConnection(FakeStream(), ('127.0.0.1', 1883))
+
+        msg = Publish(qos=1)
+        msg.id = 1
+        msg.topic = 'foo/bar'
+        msg.payload = b'x' * 200  # two bytes length field
+        self.publish = msg.raw_data
+        self.pingreq = Pingreq().raw_data
+
+    def test_parses_all_complete_frames(self):
+        data = self.pingreq + self.publish + self.pingreq + self.publish[:5]
+        self.connection._read_buffer += data
+
+        self.assertEqual(self.connection._parse_frames(), 3)
+        self.assertEqual(list(self.connection._frames),
+                         [self.pingreq, self.publish, self.pingreq])
+        self.assertEqual(self.connection._read_buffer, self.publish[:5])
+        self.assertEqual(self.connection._missing_bytes(),
+                         len(self.publish) - 5)
+
+    def test_incomplete_header(self):
+        self.connection._read_buffer += self.publish[:2]
+
+        self.assertEqual(self.connection._parse_frames(), 0)
+        self.assertEqual(self.connection._missing_bytes(), 1)
+
+        self.connection._read_buffer += self.publish[2:]
+        self.assertEqual(self.connection._parse_frames(), 1)
+        self.assertEqual(self.connection._read_buffer, b'')
+
+    def test_malformed_length_closes_the_connection(self):
+        # the remaining length takes at most 4 bytes
+        self.connection._read_buffer += self.pingreq + b'\x30\xff\xff\xff'
+        self.assertEqual(self.connection._parse_frames(), 1)
+        self.assertFalse(self.connection._stream.is_closed)
+
+        self.connection._read_buffer += b'\xff\x01'
+        with self.assertRaises(StreamClosedError):
+            self.connection._parse_frames()
+
+        self.assertTrue(self.connection._stream.is_closed)
+
+
+class TestFanOut(TestCase):
+    def setUp(self):
+        msg = Publish(qos=1)
+        msg.id = 7
+        msg.topic = 'foo/bar'
+        msg.payload = b'x' * 200
+
+        # a received message, as routed by the broker
+        self.publish = Publish.from_bytes(msg.raw_data)
+        self.streams = [RecordingStream() for _ in range(3)]
+        self.connections = [MQTTConnection(stream, ('127.0.0.1', 1883))
+                            for stream in self.streams]
+
+    def fan_out(self, write):
+        copies = []
+        for packet_id, connection in enumerate(self.connections, 1):
+            msg = self.publish.copy()
+            msg.id = packet_id
+            write(connection, msg)
+            copies.append(msg)
+
+        return copies
+
+    def assertDelivered(self):
+        for packet_id, stream in enumerate(self.streams, 1):
+            received = Publish.from_bytes(b''.join(stream.written))
+
+            self.assertEqual(received.id, packet_id)
+            self.assertEqual(received.topic, 'foo/bar')
+            self.assertEqual(received.payload, b'x' * 200)
+
+    def test_write_message(self):
+        with patch.object(MQTTUtils, 'encode_string') as encode_string:
+            copies = self.fan_out(lambda connection, msg:
+                                  connection.write_message(msg))
+
+        self.assertFalse(encode_string.called)
+        self.assertDelivered()
+
+        # a single write each, thus a single send call
+        for stream in self.streams:
+            self.assertEqual(len(stream.written), 1)
+
+        # the topic and payload joined are the ones of the received frame
+        parts = [msg.raw_parts() for msg in copies]
+        self.assertEqual(len(set(id(p[1]) for p in parts)), 1)
+        self.assertEqual(len(set(id(p[-1]) for p in parts)), 1)
+
+    def test_write_parts(self):
+        with patch.object(MQTTUtils, 'encode_string') as encode_string:
+            copies = self.fan_out(lambda connection, msg:
+                                  connection.write_parts(msg.raw_parts()))
+
+        self.assertFalse(encode_string.called)
+        self.assertDelivered()
+
+        for stream, msg in zip(self.streams, copies):
+            self.assertEqual(len(stream.written), 1)
+            self.assertEqual(stream.written[0], msg.raw_data)
@@ -1,5 +1,5 @@
 from unittest import TestCase
-from broker.messages import Publish
+from broker.messages import Publish, Subscribe
 
 
 class TestPublishMessage(TestCase):
@@ -18,4 +18,114 @@ class TestPublishMessage(TestCase):
         precal_digest = b"x\xb5\xc2\xdfJ\xd0'hp\x1d\xaeV\xa1\xec\xa9\x98" \
                         b"\xc8\xcb7\xd8\xb4a_\xb9\xfc\xb4\x8a$\x92\xf6\xceY"
 
-        self.assertEqual(precal_digest, self.msg.__hash__())
\ No newline at end of file
+        self.assertEqual(precal_digest, self.msg.__hash__())
+
+
+class TestSlottedMessage(TestCase):
+    def setUp(self):
+        self.msg = Publish(qos=1)
+        self.msg.id = 1
+        self.msg.topic = 'foo/bar'
+        self.msg.payload = b'abcd'
+
+    def test_has_no_instance_dict(self):
+        self.assertFalse(hasattr(self.msg, '__dict__'))
+
+        with self.assertRaises(AttributeError):
+            self.msg.foo = 'bar'
+
+    def test_encoded_once(self):
+        raw_data = self.msg.raw_data
+
+        self.assertFalse(self.msg._pending_update)
+        self.assertIs(self.msg.raw_data, raw_data)
+
+    def test_changed_field_is_encoded_again(self):
+        raw_data = self.msg.raw_data
+        self.msg.id = 2
+
+        self.assertTrue(self.msg._pending_update)
+        self.assertNotEqual(self.msg.raw_data, raw_data)
+        self.assertEqual(Publish.from_bytes(self.msg.raw_data).id, 2)
+
+    def test_field_mutated_in_place(self):
+        msg = Subscribe()
+        msg.id = 1
+        msg.subscription_intents = [('foo', 0)]
+        raw_data = msg.raw_data
+
+        # the snapshot holds the list itself, the message must be marked
+        msg.subscription_intents.append(('bar', 1))
+        self.assertIs(msg.raw_data, raw_data)
+
+        msg._pending_update = True
+        decoded = Subscribe.from_bytes(msg.raw_data)
+        self.assertEqual(decoded.subscription_intents,
+                         [('foo', 0), ('bar', 1)])
+
+    def test_copy(self):
+        raw_data = self.msg.raw_data
+        copy = self.msg.copy()
+
+        self.assertEqual(copy.raw_data, raw_data)
+
+        copy.id = 2
+        self.assertEqual(self.msg.id, 1)
+        self.assertIs(self.msg.raw_data, raw_data)
+        self.assertEqual(Publish.from_bytes(copy.raw_data).id, 2)
+
+
+class TestDecodedPublishMessage(TestCase):
+    def setUp(self):
+        msg = Publish(qos=1)
+        msg.id = 7
+        msg.topic = 'foo/bar'
+        msg.payload = b'abcd' * 64
+
+        self.raw = msg.raw_data
+        self.msg = Publish.from_bytes(self.raw)
+
+    def test_lazy_decoding(self):
+        self.assertEqual(self.msg.id, 7)
+        self.assertEqual(self.msg.payload_length, 256)
+        self.assertEqual(self.msg.raw_parts(), (self.raw, ))
+
+        self.assertEqual(self.msg.topic, 'foo/bar')
+        self.assertEqual(self.msg.payload, b'abcd' * 64)
+
+    def test_reading_fields_keeps_raw_data(self):
+        self.assertEqual(self.msg.topic, 'foo/bar')
+        self.assertEqual(self.msg.payload, b'abcd' * 64)
+
+        self.assertFalse(self.msg._pending_update)
+        self.assertIs(self.msg.raw_data, self.raw)
+        self.assertEqual(self.msg.raw_parts(), (self.raw, ))
+
+    def test_copies_share_decoded_body(self):
+        copy = self.msg.copy()
+        copy.id = 8
+
+        header, topic, packet_id, payload = copy.raw_parts()
+        self.assertEqual(packet_id, b'\x00\x08')
+
+        # the payload is written from the received frame, without a copy
+        self.assertIsInstance(payload, memoryview)
+        self.assertIs(payload.obj, self.raw)
+        self.assertIs(copy.raw_parts()[-1], payload)
+        self.assertIsNone(self.msg._body._payload)
+
+        self.assertIs(copy.payload, self.msg.payload)
+        self.assertEqual(copy.payload, b'abcd' * 64)
+
+        decoded = Publish.from_bytes(copy.raw_data)
+        self.assertEqual((decoded.topic, decoded.id, decoded.payload),
+                         ('foo/bar', 8, b'abcd' * 64))
+
+    def test_changed_topic(self):
+        copy = self.msg.copy()
+        copy.topic = 'bar'
+        copy.qos = 0
+
+        decoded = Publish.from_bytes(copy.raw_data)
+        self.assertEqual((decoded.topic, decoded.id, decoded.payload),
+                         ('bar', None, b'abcd' * 64))
@@ -246,3 +246,40 @@ class TestRedisHashDict(TestCase):
 
         for item in self.dict.items():
             self.assertIn(item, truth)
+
+
+class TestTopicFilter(TestCase):
+    masks = (
+        '#', '+', '/#', '/+', '+/#', '+/+', 'foo/bar', 'foo/bar/#',
+        'foo/+/bar', 'foo/bar/+', '+/foo/bar', 'foo/+/bar/#',
+        '+/control/+/#', 'sport/tennis/player1', 'foo/+/bar/+/one/two/#',
+        'foo/+/bar/+/one/two/three/#',
+    )
+
+    topics = (
+        '', '/', 'foo', 'foo/bar', 'foo/bar/', 'foo/bar//', 'foo/b',
+        'foo/bar/one/two', '/foo/bar', 'buzz/foo/bar', 'foo//bar',
+        'foo/buzz/bar/abc', 'foo/bar/#', 'foo/bar/+', 'foo/+/bar/+/#',
+        '1/control/user/2', 'sport/tennis/player1', 'foo/x/bar/y/one/two',
+        'foo/x/bar/y/one/two/z', 'foo/x/bar/+/one/two/z', 'foo/x/bar/y/one',
+        'foo/x/bar/y/one/three/z', 'foo/x/bar/y/one/two/three',
+    )
+
+    def test_agrees_with_ereg(self):
+        for allow_wildcards in (False, True):
+            for mask in self.masks:
+                ereg = MQTTUtils.convert_to_ereg(mask, allow_wildcards)
+                topic_filter = MQTTUtils.compile_filter(mask, allow_wildcards)
+
+                for topic in self.topics:
+                    self.assertEqual(
+                        re.match(ereg, topic) is not None,
+                        topic_filter.match(topic),
+                        '%s against %s' % (mask, topic))
+                    self.assertEqual(
+                        topic_filter.match(topic),
+                        topic_filter.match(topic, topic.split('/')))
+
+    def test_invalid_mask(self):
+        self.assertIsNone(MQTTUtils.compile_filter('foo/#/bar'))
+        self.assertIsNone(MQTTUtils.compile_filter('foo+'))
@@ -0,0 +1,925 @@
+import gc
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from redis import StrictRedis
+
+from broker.messages import Publish
+from broker.persistence import PacketIdGenerator, PacketIdsDepletedError, \
+    AsyncRedisPersistence, RedisPersistence, InMemoryPersistence, \
+    WriteBehindPersistence, FileLogPersistence, SQLitePersistence
+from broker.persistence.redis import RedisOutgoingPublishes
+from broker.server import MQTTServer, RetainedMessages
+
+
+class TestPacketIdGenerator(TestCase):
+    def setUp(self):
+        self.reserved = dict()
+        self.gen = PacketIdGenerator(self.reserved)
+
+    def allocate(self):
+        packet_id = self.gen.next()
+        self.assertNotIn(packet_id, self.reserved)
+        self.reserved[packet_id] = True
+        return packet_id
+
+    def release(self, packet_id):
+        del self.reserved[packet_id]
+        self.gen.release(packet_id)
+
+    def test_cycles_through_ids(self):
+        self.assertEqual([self.allocate() for _ in range(3)], [1, 2, 3])
+
+        self.release(1)
+        self.assertEqual(self.allocate(), 4)
+
+    def test_skips_ids_reserved_beforehand(self):
+        self.reserved.update({1: True, 2: True, 4: True})
+
+        self.assertEqual(self.allocate(), 3)
+        self.assertEqual(self.allocate(), 5)
+
+    def test_dense_reservation(self):
+        for _ in range(65534):
+            self.allocate()
+
+        self.assertRaises(PacketIdsDepletedError, self.gen.next)
+
+        self.release(40000)
+        self.release(17)
+        self.assertEqual(self.allocate(), 17)
+        self.assertEqual(self.allocate(), 40000)
+
+    def test_reset(self):
+        self.allocate()
+        self.reserved.clear()
+        self.gen.reset()
+
+        self.assertEqual(self.allocate(), 2)
+
+
+def round_trip(command):
+    def counted(redis, *args, **kwargs):
+        if redis._batched:
+            return command(redis, *args, **kwargs)
+
+        redis.round_trips += 1
+        redis._batched = True
+        try:
+            return command(redis, *args, **kwargs)
+        finally:
+            redis._batched = False
+
+    return counted
+
+
+class FakeRedis(StrictRedis):
+    """
+    An in-process stand-in for the StrictRedis commands used by the
+    persistence, storing everything as bytes as Redis does. It also counts
+    the round trips: a pipeline or a script costs a single one.
+    """
+    def __init__(self):
+        self.data = dict()
+        self.round_trips = 0
+        self._batched = False
+
+    @staticmethod
+    def _encode(value):
+        return value if isinstance(value, bytes) else str(value).encode()
+
+    @round_trip
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    @round_trip
+    def hset(self, name, key, value):
+        self.data.setdefault(name, dict())[self._encode(key)] = self._encode(value)
+
+    @round_trip
+    def hdel(self, name, key):
+        self.data.get(name, dict()).pop(self._encode(key), None)
+
+    @round_trip
+    def hget(self, name, key):
+        return self.data.get(name, dict()).get(self._encode(key))
+
+    @round_trip
+    def hmget(self, name, keys):
+        values = self.data.get(name, dict())
+        return [values.get(self._encode(key)) for key in keys]
+
+    @round_trip
+    def hexists(self, name, key):
+        return self._encode(key) in self.data.get(name, dict())
+
+    @round_trip
+    def hgetall(self, name):
+        return dict(self.data.get(name, dict()))
+
+    @round_trip
+    def hkeys(self, name):
+        return list(self.data.get(name, dict()))
+
+    @round_trip
+    def hlen(self, name):
+        return len(self.data.get(name, dict()))
+
+    @round_trip
+    def sadd(self, key, value):
+        self.data.setdefault(key, set()).add(self._encode(value))
+
+    @round_trip
+    def srem(self, key, value):
+        self.data.get(key, set()).discard(self._encode(value))
+
+    @round_trip
+    def smembers(self, key):
+        return set(self.data.get(key, set()))
+
+    @round_trip
+    def sismember(self, key, value):
+        return self._encode(value) in self.data.get(key, set())
+
+    @round_trip
+    def rpush(self, key, value):
+        self.data.setdefault(key, list()).append(self._encode(value))
+
+    @round_trip
+    def lpop(self, key):
+        values = self.data.get(key)
+        return values.pop(0) if values else None
+
+    @round_trip
+    def lrem(self, key, count, value):
+        values = self.data.get(key, list())
+        if self._encode(value) in values:
+            values.remove(self._encode(value))
+
+    @round_trip
+    def llen(self, key):
+        return len(self.data.get(key, list()))
+
+    @round_trip
+    def lrange(self, key, start, end):
+        return list(self.data.get(key, list()))
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    @round_trip
+    def _execute_pipeline(self, commands):
+        results = [command(*args) for command, args in commands]
+        commands.clear()
+        return results
+
+    def register_script(self, script):
+        # only the scripts of the persistence are known
+        if script == RedisOutgoingPublishes.START_FLOW_SCRIPT:
+            return self._start_flow
+
+        raise NotImplementedError(script)
+
+    @round_trip
+    def _start_flow(self, keys, args):
+        queue_key, ids_key, inflight_key = keys
+        raw_data = self.lpop(queue_key)
+        if raw_data is not None:
+            self.rpush(ids_key, args[0])
+            self.hset(inflight_key, args[0], raw_data)
+
+        return raw_data
+
+
+class FakePipeline():
+    def __init__(self, redis):
+        self._redis = redis
+        self._commands = list()
+
+    def __getattr__(self, command):
+        def queue(*args):
+            self._commands.append((getattr(self._redis, command), args))
+            return self
+
+        return queue
+
+    def execute(self):
+        return self._redis._execute_pipeline(self._commands)
+
+
+class TestAsyncRedisPersistence(TestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.persistence = AsyncRedisPersistence(self.redis)
+
+    def reload(self):
+        self.persistence.sync().result(timeout=5)
+        return AsyncRedisPersistence(self.redis)
+
+    def make_publish(self, payload):
+        msg = Publish(qos=1)
+        msg.topic = 'foo/bar'
+        msg.payload = payload
+        return msg
+
+    def test_session_is_reloaded(self):
+        client = self.persistence.get_for_client('bob')
+        client.subscriptions['foo/+'] = 1
+        client.incoming_packet_ids.add(7)
+
+        publishes = client.outgoing_publishes
+        for payload in (b'a', b'b', b'c'):
+            publishes.insert(self.make_publish(payload))
+
+        first = publishes.get_next()
+        publishes.set_sent(first.id)
+        second = publishes.get_next()
+        publishes.remove(second.id)
+
+        reloaded = self.reload()
+        self.assertEqual(set(reloaded.get_client_uids()), {'bob'})
+
+        client = reloaded.get_for_client('bob')
+        self.assertEqual(dict(client.subscriptions.items()), {'foo/+': 1})
+        self.assertIn(7, client.incoming_packet_ids)
+
+        publishes = client.outgoing_publishes
+        inflight = list(publishes.get_all_inflight())
+        self.assertEqual([(m.id, m.payload) for m in inflight],
+                         [(first.id, b'a')])
+        self.assertTrue(publishes.is_sent(first.id))
+        self.assertEqual(publishes.get_next().payload, b'c')
+
+    def test_sessions_are_loaded_on_demand(self):
+        for uid in ('alice', 'bob', 'carol'):
+            client = self.persistence.get_for_client(uid)
+            client.subscriptions['foo/+'] = 1
+            client.outgoing_publishes.insert(self.make_publish(b'a'))
+
+        self.persistence.sync().result(timeout=5)
+        self.redis.round_trips = 0
+
+        # only the uids are read
+        reloaded = AsyncRedisPersistence(self.redis)
+        self.assertEqual(self.redis.round_trips, 1)
+        self.assertEqual(reloaded._clients, {})
+
+        # a round trip per requested session
+        for uid in ('alice', 'bob', 'carol'):
+            round_trips = self.redis.round_trips
+            client = reloaded.get_for_client(uid)
+            self.assertEqual(self.redis.round_trips, round_trips + 1)
+
+            self.assertEqual(dict(client.subscriptions.items()),
+                             {'foo/+': 1})
+            self.assertEqual(client.outgoing_publishes.get_next().payload,
+                             b'a')
+            reloaded.sync().result(timeout=5)
+
+    def test_write_many(self):
+        client = self.persistence.get_for_client('bob')
+        client.subscriptions['bar'] = 0
+        self.persistence.sync().result(timeout=5)
+
+        round_trips = self.redis.round_trips
+        self.persistence.write_many([
+            (client.subscriptions, {'foo/+': 1}, ['bar']),
+            (client.incoming_packet_ids, [7, 8], []),
+        ])
+        self.persistence.sync().result(timeout=5)
+        self.assertEqual(self.redis.round_trips, round_trips + 1)
+
+        client = self.reload().get_for_client('bob')
+        self.assertEqual(dict(client.subscriptions.items()), {'foo/+': 1})
+        self.assertEqual(set(client.incoming_packet_ids), {7, 8})
+
+    def test_get_subscriptions(self):
+        self.persistence.get_for_client('bob').subscriptions['foo/+'] = 1
+        self.persistence.get_for_client('carol').subscriptions['baz'] = 2
+        self.persistence.get_for_client('alice').subscriptions['bar'] = 0
+
+        reloaded = self.reload()
+        reloaded.get_for_client('alice')
+
+        round_trips = self.redis.round_trips
+        subscriptions = reloaded.get_subscriptions(
+            ['alice', 'bob', 'carol', 'dave'])
+
+        self.assertEqual(set(subscriptions), {
+            ('bob', 'foo/+', 1), ('carol', 'baz', 2), ('alice', 'bar', 0)})
+
+        # the dormant sessions' subscriptions are read together, the
+        # sessions aren't loaded
+        self.assertEqual(self.redis.round_trips, round_trips + 1)
+        self.assertEqual(set(reloaded._clients), {'alice'})
+        self.assertNotIn('dave', reloaded.get_client_uids())
+
+    def test_remove_client_data(self):
+        client = self.persistence.get_for_client('bob')
+        client.subscriptions['foo'] = 0
+        client.outgoing_publishes.insert(self.make_publish(b'a'))
+
+        self.persistence.remove_client_data('bob')
+
+        self.reload()
+        self.assertEqual(self.redis.data, {'mqtt_broker:client_uids': set()})
+
+    def test_retained_messages(self):
+        retained = self.persistence.get_retained_messages()
+        msg = self.make_publish(b'a')
+        msg.id = 1
+        raw = msg.raw_data
+        retained['foo/bar'] = (raw, 'bob')
+
+        reloaded = self.reload().get_retained_messages()
+        self.assertEqual(dict(reloaded.items()), {'foo/bar': (raw, 'bob')})
+
+    def test_only_retained_topics_are_loaded(self):
+        retained = self.persistence.get_retained_messages()
+        raws = dict()
+        for topic in ('foo/bar', 'foo/buzz'):
+            msg = self.make_publish(topic.encode())
+            msg.topic = topic
+            msg.id = 1
+            raws[topic] = msg.raw_data
+            retained[topic] = (msg.raw_data, 'bob')
+
+        self.persistence.sync().result(timeout=5)
+        self.redis.round_trips = 0
+
+        reloaded = RetainedMessages(self.reload().get_retained_messages(),
+                                    max_bytes=0)
+        round_trips = self.redis.round_trips
+
+        # the raw data is fetched on a miss of the hot tier
+        (msg, sender), = reloaded.match('foo/bar')
+        self.assertEqual((msg.raw_data, sender), (raws['foo/bar'], 'bob'))
+        self.assertEqual(self.redis.round_trips, round_trips + 1)
+
+        # and not once the message is kept in memory
+        next(reloaded.match('foo/bar'))
+        self.assertEqual(self.redis.round_trips, round_trips + 1)
+        self.assertEqual(len(reloaded), 2)
+
+        # the misses of a match are read together
+        reloaded = RetainedMessages(self.persistence.get_retained_messages())
+        round_trips = self.redis.round_trips
+        matched = dict((msg.topic, msg.raw_data)
+                       for msg, _ in reloaded.match('foo/#'))
+        self.assertEqual(matched, raws)
+        self.assertEqual(reloaded.stats()['misses'], 2)
+        self.assertEqual(self.redis.round_trips, round_trips + 1)
+
+
+class TestInMemoryOutgoingPublishes(TestCase):
+    def setUp(self):
+        self.publishes = InMemoryPersistence() \
+            .get_for_client('bob').outgoing_publishes
+
+    def insert(self, payload):
+        msg = Publish(qos=1)
+        msg.topic = 'foo/bar'
+        msg.payload = payload
+        self.publishes.insert(msg)
+        return msg
+
+    def test_queue_order(self):
+        for payload in (b'a', b'b', b'c'):
+            self.insert(payload)
+
+        flows = [self.publishes.get_next() for _ in range(3)]
+        self.assertEqual([(m.id, m.payload) for m in flows],
+                         [(1, b'a'), (2, b'b'), (3, b'c')])
+        self.assertIsNone(self.publishes.get_next())
+
+        # the in-flight publishes are kept in the order they were started
+        self.publishes.remove(2)
+        self.insert(b'd')
+        self.publishes.get_next()
+        self.assertEqual([m.payload
+                          for m in self.publishes.get_all_inflight()],
+                         [b'a', b'c', b'd'])
+
+    def test_shared_message_is_left_as_is(self):
+        # the same message is queued for several subscribers
+        msg = self.insert(b'a')
+        self.publishes.insert(msg)
+
+        first = self.publishes.get_next()
+        second = self.publishes.get_next()
+
+        self.assertEqual((first.id, second.id), (1, 2))
+        self.assertIsNone(msg.id)
+
+        # nor are the in-flight publishes changed through the returned copies
+        first.id = 42
+        self.assertEqual(self.publishes.get_inflight(1).id, 1)
+
+    def test_remove_inflight(self):
+        self.insert(b'a')
+        self.insert(b'b')
+        first = self.publishes.get_next()
+        self.publishes.get_next()
+
+        self.publishes.set_sent(first.id)
+        self.publishes.remove(first.id)
+
+        self.assertFalse(self.publishes.is_inflight(first.id))
+        self.assertEqual(self.publishes.inflight_len, 1)
+        with self.assertRaises(KeyError):
+            self.publishes.is_sent(first.id)
+        with self.assertRaises(KeyError):
+            self.publishes.get_inflight(first.id)
+
+        # removing it again, or an unknown id, is a no-op
+        self.publishes.remove(first.id)
+        self.publishes.remove(1000)
+        self.assertEqual(self.publishes.inflight_len, 1)
+
+        self.insert(b'c')
+        self.assertEqual(self.publishes.get_next().id, 3)
+        self.assertEqual([m.payload
+                          for m in self.publishes.get_all_inflight()],
+                         [b'b', b'c'])
+
+
+class TestRedisOutgoingPublishes(TestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.publishes = RedisPersistence(self.redis) \
+            .get_for_client('bob').outgoing_publishes
+
+    def insert(self, payload):
+        msg = Publish(qos=1)
+        msg.topic = 'foo/bar'
+        msg.payload = payload
+        self.publishes.insert(msg)
+
+    def test_flow(self):
+        self.insert(b'a')
+        self.insert(b'b')
+
+        first = self.publishes.get_next()
+        second = self.publishes.get_next()
+        self.assertEqual((first.id, first.payload), (1, b'a'))
+        self.assertEqual((second.id, second.payload), (2, b'b'))
+        self.assertIsNone(self.publishes.get_next())
+        self.assertEqual(self.publishes.inflight_len, 2)
+
+        self.publishes.set_sent(first.id)
+        self.assertTrue(self.publishes.is_sent(first.id))
+        self.assertFalse(self.publishes.is_sent(second.id))
+
+        self.publishes.remove(first.id)
+        self.assertFalse(self.publishes.is_inflight(first.id))
+        self.assertEqual([(m.id, m.payload)
+                          for m in self.publishes.get_all_inflight()],
+                         [(2, b'b')])
+        self.assertEqual(self.publishes.get_inflight(2).payload, b'b')
+
+        self.publishes.remove(second.id)
+        self.assertEqual(self.publishes.inflight_len, 0)
+        self.assertEqual(self.redis.data['bob:outgoing_inflight'], {})
+
+
+class TestRedisClientPersistence(TestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+
+    def test_reads_are_cached(self):
+        client = RedisPersistence(self.redis).get_for_client('bob')
+        client.subscriptions['foo/+'] = 1
+        client.incoming_packet_ids.add(7)
+
+        msg = Publish(qos=1)
+        msg.topic = 'foo/bar'
+        msg.payload = b'a'
+        client.outgoing_publishes.insert(msg)
+        packet_id = client.outgoing_publishes.get_next().id
+        client.outgoing_publishes.set_sent(packet_id)
+
+        round_trips = self.redis.round_trips
+        self.assertEqual(dict(client.subscriptions.items()), {'foo/+': 1})
+        self.assertEqual(client.subscriptions['foo/+'], 1)
+        self.assertIn(7, client.incoming_packet_ids)
+        self.assertTrue(client.outgoing_publishes.is_sent(packet_id))
+        self.assertEqual(client.outgoing_publishes.get_inflight(packet_id).payload,
+                         b'a')
+        self.assertEqual(self.redis.round_trips, round_trips)
+
+        reloaded = RedisPersistence(self.redis).get_for_client('bob')
+        self.assertEqual(dict(reloaded.subscriptions.items()), {'foo/+': 1})
+        self.assertIn(7, reloaded.incoming_packet_ids)
+        self.assertTrue(reloaded.outgoing_publishes.is_sent(packet_id))
+        self.assertEqual([m.payload for m in
+                          reloaded.outgoing_publishes.get_all_inflight()],
+                         [b'a'])
+
+        del reloaded.subscriptions['foo/+']
+        reloaded.incoming_packet_ids.remove(7)
+        self.assertEqual(self.redis.data['bob:subscriptions'], {})
+        self.assertEqual(self.redis.data['bob:incoming_packet_ids'], set())
+
+    def test_get_subscriptions(self):
+        persistence = RedisPersistence(self.redis)
+        persistence.get_for_client('bob').subscriptions['foo/+'] = 1
+        persistence.get_for_client('alice').subscriptions['bar'] = 0
+
+        round_trips = self.redis.round_trips
+        subscriptions = RedisPersistence(self.redis) \
+            .get_subscriptions(['alice', 'bob', 'carol'])
+
+        self.assertEqual(set(subscriptions),
+                         {('bob', 'foo/+', 1), ('alice', 'bar', 0)})
+        self.assertEqual(self.redis.round_trips, round_trips + 1)
+
+
+class TestRedisRetainedMessages(TestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+
+    def open(self):
+        retained_messages = RedisPersistence(self.redis).get_retained_messages()
+        return RetainedMessages(retained_messages)
+
+    def test_loaded_from_bytes_keys(self):
+        msg = Publish(qos=1, retain=True, id=1)
+        msg.topic = 'foo/bar'
+        msg.payload = b'a'
+        self.open().save(msg, 'bob')
+
+        # Redis returns the topics and the sender uids as bytes
+        self.assertEqual(list(self.redis.data['_retained_messages']),
+                         [b'foo/bar'])
+
+        retained = self.open()
+        (matched, sender), = retained.match('foo/+')
+        self.assertEqual((matched.topic, matched.payload, sender),
+                         ('foo/bar', b'a', 'bob'))
+        self.assertEqual(dict(retained.items()),
+                         {'foo/bar': (msg.raw_data, 'bob')})
+
+        retained.save(Publish(topic='foo/bar', payload=b''), 'bob')
+        self.assertEqual(len(self.open()), 0)
+
+
+@patch('broker.persistence.write_behind.IOLoop')
+class TestWriteBehindPersistence(TestCase):
+    def setUp(self):
+        self.backend = InMemoryPersistence()
+        self.persistence = WriteBehindPersistence(self.backend, interval=50,
+                                                  max_pending=5)
+
+    def test_changes_are_coalesced(self, ioloop):
+        subscriptions = self.persistence.get_for_client('bob').subscriptions
+        subscriptions['foo'] = 0
+        subscriptions['foo'] = 1
+        subscriptions['bar'] = 2
+        del subscriptions['bar']
+
+        self.assertEqual(dict(subscriptions.items()), {'foo': 1})
+        self.assertNotIn('bar', subscriptions)
+        self.assertEqual(ioloop.instance().add_timeout.call_count, 1)
+
+        backend = self.backend.get_for_client('bob').subscriptions
+        self.assertEqual(len(backend), 0)
+
+        self.persistence.write_pending()
+        self.assertEqual(dict(backend.items()), {'foo': 1})
+
+    def test_flush_on_max_pending(self, ioloop):
+        incoming_ids = self.persistence.get_for_client('bob').incoming_packet_ids
+        for packet_id in range(1, 6):
+            incoming_ids.add(packet_id)
+
+        self.assertEqual(set(self.backend.get_for_client('bob').incoming_packet_ids),
+                         {1, 2, 3, 4, 5})
+        ioloop.instance().remove_timeout.assert_called_once_with(
+            ioloop.instance().add_timeout.return_value)
+
+    def test_inflight_flags_are_deferred(self, ioloop):
+        publishes = self.persistence.get_for_client('bob').outgoing_publishes
+        msg = Publish(qos=2)
+        msg.topic = 'foo'
+        msg.payload = b'a'
+        publishes.insert(msg)
+
+        packet_id = publishes.get_next().id
+        publishes.set_sent(packet_id)
+        publishes.set_pubconf(packet_id)
+        self.assertTrue(publishes.is_sent(packet_id))
+        self.assertTrue(publishes.is_pubconf(packet_id))
+
+        backend = self.backend.get_for_client('bob').outgoing_publishes
+        self.assertTrue(backend.is_inflight(packet_id))
+        self.assertFalse(backend.is_sent(packet_id))
+
+        self.persistence.write_pending()
+        self.assertTrue(backend.is_sent(packet_id))
+        self.assertTrue(backend.is_pubconf(packet_id))
+
+    def test_get_subscriptions(self, ioloop):
+        self.backend.get_for_client('alice').subscriptions['bar'] = 0
+        self.backend.get_for_client('bob').subscriptions['foo'] = 0
+
+        # a pending change of a requested session
+        self.persistence.get_for_client('bob').subscriptions['foo/+'] = 1
+
+        subscriptions = self.persistence.get_subscriptions(
+            ['alice', 'bob', 'carol'])
+        self.assertEqual(set(subscriptions), {('alice', 'bar', 0),
+                                              ('bob', 'foo', 0),
+                                              ('bob', 'foo/+', 1)})
+
+    def test_only_changed_sessions_are_flushed(self, ioloop):
+        clients = [self.persistence.get_for_client(uid)
+                   for uid in ('alice', 'bob', 'carol')]
+        clients[1].subscriptions['foo'] = 1
+
+        with patch.object(self.backend, 'write_many') as write_many:
+            self.persistence.write_pending()
+
+        (store, items, deleted), = write_many.call_args[0][0]
+        self.assertIs(store, self.backend.get_for_client('bob').subscriptions)
+        self.assertEqual((items, deleted), ({'foo': 1}, []))
+
+    def test_unused_sessions_are_dropped(self, ioloop):
+        self.persistence.get_for_client('bob').subscriptions['foo'] = 1
+        gc.collect()
+        # kept until its changes are written
+        self.assertIn('bob', self.persistence._clients)
+
+        self.persistence.write_pending()
+        gc.collect()
+        self.assertNotIn('bob', self.persistence._clients)
+
+        subscriptions = self.persistence.get_for_client('bob').subscriptions
+        self.assertEqual(dict(subscriptions.items()), {'foo': 1})
+
+    def test_changes_written_in_a_round_trip(self, ioloop):
+        redis = FakeRedis()
+        persistence = WriteBehindPersistence(RedisPersistence(redis))
+
+        for uid in ('alice', 'bob'):
+            client = persistence.get_for_client(uid)
+            client.subscriptions['foo'] = 1
+            client.subscriptions['bar'] = 2
+            client.incoming_packet_ids.add(7)
+
+            msg = Publish(qos=1)
+            msg.topic = 'foo'
+            msg.payload = b'a'
+            client.outgoing_publishes.insert(msg)
+            packet_id = client.outgoing_publishes.get_next().id
+            client.outgoing_publishes.set_sent(packet_id)
+
+        msg.id = 1
+        retained_messages = persistence.get_retained_messages()
+        retained_messages['foo'] = (msg.raw_data, 'bob')
+
+        round_trips = redis.round_trips
+        persistence.write_pending()
+        self.assertEqual(redis.round_trips, round_trips + 1)
+
+        reloaded = RedisPersistence(redis)
+        for uid in ('alice', 'bob'):
+            client = reloaded.get_for_client(uid)
+            self.assertEqual(dict(client.subscriptions.items()),
+                             {'foo': 1, 'bar': 2})
+            self.assertIn(7, client.incoming_packet_ids)
+            self.assertTrue(client.outgoing_publishes.is_sent(packet_id))
+
+        self.assertEqual(reloaded.get_retained_messages()['foo'],
+                         (msg.raw_data, 'bob'))
+
+    def test_removed_client_pending_changes_are_dropped(self, ioloop):
+        self.persistence.get_for_client('bob').subscriptions['foo'] = 0
+        self.persistence.remove_client_data('bob')
+        self.persistence.write_pending()
+
+        self.assertEqual(len(self.backend.get_for_client('bob').subscriptions), 0)
+
+
+class SessionFixture():
+    """
+    Fills a persistence with a session and retained message, to be checked
+    once the persistence is reloaded.
+    """
+    def make_publish(self, payload):
+        msg = Publish(qos=1)
+        msg.topic = 'foo/bar'
+        msg.payload = payload
+        return msg
+
+    def end_tick(self, ioloop):
+        # runs the callbacks added during the IOLoop iteration
+        add_callback = ioloop.instance().add_callback
+        callbacks = [args[0] for args, _ in add_callback.call_args_list]
+        add_callback.reset_mock()
+
+        for callback in callbacks:
+            callback()
+
+    def assert_tick_committed_once(self, ioloop):
+        self.persistence.get_for_client('bob').subscriptions['foo/+'] = 1
+        self.end_tick(ioloop)
+        self.persistence.sync().result(timeout=5)
+
+        server = MQTTServer(persistence=self.persistence)
+        with self.count_commits(self.persistence) as commits:
+            synced = set()
+            for n in range(100):
+                synced.add(server.handle_incoming_publish(
+                    self.make_publish(b'%d' % n), 'alice'))
+
+            # acknowledged once the commit ending the iteration is done
+            future, = synced
+            self.assertFalse(future.done())
+            self.end_tick(ioloop)
+            future.result(timeout=5)
+
+        self.assertEqual(commits.call_count, 1)
+
+        publishes = self.reload().get_for_client('bob').outgoing_publishes
+        payloads = list()
+        while publishes.inflight_len < 100:
+            payloads.append(publishes.get_next().payload)
+        self.assertEqual(payloads, [b'%d' % n for n in range(100)])
+
+    def fill(self, persistence):
+        client = persistence.get_for_client('bob')
+        client.subscriptions['foo/+'] = 1
+        client.subscriptions['bar'] = 0
+        del client.subscriptions['bar']
+        client.incoming_packet_ids.add(7)
+
+        publishes = client.outgoing_publishes
+        for payload in (b'a', b'b', b'c'):
+            publishes.insert(self.make_publish(payload))
+
+        first = publishes.get_next()
+        publishes.set_sent(first.id)
+        second = publishes.get_next()
+        publishes.remove(second.id)
+
+        persistence.get_for_client('alice')
+        persistence.remove_client_data('alice')
+
+        msg = self.make_publish(b'r')
+        msg.id = 1
+        persistence.get_retained_messages()['foo/bar'] = (msg.raw_data, 'bob')
+
+        return first.id
+
+    def assert_filled(self, persistence, packet_id):
+        self.assertEqual(set(persistence.get_client_uids()), {'bob'})
+
+        client = persistence.get_for_client('bob')
+        self.assertEqual(dict(client.subscriptions.items()), {'foo/+': 1})
+        self.assertIn(7, client.incoming_packet_ids)
+
+        publishes = client.outgoing_publishes
+        self.assertEqual([(m.id, m.payload) for m in publishes.get_all_inflight()],
+                         [(packet_id, b'a')])
+        self.assertTrue(publishes.is_sent(packet_id))
+        self.assertEqual(publishes.get_next().payload, b'c')
+
+        (raw_data, sender), = persistence.get_retained_messages().values()
+        self.assertEqual(sender, 'bob')
+
+
+@patch('broker.persistence.file_log.IOLoop')
+class TestFileLogPersistence(SessionFixture, TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.persistence = self.open()
+
+    def tearDown(self):
+        self.persistence.log.close()
+        self.directory.cleanup()
+
+    def open(self, **kwargs):
+        return FileLogPersistence(self.directory.name, **kwargs)
+
+    def reload(self, **kwargs):
+        self.persistence.log.close()
+        self.persistence = self.open(**kwargs)
+        return self.persistence
+
+    def count_commits(self, persistence):
+        log = persistence.log
+        return patch.object(log, '_write', wraps=log._write)
+
+    def test_publishes_of_a_tick_committed_once(self, ioloop):
+        self.assert_tick_committed_once(ioloop)
+
+    def test_session_is_replayed(self, ioloop):
+        packet_id = self.fill(self.persistence)
+        self.end_tick(ioloop)
+        self.persistence.sync().result(timeout=5)
+
+        self.assert_filled(self.reload(), packet_id)
+
+    def test_torn_record_is_dropped(self, ioloop):
+        packet_id = self.fill(self.persistence)
+        client = self.persistence.get_for_client('bob')
+        self.end_tick(ioloop)
+        self.persistence.sync().result(timeout=5)
+
+        client.subscriptions['torn'] = 2
+        self.persistence.log.close()
+
+        segment = self.persistence.log._path(self.persistence.log._segment)
+        size = os.path.getsize(segment)
+        with open(segment, 'r+b') as f:
+            f.truncate(size - 1)
+
+        self.persistence = self.open()
+        self.assert_filled(self.persistence, packet_id)
+
+        # records appended after the torn one are replayed
+        self.persistence.get_for_client('bob').subscriptions['bar'] = 2
+        subscriptions = self.reload().get_for_client('bob').subscriptions
+        self.assertEqual(dict(subscriptions.items()), {'foo/+': 1, 'bar': 2})
+
+    def test_get_subscriptions(self, ioloop):
+        self.fill(self.persistence)
+        persistence = self.reload()
+
+        subscriptions = persistence.get_subscriptions(['bob', 'carol'])
+        self.assertEqual(list(subscriptions), [('bob', 'foo/+', 1)])
+
+        # the sessions are neither requested nor created
+        self.assertEqual(persistence._clients, {})
+        self.assertEqual(set(persistence.get_client_uids()), {'bob'})
+
+        persistence.get_for_client('bob').subscriptions['bar'] = 0
+        subscriptions = persistence.get_subscriptions(['bob'])
+        self.assertEqual(set(subscriptions), {('bob', 'foo/+', 1),
+                                              ('bob', 'bar', 0)})
+
+    def test_compaction(self, ioloop):
+        persistence = self.reload(segment_size=1, compact_segments=4)
+        packet_id = self.fill(persistence)
+
+        # a segment per record
+        log = persistence.log
+        for record in range(30):
+            persistence.get_for_client('carol').subscriptions['baz'] = record
+            log.commit()
+
+        persistence = self.reload(segment_size=1, compact_segments=4)
+        self.assertLess(len(os.listdir(self.directory.name)), 10)
+
+        persistence.remove_client_data('carol')
+        self.assert_filled(persistence, packet_id)
+
+
+@patch('broker.persistence.sqlite.IOLoop')
+class TestSQLitePersistence(SessionFixture, TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'broker.db')
+        self.persistence = SQLitePersistence(self.path)
+
+    def tearDown(self):
+        self.persistence.statements.close()
+        self.directory.cleanup()
+
+    def reload(self):
+        self.persistence.statements.close()
+        self.persistence = SQLitePersistence(self.path)
+        return self.persistence
+
+    def count_commits(self, persistence):
+        statements = persistence.statements
+        return patch.object(statements, '_execute', wraps=statements._execute)
+
+    def test_publishes_of_a_tick_committed_once(self, ioloop):
+        self.assert_tick_committed_once(ioloop)
+
+    def test_session_is_reloaded(self, ioloop):
+        packet_id = self.fill(self.persistence)
+        self.assertEqual(ioloop.instance().add_callback.call_count, 1)
+        self.end_tick(ioloop)
+        self.persistence.sync().result(timeout=5)
+
+        self.persistence.statements.close()
+        self.persistence = SQLitePersistence(self.path)
+        self.assert_filled(self.persistence, packet_id)
+
+    def test_get_subscriptions(self, ioloop):
+        self.fill(self.persistence)
+        self.end_tick(ioloop)
+        self.persistence.sync().result(timeout=5)
+
+        self.persistence.statements.close()
+        self.persistence = SQLitePersistence(self.path)
+
+        subscriptions = self.persistence.get_subscriptions(['bob', 'carol'])
+        self.assertEqual(list(subscriptions), [('bob', 'foo/+', 1)])
+        self.assertEqual(self.persistence._clients, {})
+        self.assertEqual(set(self.persistence.get_client_uids()), {'bob'})
@@ -0,0 +1,332 @@
+from unittest import TestCase
+from unittest.mock import patch
+import re
+
+from broker.routing import SubscriptionIndex
+from broker.util import MQTTUtils
+
+
+class TestSubscriptionIndex(TestCase):
+    masks = (
+        '#', '+', '+/#', '/#', '/+',
+        'foo', 'foo/bar', 'foo/#', 'foo/bar/#',
+        'foo/+', 'foo/+/bar', 'foo/+/bar/#', '+/foo/bar',
+        'sport/tennis/+', 'sport/+/player1/#',
+    )
+
+    topics = (
+        '', '/', 'foo', 'foo/', 'foo/bar', 'foo/bar/', 'foo/bar/buzz',
+        'foo//bar', 'foo/xyz/bar', 'foo/xyz/bar/abc', '/foo/bar',
+        'buzz/foo/bar', 'sport/tennis/player1', 'sport/tennis/player1/score',
+        'foo/+', 'foo/#',
+    )
+
+    def setUp(self):
+        self.index = SubscriptionIndex()
+
+    def test_match_agrees_with_regex(self):
+        for i, mask in enumerate(self.masks):
+            self.index.add('client-%d' % i, mask, i % 3)
+
+        for topic in self.topics:
+            expected = dict()
+            for i, mask in enumerate(self.masks):
+                if re.match(MQTTUtils.convert_to_ereg(mask), topic):
+                    expected['client-%d' % i] = [i % 3]
+
+            self.assertEqual(expected, self.index.match(topic),
+                             'mismatch for topic "%s"' % topic)
+
+    def test_overlapping_subscriptions(self):
+        self.index.add('bob', 'foo/#', 1)
+        self.index.add('bob', 'foo/+', 2)
+        self.index.add('alice', 'foo/bar', 0)
+
+        matches = self.index.match('foo/bar')
+        self.assertEqual(sorted(matches['bob']), [1, 2])
+        self.assertEqual(matches['alice'], [0])
+
+    def test_update_qos(self):
+        self.index.add('bob', 'foo/+', 0)
+        self.index.add('bob', 'foo/+', 2)
+
+        self.assertEqual(self.index.match('foo/bar'), {'bob': [2]})
+        self.assertEqual(len(self.index), 1)
+
+    def test_remove(self):
+        self.index.add('bob', 'foo/+/bar', 1)
+        self.index.add('alice', 'foo/+/bar', 1)
+
+        self.index.remove('bob', 'foo/+/bar')
+        self.index.remove('bob', 'not/subscribed')
+
+        self.assertEqual(self.index.match('foo/x/bar'), {'alice': [1]})
+
+        self.index.remove('alice', 'foo/+/bar')
+        self.assertEqual(self.index.match('foo/x/bar'), {})
+        self.assertTrue(self.index._root.is_empty())
+
+    def test_remove_client(self):
+        self.index.add('bob', 'foo/#', 1)
+        self.index.add('bob', 'bar', 1)
+        self.index.add('alice', 'bar', 0)
+
+        self.index.remove_client('bob')
+
+        self.assertEqual(self.index.masks('bob'), {})
+        self.assertEqual(self.index.match('foo/bar'), {})
+        self.assertEqual(self.index.match('bar'), {'alice': [0]})
+
+
+class TestDeliveryPlanCache(TestCase):
+    def setUp(self):
+        self.index = SubscriptionIndex(cache_size=2)
+        self.index.add('bob', 'site/+/telemetry', 1)
+
+    def test_hit_and_miss(self):
+        plan = self.index.resolve('site/a/telemetry')
+        self.assertEqual(plan, (('bob', (1, )), ))
+
+        self.assertIs(plan, self.index.resolve('site/a/telemetry'))
+        self.assertEqual(self.index.plans.stats(),
+                         {'size': 1, 'hits': 1, 'misses': 1})
+
+    def test_lru_eviction(self):
+        for topic in ('site/a/telemetry', 'site/b/telemetry',
+                      'site/a/telemetry', 'site/c/telemetry'):
+            self.index.resolve(topic)
+
+        self.assertIn('site/a/telemetry', self.index.plans)
+        self.assertNotIn('site/b/telemetry', self.index.plans)
+        self.assertIn('site/c/telemetry', self.index.plans)
+
+    def test_invalidated_by_matching_masks_only(self):
+        self.index.resolve('site/a/telemetry')
+        self.index.resolve('other')
+
+        self.index.add('alice', 'site/#', 0)
+        self.assertNotIn('site/a/telemetry', self.index.plans)
+        self.assertIn('other', self.index.plans)
+
+        self.assertEqual(dict(self.index.resolve('site/a/telemetry')),
+                         {'bob': (1, ), 'alice': (0, )})
+
+        self.index.remove_client('alice')
+        self.assertEqual(self.index.resolve('site/a/telemetry'),
+                         (('bob', (1, )), ))
+
+        self.index.remove('bob', 'site/+/telemetry')
+        self.assertEqual(self.index.resolve('site/a/telemetry'), ())
+
+    def test_disabled(self):
+        index = SubscriptionIndex(cache_size=0)
+        index.add('bob', 'foo', 0)
+
+        self.assertEqual(index.resolve('foo'), (('bob', (0, )), ))
+        self.assertEqual(len(index.plans), 0)
+
+
+class TestTopicFilterStore(TestCase):
+    def setUp(self):
+        self.index = SubscriptionIndex()
+
+    def test_filters_are_shared(self):
+        self.index.add('bob', 'cmd/broadcast/#', 1)
+        self.index.add('alice', 'cmd/broadcast/#', 0)
+        self.index.add('alice', 'cmd/broadcast/#', 2)
+
+        filters = self.index.filters
+        self.assertEqual(filters.references('cmd/broadcast/#'), 2)
+        self.assertIs(filters.get('cmd/broadcast/#'),
+                      filters.get('cmd/broadcast/#'))
+        self.assertTrue(filters.get('cmd/broadcast/#').match('cmd/broadcast'))
+
+    def test_released_with_the_last_subscription(self):
+        self.index.add('bob', 'foo/+', 1)
+        self.index.add('alice', 'foo/+', 1)
+        self.index.add('alice', 'bar', 1)
+
+        self.index.remove('bob', 'foo/+')
+        self.assertIn('foo/+', self.index.filters)
+
+        self.index.remove_client('alice')
+        self.index.remove('alice', 'foo/+')
+        self.assertEqual(len(self.index.filters), 0)
+        self.assertEqual(self.index.filters.references('foo/+'), 0)
+
+
+class TestSharedSubscriptions(TestCase):
+    def setUp(self):
+        self.index = SubscriptionIndex()
+        self.index.add('bob', '$share/workers/ingest/#', 1)
+        self.index.add('alice', '$share/workers/ingest/#', 2)
+        self.index.add('carol', 'ingest/+', 0)
+
+    def test_resolved_apart(self):
+        self.assertEqual(self.index.resolve('ingest/a'), (('carol', (0, )), ))
+
+        group, = self.index.resolve_shared('ingest/a')
+        self.assertEqual((group.name, group.topic_filter),
+                         ('workers', 'ingest/#'))
+        self.assertEqual(group.members, {'bob': 1, 'alice': 2})
+
+        self.assertEqual(self.index.resolve_shared('other'), ())
+        self.assertEqual(self.index.resolve_shared(
+            '$share/workers/ingest/a'), ())
+
+    def test_rotation(self):
+        group, = self.index.resolve_shared('ingest')
+        self.assertEqual(group.rotation(), ['bob', 'alice'])
+
+        group.picked('bob')
+        self.assertEqual(group.rotation(), ['alice', 'bob'])
+
+        self.index.add('dave', '$share/workers/ingest/#', 0)
+        group.picked('alice')
+        self.assertEqual(group.rotation(), ['dave', 'bob', 'alice'])
+
+        self.index.remove('bob', '$share/workers/ingest/#')
+        self.assertEqual(group.rotation(), ['dave', 'alice'])
+
+    def test_remove(self):
+        self.index.resolve_shared('ingest/a')
+
+        self.index.remove('bob', '$share/workers/ingest/#')
+        self.index.remove_client('alice')
+
+        self.assertEqual(self.index.resolve_shared('ingest/a'), ())
+        self.assertEqual(len(self.index.filters), 1)
+
+        self.index.remove('carol', 'ingest/+')
+        self.assertTrue(self.index._root.is_empty())
+
+    def test_filter_of_shared_mask(self):
+        topic_filter = self.index.filters.get('$share/workers/ingest/#')
+        self.assertTrue(topic_filter.match('ingest/a'))
+        self.assertFalse(topic_filter.match('$share/workers/ingest/a'))
+
+    def test_validation(self):
+        self.assertTrue(MQTTUtils.subscription_is_valid('$share/g/a/+'))
+        self.assertFalse(MQTTUtils.subscription_is_valid('$share/g'))
+        self.assertFalse(MQTTUtils.subscription_is_valid('$share//a'))
+        self.assertFalse(MQTTUtils.subscription_is_valid('$share/g#/a'))
+        self.assertFalse(MQTTUtils.subscription_is_valid('$share/g/a/#/b'))
+
+
+class TestSingleDelivery(TestCase):
+    def setUp(self):
+        self.index = SubscriptionIndex(single_delivery=True)
+
+    def test_max_qos(self):
+        self.index.add('bob', 'a/#', 0)
+        self.index.add('bob', 'a/+/c', 2)
+        self.index.add('bob', 'a/b/c', 1)
+        self.index.add('alice', 'a/b/+', 1)
+
+        self.assertEqual(self.index.match('a/b/c'),
+                         {'bob': [2], 'alice': [1]})
+        self.assertEqual(dict(self.index.resolve('a/b/c')),
+                         {'bob': (2, ), 'alice': (1, )})
+        self.assertEqual(self.index.match('a/b'), {'bob': [0]})
+
+    def test_matches_agree(self):
+        index = SubscriptionIndex()
+        for i, mask in enumerate(TestSubscriptionIndex.masks):
+            for uid in ('bob', 'alice'):
+                index.add(uid, mask, (i + len(uid)) % 3)
+                self.index.add(uid, mask, (i + len(uid)) % 3)
+
+        for topic in TestSubscriptionIndex.topics:
+            expected = {uid: [max(qos_list)]
+                        for uid, qos_list in index.match(topic).items()}
+            self.assertEqual(expected, self.index.match(topic))
+
+
+class TestHasSubscribers(TestCase):
+    def test_agrees_with_match(self):
+        for i, mask in enumerate(TestSubscriptionIndex.masks):
+            index = SubscriptionIndex()
+            index.add('bob', mask, 0)
+            index.add('bob', 'unrelated/topic', 0)
+
+            for topic in TestSubscriptionIndex.topics:
+                self.assertEqual(bool(index.match(topic)),
+                                 index.has_subscribers(topic),
+                                 'mismatch for "%s" on "%s"' % (topic, mask))
+
+    def test_shared_subscriptions(self):
+        index = SubscriptionIndex()
+        index.add('bob', '$share/workers/ingest/+', 1)
+
+        self.assertTrue(index.has_subscribers('ingest/a'))
+        self.assertFalse(index.has_subscribers('ingest/a/b'))
+
+    def test_stats(self):
+        index = SubscriptionIndex()
+        self.assertEqual(index.stats()['skipped_ratio'], 0.0)
+        self.assertFalse(index.has_subscribers('foo'))
+
+        index.add('bob', 'foo/#', 1)
+        for topic in ('foo', 'foo/bar', 'bar', 'bar/foo'):
+            index.has_subscribers(topic)
+
+        self.assertEqual(index.stats(), {
+            'routed': 2, 'skipped': 3, 'skipped_ratio': 0.6,
+        })
+
+
+class TestRoute(TestCase):
+    def setUp(self):
+        self.index = SubscriptionIndex()
+        self.index.add('bob', 'site/+/telemetry', 1)
+        self.index.add('alice', '$share/workers/site/#', 0)
+
+    def test_agrees_with_resolve(self):
+        for topic in ('site/a/telemetry', 'site/a', 'telemetry/42'):
+            plan, groups = self.index.route(topic)
+            self.assertEqual(plan, self.index.resolve(topic))
+            self.assertEqual(groups, self.index.resolve_shared(topic))
+
+    def test_hit_skips_the_negative_lookup(self):
+        for topic in ('site/a/telemetry', 'telemetry/42'):
+            self.index.route(topic)
+
+        with patch.object(self.index, 'has_subscribers') as has_subscribers:
+            self.assertEqual(self.index.route('telemetry/42'), ((), ()))
+            plan, groups = self.index.route('site/a/telemetry')
+
+        self.assertFalse(has_subscribers.called)
+        self.assertEqual(plan, (('bob', (1, )), ))
+        self.assertEqual(len(groups), 1)
+        self.assertEqual(self.index.stats(), {
+            'routed': 2, 'skipped': 2, 'skipped_ratio': 0.5,
+        })
+
+    def test_unsubscribed_topics_keep_the_plans(self):
+        index = SubscriptionIndex(cache_size=2, unsubscribed_cache_size=2)
+        index.add('bob', 'site/+/telemetry', 1)
+        index.route('site/a/telemetry')
+
+        for n in range(10):
+            self.assertEqual(index.route('telemetry/%d' % n), ((), ()))
+
+        self.assertIn('site/a/telemetry', index.plans)
+        self.assertEqual(len(index.plans), 1)
+        self.assertEqual(len(index.unsubscribed), 2)
+
+    def test_empty_plan_invalidated(self):
+        self.assertEqual(self.index.route('telemetry/42'), ((), ()))
+        self.assertIn('telemetry/42', self.index.unsubscribed)
+        self.assertNotIn('telemetry/42', self.index.plans)
+
+        self.index.add('carol', 'telemetry/#', 2)
+        plan, _ = self.index.route('telemetry/42')
+        self.assertEqual(plan, (('carol', (2, )), ))
+
+    def test_empty_plan_invalidated_by_shared_subscription(self):
+        self.assertEqual(self.index.route('ingest/a'), ((), ()))
+
+        self.index.add('carol', '$share/workers/ingest/+', 1)
+        plan, groups = self.index.route('ingest/a')
+        self.assertEqual(plan, ())
+        self.assertEqual([group.name for group in groups], ['workers'])
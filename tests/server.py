@@ -0,0 +1,338 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from broker.client import DormantSession
+from broker.messages import Connect, Publish
+from broker.persistence import InMemoryPersistence
+from broker.routing import SubscriptionIndex
+from broker.server import MQTTServer, RetainedMessages
+from broker.util import TopicFilter
+
+
+class TestDormantSessions(TestCase):
+    def setUp(self):
+        self.persistence = InMemoryPersistence()
+        self.persistence.get_for_client('bob').subscriptions['foo/+'] = 1
+
+        self.server = MQTTServer(persistence=self.persistence)
+
+    def test_startup_only_indexes_subscriptions(self):
+        self.assertEqual(self.server.clients, {})
+        self.assertEqual(self.server.subscriptions.masks('bob'), {'foo/+': 1})
+
+    def publish(self, qos):
+        msg = Publish(qos=qos)
+        msg.topic = 'foo/bar'
+        msg.payload = b'a'
+        self.server.broadcast_message(msg, 'alice')
+
+    def test_routing_queues_on_the_dormant_session(self):
+        self.publish(qos=1)
+        self.publish(qos=0)
+
+        self.assertEqual(self.server.clients, {})
+        self.assertIsInstance(self.server.dormant_sessions['bob'],
+                              DormantSession)
+
+        # the flows are only started once the client reconnects
+        publishes = self.persistence.get_for_client('bob').outgoing_publishes
+        self.assertEqual(publishes.inflight_len, 0)
+        self.assertEqual(publishes.get_next().payload, b'a')
+        self.assertIsNone(publishes.get_next())
+
+    def test_topics_without_subscribers_skip_routing(self):
+        self.publish(qos=1)
+        with patch.object(self.server.subscriptions, 'match') as match:
+            msg = Publish(qos=1)
+            msg.topic = 'telemetry/42'
+            msg.payload = b'a'
+            self.server.broadcast_message(msg, 'alice')
+
+        self.assertFalse(match.called)
+        self.assertIn(('telemetry/42', 1), self.server.hacked_topic_list)
+        self.assertEqual(self.server.subscriptions.stats()['skipped'], 1)
+
+        # the topic is cached as unsubscribed, the next publishes skip the trie
+        subscriptions = self.server.subscriptions
+        with patch.object(subscriptions, 'has_subscribers') as has_subscribers:
+            self.server.broadcast_message(msg, 'alice')
+
+        self.assertFalse(has_subscribers.called)
+        self.assertEqual(subscriptions.stats()['skipped'], 2)
+
+    def test_connect_wakes_the_session(self):
+        connect = Connect(client_uid='bob', clean_session=False)
+        self.assertTrue(self.server.is_session_present(connect))
+
+        client = self.server.get_known_client(connect)
+        self.assertIs(self.server.clients['bob'], client)
+        self.assertEqual(client.subscriptions.qos('foo/+'), 1)
+
+    @patch('broker.server.IOLoop')
+    def test_disconnected_client_is_made_dormant(self, ioloop):
+        self.publish(qos=1)
+        client = self.server.wake_session('bob')
+        self.assertNotIn('bob', self.server.dormant_sessions)
+
+        client.disconnect()
+        callback, disconnected = ioloop.current().add_callback.call_args[0]
+        callback(disconnected)
+
+        self.assertEqual(self.server.clients, {})
+        self.assertIsNotNone(self.server.dormant_sessions['bob'].last_seen)
+
+    @patch('broker.server.IOLoop')
+    def test_reconnected_client_is_kept(self, ioloop):
+        client = self.server.wake_session('bob')
+
+        client.disconnect()
+        client._connected.set()
+        callback, disconnected = ioloop.current().add_callback.call_args[0]
+        callback(disconnected)
+
+        self.assertIs(self.server.clients['bob'], client)
+
+    def test_unknown_client(self):
+        connect = Connect(client_uid='carol', clean_session=False)
+        self.assertFalse(self.server.is_session_present(connect))
+        self.assertIsNone(self.server.get_known_client(connect))
+
+    def test_subscribe_enqueues_retained_messages(self):
+        msg = Publish(qos=2, retain=True, id=1)
+        msg.topic = 'foo/bar'
+        msg.payload = b'a'
+        self.server.handle_incoming_publish(msg, 'alice')
+
+        client = self.server.wake_session('bob')
+        with patch.object(client, 'publish') as publish:
+            client.subscribe('foo/#', 1)
+            client.subscribe('other/#', 1)
+
+        (msg_copy, ), _ = publish.call_args
+        self.assertEqual(publish.call_count, 1)
+        self.assertEqual((msg_copy.topic, msg_copy.qos), ('foo/bar', 1))
+
+    def test_clients_share_filters(self):
+        self.persistence.get_for_client('alice').subscriptions['foo/+'] = 0
+        bob = self.server.wake_session('bob')
+        alice = self.server.recreate_client('alice')
+
+        self.assertIs(bob.subscriptions['foo/+'][1],
+                      alice.subscriptions['foo/+'][1])
+        self.assertEqual(self.server.subscriptions.filters.references('foo/+'),
+                         2)
+
+        self.server.remove_client(bob)
+        self.assertEqual(self.server.subscriptions.filters.references('foo/+'),
+                         1)
+
+
+class TestRetainedMessages(TestCase):
+    masks = (
+        '#', '+', '+/#', '/#', '/+', 'foo', 'foo/#', 'foo/+', 'foo/+/bar',
+        'foo/bar/#', '+/+', 'nothing/#',
+    )
+
+    topics = (
+        '', '/', 'foo', 'foo/', 'foo/bar', 'foo/bar/buzz', 'foo//bar',
+        'foo/xyz/bar', '/foo/bar', 'buzz/foo',
+    )
+
+    def setUp(self):
+        self.persisted = dict()
+        self.retained = RetainedMessages(self.persisted)
+
+    def save(self, topic, payload=b'a', qos=1):
+        msg = Publish(qos=qos, retain=True, id=1)
+        msg.topic = topic
+        msg.payload = payload
+        self.retained.save(msg, 'bob')
+
+    def matched_topics(self, mask):
+        return sorted(msg.topic for msg, _ in self.retained.match(mask))
+
+    def test_match_agrees_with_filters(self):
+        for topic in self.topics:
+            self.save(topic)
+
+        for mask in self.masks:
+            topic_filter = TopicFilter(mask)
+            expected = sorted(t for t in self.topics if topic_filter.match(t))
+            self.assertEqual(expected, self.matched_topics(mask),
+                             'mismatch for mask "%s"' % mask)
+
+    def test_messages_are_decoded_once(self):
+        self.save('foo/bar', b'payload')
+
+        (msg, sender), = self.retained.match('foo/+')
+        self.assertEqual((msg.payload, sender), (b'payload', 'bob'))
+        self.assertIs(msg, next(self.retained.match('foo/bar'))[0])
+
+    def test_empty_payload_deletes(self):
+        self.save('foo/bar')
+        self.save('foo/bar/buzz')
+
+        self.save('foo/bar', b'')
+        self.assertEqual(self.matched_topics('#'), ['foo/bar/buzz'])
+
+        self.save('foo/bar/buzz', b'')
+        self.assertEqual(self.persisted, {})
+        self.assertEqual(self.retained._root.children, {})
+
+    def test_loaded_from_persistence(self):
+        self.save('foo/bar', b'old')
+        self.save('foo/bar', b'new')
+
+        retained = RetainedMessages(self.persisted)
+        (msg, sender), = retained.match('foo/#')
+        self.assertEqual((msg.payload, sender), (b'new', 'bob'))
+        self.assertEqual(len(retained), 1)
+
+    def test_lru_eviction(self):
+        self.save('a')
+        frame_size = self.retained.stats()['bytes']
+        self.retained.max_bytes = 2 * frame_size
+
+        self.save('b')
+        self.matched_topics('a')
+        self.save('c')
+
+        self.assertEqual(list(self.retained._hot), ['a', 'c'])
+        self.assertEqual(self.retained.stats(), {
+            'size': 2, 'bytes': 2 * frame_size,
+            'hits': 1, 'misses': 0, 'evictions': 1,
+        })
+
+        # the evicted message is read from the persistence
+        self.assertEqual(self.matched_topics('+'), ['a', 'b', 'c'])
+        # 'b' evicts 'c' from memory, then 'c', kept aside, evicts 'a'
+        self.assertEqual(self.retained.stats()['misses'], 1)
+        self.assertEqual(self.retained.stats()['hits'], 3)
+        self.assertEqual(list(self.retained._hot), ['b', 'c'])
+        self.assertEqual(len(self.retained), 3)
+
+    def test_only_topics_are_loaded(self):
+        self.save('foo/bar')
+        self.save('foo/buzz')
+
+        retained = RetainedMessages(self.persisted, max_bytes=0)
+        self.assertEqual(retained.stats()['size'], 0)
+
+        self.assertEqual(len(list(retained.match('foo/#'))), 2)
+        self.assertEqual(retained.stats()['size'], 1)
+        self.assertEqual(retained.stats()['misses'], 2)
+
+        retained.save(Publish(topic='foo/bar', payload=b''), 'bob')
+        retained.save(Publish(topic='foo/buzz', payload=b''), 'bob')
+        self.assertEqual(retained.stats()['bytes'], 0)
+        self.assertEqual(retained._root.children, {})
+
+    def test_received_payload_is_left_undecoded(self):
+        msg = Publish(qos=1, retain=True, id=1)
+        msg.topic = 'foo/bar'
+        msg.payload = b'payload'
+        received = Publish.from_bytes(msg.raw_data)
+
+        self.retained.save(received, 'bob')
+
+        self.assertIsNone(received._body._payload)
+        self.assertEqual(self.persisted['foo/bar'], (msg.raw_data, 'bob'))
+
+    def test_shared_by_servers(self):
+        persistence = InMemoryPersistence()
+        retained = RetainedMessages(persistence.get_retained_messages())
+        server = MQTTServer(persistence=persistence, retained_messages=retained)
+        ssl_server = MQTTServer(persistence=persistence,
+                                retained_messages=retained)
+
+        msg = Publish(qos=0, retain=True)
+        msg.topic = 'foo'
+        msg.payload = b'a'
+        server.handle_incoming_publish(msg, 'bob')
+
+        self.assertEqual(len(list(ssl_server._retained_messages.match('#'))),
+                         1)
+
+
+class TestSharedSubscriptions(TestCase):
+    mask = '$share/workers/ingest/#'
+
+    def setUp(self):
+        self.server = MQTTServer()
+        self.workers = [self.connect('worker-%d' % n) for n in range(3)]
+
+    def connect(self, uid):
+        client = self.server.recreate_client(uid)
+        self.server.add_client(client)
+        client._connected.set()
+        client.subscribe(self.mask, 1)
+        return client
+
+    def publish(self, count=1, sender_uid='sensor'):
+        for n in range(count):
+            msg = Publish(qos=1)
+            msg.topic = 'ingest/%d' % n
+            msg.payload = b'a'
+            self.server.broadcast_message(msg, sender_uid)
+
+    def depths(self):
+        return [worker.outgoing_queue.depth for worker in self.workers]
+
+    def test_round_robin(self):
+        self.publish(4)
+        self.assertEqual(self.depths(), [2, 1, 1])
+
+    def test_least_outstanding(self):
+        self.server.shared_balancing = 'least_outstanding'
+        for n in range(3):
+            self.workers[0].outgoing_queue.put_publish(Publish())
+
+        self.publish(3)
+        self.assertEqual(self.depths(), [3, 2, 1])
+
+    def test_disconnected_members(self):
+        for worker in self.workers[1:]:
+            worker._connected.clear()
+
+        self.publish(2)
+        self.assertEqual(self.depths(), [2, 0, 0])
+
+        # the messages are queued on a session if no member is connected
+        self.workers[0]._connected.clear()
+        self.publish()
+        self.assertEqual(self.depths(), [2, 1, 0])
+
+    def test_forwarding_sender_is_skipped(self):
+        self.workers[0].receive_subscriptions = True
+        self.publish(2, sender_uid='worker-0')
+        self.assertEqual(self.depths(), [0, 1, 1])
+
+    def test_no_retained_messages(self):
+        msg = Publish(qos=1, retain=True, id=1)
+        msg.topic = 'ingest/a'
+        msg.payload = b'a'
+        self.server.handle_incoming_publish(msg, 'sensor')
+
+        worker = self.connect('worker-3')
+        self.assertEqual(worker.outgoing_queue.depth, 0)
+
+
+class TestSingleDelivery(TestCase):
+    def test_one_copy_per_client(self):
+        server = MQTTServer(subscriptions=SubscriptionIndex(
+            single_delivery=True))
+        client = server.recreate_client('bob')
+        server.add_client(client)
+        client._connected.set()
+        client.subscribe('a/#', 0)
+        client.subscribe('a/+/c', 1)
+
+        msg = Publish(qos=2)
+        msg.topic = 'a/b/c'
+        msg.payload = b'a'
+        with patch.object(client, 'publish') as publish:
+            server.broadcast_message(msg, 'alice')
+
+        (msg_copy, ), _ = publish.call_args
+        self.assertEqual(publish.call_count, 1)
+        self.assertEqual(msg_copy.qos, 1)
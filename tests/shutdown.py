@@ -0,0 +1,79 @@
+import signal
+from logging import getLogger
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from broker.persistence import InMemoryPersistence, FileLogPersistence, \
+    SQLitePersistence, WriteBehindPersistence
+from broker.server import MQTTServer
+from start_broker import OsSignalHandler
+
+
+@patch('broker.persistence.write_behind.IOLoop')
+@patch('broker.persistence.sqlite.IOLoop')
+@patch('broker.persistence.file_log.IOLoop')
+@patch('start_broker.signal')
+@patch('start_broker.IOLoop')
+class TestShutdown(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def shut_down(self, persistence):
+        handler = OsSignalHandler(getLogger('activity.broker'), persistence)
+        handler.add(MQTTServer(persistence=persistence))
+        handler.handle_signal(signal.SIGTERM, None)
+
+    def subscribe(self, persistence):
+        persistence.get_for_client('bob').subscriptions['foo/+'] = 1
+
+    def assertSubscribed(self, persistence):
+        subscriptions = persistence.get_for_client('bob').subscriptions
+        self.assertEqual(dict(subscriptions.items()), {'foo/+': 1})
+
+    def test_default_backend(self, ioloop, *_):
+        persistence = InMemoryPersistence()
+        self.subscribe(persistence)
+
+        self.shut_down(persistence)
+        ioloop.instance().stop.assert_called_once_with()
+
+    def test_file_log_is_closed(self, ioloop, *_):
+        persistence = FileLogPersistence(self.directory.name)
+        self.subscribe(persistence)
+
+        self.shut_down(persistence)
+        self.assertTrue(persistence.log._file.closed)
+        ioloop.instance().stop.assert_called_once_with()
+
+        persistence = FileLogPersistence(self.directory.name)
+        self.assertSubscribed(persistence)
+        persistence.flush()
+
+    def test_sqlite_is_closed(self, ioloop, *_):
+        path = '%s/broker.db' % self.directory.name
+        persistence = SQLitePersistence(path)
+        self.subscribe(persistence)
+
+        self.shut_down(persistence)
+        self.assertIsNone(persistence.statements._connection)
+        ioloop.instance().stop.assert_called_once_with()
+
+        persistence = SQLitePersistence(path)
+        self.assertSubscribed(persistence)
+        persistence.flush()
+
+    def test_write_behind_flushes_the_backend(self, ioloop, *_):
+        backend = FileLogPersistence(self.directory.name)
+        persistence = WriteBehindPersistence(backend, interval=60000)
+        self.subscribe(persistence)
+
+        self.shut_down(persistence)
+        self.assertTrue(backend.log._file.closed)
+
+        persistence = FileLogPersistence(self.directory.name)
+        self.assertSubscribed(persistence)
+        persistence.flush()